@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import atexit
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_AUDIT_FILE = Path(__file__).parent / "audit.jsonl"
+
+class AuditLog:
+    def __init__(self, log_file=DEFAULT_AUDIT_FILE, batch_size=256, flush_interval=1.0):
+        self.log_file = Path(log_file)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.path_key = self._load_path_key()
+
+        self._pending = []
+        self._written = 0
+        self._queued = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _load_path_key(self):
+        key_file = self.log_file.with_suffix('.key')
+        try:
+            return key_file.read_bytes()
+        except FileNotFoundError:
+            pass
+
+        key = secrets.token_bytes(32)
+        self.log_file.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        return key
+
+    def hash_path(self, path):
+        path = os.path.abspath(str(path))
+        return hashlib.blake2b(path.encode('utf-8', 'surrogateescape'), key=self.path_key,
+                               digest_size=16).hexdigest()
+
+    def record(self, event, **fields):
+        entry = {'ts': round(time.time(), 6), 'event': event}
+        entry.update(fields)
+        with self._condition:
+            if self._closed:
+                return
+            self._pending.append(entry)
+            self._queued += 1
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+
+    def flush(self):
+        with self._condition:
+            target = self._queued
+            self._condition.notify_all()
+            while self._written < target and self._writer.is_alive():
+                self._condition.wait(0.1)
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+
+    def _writer_loop(self):
+        while True:
+            with self._condition:
+                if len(self._pending) < self.batch_size and not self._closed:
+                    self._condition.wait(self.flush_interval)
+                batch = self._pending
+                self._pending = []
+                closed = self._closed
+
+            if batch:
+                self._write_batch(batch)
+                with self._condition:
+                    self._written += len(batch)
+                    self._condition.notify_all()
+
+            if closed and not batch:
+                return
+
+    def _write_batch(self, batch):
+        # One write and one fsync per batch: this is the group commit.
+        lines = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in batch)
+        try:
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            print(f"Error writing audit log: {e}")
+
+def open_audit_log(settings):
+    audit_file = settings.get('audit_log', str(DEFAULT_AUDIT_FILE))
+    if not audit_file:
+        return None
+    try:
+        return AuditLog(audit_file,
+                        batch_size=settings.get('audit_batch_size', 256),
+                        flush_interval=settings.get('audit_flush_interval', 1.0))
+    except Exception as e:
+        print(f"Audit log disabled: {e}")
+        return None
\ No newline at end of file
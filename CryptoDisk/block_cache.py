@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import threading
+from collections import OrderedDict
+from metrics import BLOCK_CACHE_BYTES, BLOCK_CACHE_REQUESTS
+from secure_memory import wipe
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+class BlockCache:
+    # Decrypted segments shared by every reader in the process, keyed by
+    # (file id, segment index), or by fingerprint for deduplicated chunks.
+    # Blocks are copied out under the lock, so an eviction can zero them
+    # without a reader still looking at the memory. The cache only wipes its
+    # own copies: the block given to put() and the bytes get() returns are
+    # ordinary objects of the caller. copy_into() fills a buffer the caller
+    # owns and can wipe instead.
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, start=0, end=None):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                BLOCK_CACHE_REQUESTS.inc(result='miss')
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            BLOCK_CACHE_REQUESTS.inc(result='hit')
+            return bytes(block[start:end])
+
+    def copy_into(self, key, buffer, start=0, end=None):
+        # Returns the number of bytes copied to the start of buffer, or None.
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                BLOCK_CACHE_REQUESTS.inc(result='miss')
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            BLOCK_CACHE_REQUESTS.inc(result='hit')
+            with memoryview(block) as view:
+                part = view[start:end]
+                if len(part) > len(buffer):
+                    raise ValueError(f"Buffer of {len(buffer)} bytes is too small for {len(part)}")
+                buffer[:len(part)] = part
+                return len(part)
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        block = bytearray(data)
+        with self._lock:
+            previous = self._blocks.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous)
+                wipe(previous)
+            self._blocks[key] = block
+            self.bytes += len(block)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+                wipe(evicted)
+            BLOCK_CACHE_BYTES.set(self.bytes)
+
+    def clear(self):
+        with self._lock:
+            for block in self._blocks.values():
+                wipe(block)
+            self._blocks.clear()
+            self.bytes = 0
+            BLOCK_CACHE_BYTES.set(0)
+
+    def stats(self):
+        with self._lock:
+            return {'max_bytes': self.max_bytes, 'bytes': self.bytes, 'blocks': len(self._blocks),
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_block_cache(max_bytes=DEFAULT_CACHE_SIZE):
+    # One cache per budget, like the buffer pools; 0 turns caching off.
+    if not max_bytes:
+        return None
+    with _caches_lock:
+        cache = _caches.get(max_bytes)
+        if cache is None:
+            cache = _caches[max_bytes] = BlockCache(max_bytes)
+        return cache
\ No newline at end of file
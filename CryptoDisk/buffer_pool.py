@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import threading
+from contextlib import contextmanager
+
+DEFAULT_MAX_BUFFERS = 8
+
+class BufferPool:
+    def __init__(self, buffer_size, max_buffers=DEFAULT_MAX_BUFFERS):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self._free = []
+        self._lock = threading.Lock()
+        # Callers block here once max_buffers are out, so concurrent jobs never
+        # hold more than buffer_size * max_buffers bytes of I/O buffers.
+        self._available = threading.BoundedSemaphore(max_buffers)
+
+    def acquire(self):
+        self._available.acquire()
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        with self._lock:
+            self._free.append(buffer)
+        self._available.release()
+
+    @contextmanager
+    def buffer(self):
+        buffer = self.acquire()
+        try:
+            yield buffer
+        finally:
+            self.release(buffer)
+
+    def stats(self):
+        with self._lock:
+            idle = len(self._free)
+        return {'buffer_size': self.buffer_size, 'max_buffers': self.max_buffers, 'idle': idle}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_buffer_pool(buffer_size, max_buffers=DEFAULT_MAX_BUFFERS):
+    with _pools_lock:
+        pool = _pools.get(buffer_size)
+        if pool is None:
+            pool = _pools[buffer_size] = BufferPool(buffer_size, max_buffers)
+        return pool
\ No newline at end of file
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import hmac as hmac_compare
+import os
+import time
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+class AesGcmCipher:
+    name = 'aes-256-gcm'
+    key_size = 32
+    nonce_size = 12
+    tag_size = 16
+
+    def __init__(self, key):
+        self._aead = AESGCM(key)
+
+    def encrypt(self, nonce, data, aad):
+        return self._aead.encrypt(nonce, data, aad)
+
+    def decrypt(self, nonce, data, aad):
+        return self._aead.decrypt(nonce, data, aad)
+
+    def decrypt_into(self, nonce, data, aad, buffer):
+        # Lets key slots unwrap into locked memory where the library allows.
+        if hasattr(self._aead, 'decrypt_into'):
+            self._aead.decrypt_into(nonce, data, aad, buffer)
+        else:
+            buffer[:] = self._aead.decrypt(nonce, data, aad)
+
+class ChaCha20Poly1305Cipher(AesGcmCipher):
+    name = 'chacha20-poly1305'
+
+    def __init__(self, key):
+        self._aead = ChaCha20Poly1305(key)
+
+class AesCtrHmacCipher:
+    name = 'aes-256-ctr-hmac-sha256'
+    key_size = 32
+    nonce_size = 12
+    tag_size = 16
+
+    def __init__(self, key):
+        subkeys = HKDF(algorithm=hashes.SHA256(), length=64, salt=None,
+                       info=b'cryptodisk aes-ctr-hmac').derive(key)
+        self._enc_key = subkeys[:32]
+        self._mac_key = subkeys[32:]
+
+    def _tag(self, nonce, ciphertext, aad):
+        mac = hmac.HMAC(self._mac_key, hashes.SHA256())
+        mac.update(len(aad).to_bytes(8, 'big'))
+        mac.update(aad)
+        mac.update(nonce)
+        mac.update(ciphertext)
+        return mac.finalize()[:self.tag_size]
+
+    def _keystream(self, nonce):
+        return Cipher(algorithms.AES(self._enc_key), modes.CTR(nonce + b'\x00' * 4))
+
+    def encrypt(self, nonce, data, aad):
+        ciphertext = self._keystream(nonce).encryptor().update(data)
+        return ciphertext + self._tag(nonce, ciphertext, aad)
+
+    def decrypt(self, nonce, data, aad):
+        ciphertext, tag = data[:-self.tag_size], data[-self.tag_size:]
+        if len(tag) != self.tag_size or not hmac_compare.compare_digest(tag, self._tag(nonce, ciphertext, aad)):
+            raise InvalidTag()
+        return self._keystream(nonce).decryptor().update(ciphertext)
+
+CIPHERS = {cipher.name: cipher for cipher in (AesGcmCipher, ChaCha20Poly1305Cipher, AesCtrHmacCipher)}
+DEFAULT_CIPHER = AesGcmCipher.name
+
+_selected_cipher = None
+
+def get_cipher(name):
+    try:
+        return CIPHERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown cipher: {name}")
+
+def benchmark_ciphers(sample_size=1024 * 1024, rounds=3):
+    data = os.urandom(sample_size)
+    nonce = b'\x00' * 12
+    results = {}
+    for name, cipher_class in CIPHERS.items():
+        try:
+            cipher = cipher_class(os.urandom(cipher_class.key_size))
+            cipher.encrypt(nonce, data[:4096], b'')
+            best = None
+            for _ in range(rounds):
+                started = time.perf_counter()
+                cipher.encrypt(nonce, data, b'')
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = sample_size / max(best, 1e-9) / (1024 * 1024)
+        except Exception:
+            # Not every OpenSSL build ships every algorithm.
+            continue
+    return results
+
+def select_cipher(preferred=None):
+    global _selected_cipher
+    if preferred and preferred != 'auto':
+        return get_cipher(preferred).name
+    if _selected_cipher is None:
+        results = benchmark_ciphers()
+        _selected_cipher = max(results, key=results.get) if results else DEFAULT_CIPHER
+    return _selected_cipher
\ No newline at end of file
@@ -0,0 +1,872 @@
+#!/usr/bin/env python3
+
+# Entry point for the context menu and the command line. Only the modules a
+# command actually needs are imported, so a right-click delete never loads
+# tkinter, watchdog or cryptography.
+
+import argparse
+import itertools
+import json
+import os
+import sys
+from pathlib import Path
+from control import send_request
+from profiler import enable_profiling, PROFILE_ENV_VAR
+
+PASSWORD_ENV_VAR = "CRYPTODISK_PASSWORD"
+# Paths per request to the daemon, so one huge list is not one huge message.
+DAEMON_BATCH_SIZE = 1000
+READ_CHUNK_SIZE = 64 * 1024
+NEW_PASSWORD_ENV_VAR = "CRYPTODISK_NEW_PASSWORD"
+
+def _configured_secure_delete(settings, audit_log, throttle=None, io_priority=None):
+    from secure_delete import SecureDelete
+    from settings import configure_secure_delete
+
+    secure_delete = SecureDelete()
+    configure_secure_delete(secure_delete, settings)
+    secure_delete.audit_log = audit_log
+    if throttle is not None:
+        secure_delete.throttle = throttle
+    if io_priority:
+        secure_delete.io_priority = io_priority
+    return secure_delete
+
+def _io_limits(rate_limit=None, iops_limit=None, io_priority=None):
+    limits = {'rate_limit': rate_limit, 'iops_limit': iops_limit, 'io_priority': io_priority}
+    return {key: value for key, value in limits.items() if value}
+
+def _daemon_request(request):
+    # None when no daemon is running. A daemon that refuses the request is an
+    # error, not a reason to fall back to shredding in this process, and so
+    # is one that got the request but did not answer in time.
+    response = send_request(request)
+    if response is not None and response.get('no_reply'):
+        print("The CryptoDisk daemon got the request but did not reply in time; "
+              "it may still be working on it (see --status)")
+        return response
+    if response is not None and not response.get('ok'):
+        raise ValueError(f"The CryptoDisk daemon refused the request: {response.get('error')}")
+    return response
+
+def delete_file_directly(file_path):
+    delete_files([file_path])
+
+def read_paths(stream, null_separated=False):
+    # Read in chunks: only a partial path is carried over between them.
+    separator = b'\0' if null_separated else b'\n'
+    pending = b''
+    while True:
+        chunk = stream.read(READ_CHUNK_SIZE)
+        *complete, pending = (pending + chunk).split(separator)
+        if not chunk:
+            complete.append(pending)
+        for raw in complete:
+            if not null_separated:
+                raw = raw.rstrip(b'\r')
+            if raw:
+                yield os.fsdecode(raw)
+        if not chunk:
+            return
+
+def _batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+def delete_files(paths, quiet=True, rate_limit=None, iops_limit=None, io_priority=None):
+    # paths may be a stream; it is consumed once, in bounded batches.
+    limits = _io_limits(rate_limit, iops_limit, io_priority)
+    batches = _batches((str(Path(path).absolute()) for path in paths), DAEMON_BATCH_SIZE)
+    for batch in batches:
+        if _daemon_request(dict({'cmd': 'delete', 'paths': batch}, **limits)) is None:
+            break
+    else:
+        return None
+    # No daemon, or it went away: the rest is shredded here.
+    paths = itertools.chain(batch, itertools.chain.from_iterable(batches))
+
+    from settings import load_settings, io_throttle_for
+    from audit_log import open_audit_log
+    from shred_pool import ShredPool
+
+    settings = load_settings()
+    audit_log = open_audit_log(settings)
+    throttle = io_throttle_for(settings, rate_limit, iops_limit)
+
+    def report_progress(done, submitted, path, success):
+        if not quiet:
+            status = "ok" if success else "FAILED"
+            print(f"[{done}/{submitted}] {status} {path}")
+
+    pool = ShredPool(lambda: _configured_secure_delete(settings, audit_log, throttle, io_priority),
+                     max_workers=settings.get('workers', 8),
+                     workers_per_device=settings.get('workers_per_device'),
+                     progress=report_progress)
+    walker = _configured_secure_delete(settings, None)
+    directories = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir() and not path.is_symlink():
+            directories.append(path)
+            for file_path in walker.iter_directory_files(path):
+                pool.submit(file_path)
+        elif path.exists() or path.is_symlink():
+            pool.submit(path)
+    summary = pool.join()
+    for directory in directories:
+        if not walker.remove_empty_directories(directory):
+            print(f"Could not remove every directory under {directory}")
+    if audit_log is not None:
+        audit_log.close()
+    return summary
+
+def read_password(password_file=None, confirm=False, prompt="Password: ", env_var=PASSWORD_ENV_VAR):
+    # Returned as a SecureBuffer: locked memory, zeroed when the process exits.
+    from secure_memory import secure_text
+    if password_file:
+        with open(password_file, 'r') as f:
+            return secure_text(f.readline().rstrip('\r\n'))
+    if os.environ.get(env_var):
+        return secure_text(os.environ[env_var])
+    import getpass
+    password = getpass.getpass(prompt)
+    if confirm and getpass.getpass("Confirm password: ") != password:
+        raise ValueError("Passwords do not match")
+    return secure_text(password)
+
+def read_optional_password(password_file=None):
+    # With recipients or identities a password is only used when one is given.
+    if password_file or os.environ.get(PASSWORD_ENV_VAR):
+        return read_password(password_file)
+    return None
+
+def _crypto_engine(recipients=None, identities=None):
+    from crypto_engine import CryptoEngine
+    from settings import load_settings, configure_crypto_engine
+    from key_slots import load_public_key, load_identities
+
+    settings = load_settings()
+    crypto = CryptoEngine()
+    configure_crypto_engine(crypto, settings)
+    crypto.recipients += [load_public_key(path) for path in recipients or []]
+    crypto.identities = load_identities(identities)
+    return crypto, settings
+
+def transform_file(mode, source, target, password, recipients=None, identities=None):
+    from audit_log import open_audit_log
+
+    crypto, settings = _crypto_engine(recipients, identities)
+    crypto.audit_log = open_audit_log(settings)
+    try:
+        if source != '-' and target != '-':
+            if mode == 'encrypt':
+                crypto.encrypt_file(source, target, password)
+            else:
+                crypto.decrypt_file(source, target, password)
+            return
+
+        # Pipes: nothing is staged on disk and memory stays at one segment.
+        instream = sys.stdin.buffer if source == '-' else open(source, 'rb')
+        outstream = sys.stdout.buffer if target == '-' else open(target, 'wb')
+        try:
+            if mode == 'encrypt':
+                crypto.encrypt_stream(instream, outstream, password,
+                                      name=None if source == '-' else Path(source).name)
+            else:
+                crypto.decrypt_stream(instream, outstream, password)
+            outstream.flush()
+        except BaseException:
+            if target != '-':
+                outstream.close()
+                # Part of the plaintext may already be in the target.
+                crypto.discard_output(target, shred=mode == 'decrypt')
+            raise
+        finally:
+            if source != '-':
+                instream.close()
+            if target != '-':
+                outstream.close()
+    finally:
+        if crypto.audit_log is not None:
+            crypto.audit_log.close()
+
+def generate_key(path, kind='x25519'):
+    from key_slots import generate_keypair
+
+    public_path, recipient = generate_keypair(path, kind)
+    print(f"Wrote private key {path} and public key {public_path} (key id {recipient})")
+
+def list_key_slots(path):
+    from crypto_engine import CryptoEngine
+    from key_slots import describe_slot
+
+    slots = CryptoEngine().list_key_slots(path)
+    if slots is None:
+        print(f"{path} has no key slots (password-only v2 or legacy file)")
+        return
+    for number, slot in enumerate(slots):
+        print(f"  slot {number}: {describe_slot(slot)}")
+
+def change_recipient(action, key, paths, password, identities=None):
+    from key_slots import load_public_key, key_id
+    from rekey import SlotJournal, recover_journals
+
+    crypto, _ = _crypto_engine(identities=identities)
+    if action == 'add':
+        public_key = load_public_key(key)
+    else:
+        # A key id, or the public key file it belongs to.
+        recipient = key_id(load_public_key(key)) if os.path.isfile(key) else key
+    recover_journals()
+    journal = SlotJournal()
+    failed = 0
+    try:
+        for path in paths:
+            try:
+                if action == 'add':
+                    slots = crypto.add_recipient(path, public_key, password, journal)
+                else:
+                    slots = crypto.remove_recipient(path, recipient, password, journal)
+                print(f"{path}: {len(slots)} key slots")
+            except (OSError, ValueError) as e:
+                print(f"{path}: {e}", file=sys.stderr)
+                failed += 1
+    finally:
+        journal.close()
+    return failed
+
+def rekey_vault(paths, password, new_password, identities=None, quiet=True):
+    from rekey import VaultRekey
+    from settings import get_cryptodisk_folder
+
+    crypto, settings = _crypto_engine(identities=identities)
+
+    def report_progress(done, path, outcome):
+        if not quiet:
+            print(f"[{done}] {outcome} {path}")
+
+    rekey = VaultRekey(crypto, password, new_password, workers=settings.get('workers', 8),
+                       progress=report_progress)
+    summary = rekey.run(paths or [get_cryptodisk_folder()])
+    if summary['recovered']:
+        print(f"Finished {summary['recovered']} key slot rewrites interrupted by a crash")
+    print(f"Re-keyed {summary['rekeyed']} of {summary['files']} files in {summary['seconds']:.1f}s "
+          f"({summary['files_per_second']:.0f} files/s, {summary['key_derivations']} key derivations); "
+          f"{summary['unchanged']} already on the new password, {summary['failed']} failed")
+    if summary['grown']:
+        print(f"{summary['grown']} files were copied to make room for their key slots")
+    for error in summary['errors']:
+        print(f"  {error['path']}: {error['error']}", file=sys.stderr)
+    return summary
+
+def mount_vault(mountpoint, password, identities=None):
+    from settings import get_cryptodisk_folder
+    from vault_mount import mount_vault as mount
+
+    crypto, _ = _crypto_engine(identities=identities)
+    mount(crypto, get_cryptodisk_folder(), mountpoint, password)
+
+def wipe_free_space(mount_point, streams=2, rate_limit=None, quiet=True, iops_limit=None, io_priority=None):
+    from settings import load_settings, io_throttle_for
+    from free_space_wipe import FreeSpaceWipe
+
+    settings = load_settings()
+
+    def make_secure_delete():
+        secure_delete = _configured_secure_delete(settings, None, io_priority=io_priority)
+        # One random pass unless configured otherwise: free space holds no
+        # file-specific remanence that extra passes would address.
+        secure_delete.set_policy(settings.get('free_space_policy') or ['random'])
+        return secure_delete
+
+    def report_progress(files, bytes_written):
+        if not quiet:
+            print(f"  {files} fill files, {bytes_written / (1024 * 1024):.0f} MiB written")
+
+    throttle = io_throttle_for(settings, rate_limit, iops_limit)
+    wipe = FreeSpaceWipe(mount_point, make_secure_delete, streams=streams, throttle=throttle,
+                         progress=report_progress)
+    print(f"Wiping free space on {mount_point}...")
+    summary = wipe.run()
+    mb_per_s = summary['bytes_written'] / max(summary['duration'], 1e-6) / (1024 * 1024)
+    print(f"Wrote {summary['bytes_written']} bytes in {summary['files']} files with {summary['streams']} "
+          f"streams in {summary['duration']}s ({mb_per_s:.1f} MiB/s); "
+          f"{summary['free_at_peak']} bytes were left free at the peak")
+    for error in summary['errors']:
+        print(f"  {error}")
+    return summary
+
+def empty_cryptodisk(rate_limit=None, iops_limit=None, io_priority=None, schedule=False):
+    from settings import load_settings, get_cryptodisk_folder, io_throttle_for
+
+    cryptodisk_folder = get_cryptodisk_folder()
+    files = list(cryptodisk_folder.glob("*.crypted"))
+
+    if not files:
+        print("CryptoDisk is already empty")
+        return
+
+    print(f"Found {len(files)} files to delete")
+    confirm = input(f"Delete {len(files)} files permanently? (y/N): ")
+
+    limits = _io_limits(rate_limit, iops_limit, io_priority)
+    if confirm.lower() == 'y' and schedule:
+        from shred_queue import ShredQueue
+        shred_queue = ShredQueue()
+        try:
+            added = shred_queue.add(files)
+        finally:
+            shred_queue.close()
+        send_request({'cmd': 'run_queue'})
+        print(f"Queued {added} files for the next shred window (see --queue)")
+    elif confirm.lower() == 'y' and _daemon_request(dict({'cmd': 'empty'}, **limits)) is not None:
+        print("Queued in the running CryptoDisk daemon (see --status)")
+    elif confirm.lower() == 'y':
+        from audit_log import open_audit_log
+        settings = load_settings()
+        secure_delete = _configured_secure_delete(settings, open_audit_log(settings),
+                                                  io_throttle_for(settings, rate_limit, iops_limit), io_priority)
+        # Every file is in the vault folder, so one directory fsync covers them all.
+        with secure_delete.batch():
+            for i, file_path in enumerate(files, 1):
+                print(f"Deleting {i}/{len(files)}: {file_path.name}")
+                secure_delete.secure_delete_file(str(file_path))
+                report = secure_delete.get_last_report()
+                print(f"  Wrote {report['bytes_written']} bytes in {report['passes']} passes "
+                      f"({report['allocated_size']} allocated of {report['logical_size']} logical)")
+                for record in report.get('verification', []):
+                    status = "passed" if record['passed'] else "FAILED"
+                    print(f"  Verification ({record['mode']}, {record['blocks_checked']} blocks): {status}")
+        from dedup_store import collect_vault_garbage
+        removed = collect_vault_garbage(cryptodisk_folder, secure_delete)
+        if removed:
+            print(f"Shredded {removed} deduplicated chunks no longer referenced")
+        print("CryptoDisk emptied successfully")
+
+def show_queue():
+    response = send_request({'cmd': 'queue'})
+    if response is not None and response.get('ok'):
+        status = response['queue']
+    else:
+        from settings import load_settings
+        from shred_queue import ShredQueue, parse_windows, queue_status
+        try:
+            windows = parse_windows(load_settings().get('shred_windows'))
+        except ValueError as e:
+            print(e)
+            windows = None
+        shred_queue = ShredQueue()
+        try:
+            status = queue_status(shred_queue, windows)
+        finally:
+            shred_queue.close()
+
+    from datetime import datetime
+
+    print(f"Shred queue: {status['pending']} pending ({status['due']} due, {status['due_bytes']} bytes), "
+          f"{status['running']} running, {status['failed']} failed")
+    if status['next_due'] is not None:
+        print(f"Next deadline: {datetime.fromtimestamp(status['next_due']).isoformat(timespec='minutes')}")
+    window = status['window']
+    if status.get('next_window') and window == 'closed':
+        window += f", next opens {status['next_window']}"
+    print(f"Shred window: {window}")
+    for device in status['devices']:
+        print(f"  device {device['device']}: {device['files']} files, {device['bytes']} bytes")
+    for failed in status['failed_files']:
+        print(f"  FAILED {failed['path']}: {failed['error']}")
+
+def run_shred_queue(quiet=True, rate_limit=None, iops_limit=None, io_priority=None):
+    # For systems without the daemon: run from cron or a systemd timer.
+    if send_request({'cmd': 'run_queue'}) is not None:
+        print("The running CryptoDisk daemon will process due deletions (see --queue)")
+        return None
+
+    from settings import load_settings, get_cryptodisk_folder, io_throttle_for
+    from audit_log import open_audit_log
+    from shred_pool import ShredPool
+    from shred_queue import ShredQueue, DEFAULT_BATCH_SIZE, parse_windows, window_open, next_window_start
+    from dedup_store import collect_vault_garbage
+
+    settings = load_settings()
+    windows = parse_windows(settings.get('shred_windows'))
+    shred_queue = ShredQueue()
+    try:
+        shred_queue.recover()
+        if settings.get('retention_hours'):
+            shred_queue.add_vault(get_cryptodisk_folder(), settings['retention_hours'] * 3600)
+        if not window_open(windows):
+            start = next_window_start(windows)
+            print(f"Outside the shred windows, next one opens {start.isoformat(timespec='minutes') if start else 'never'}")
+            return None
+
+        audit_log = open_audit_log(settings)
+        throttle = io_throttle_for(settings, rate_limit, iops_limit)
+
+        def report_progress(done, submitted, path, success):
+            shred_queue.finish(str(path), success, None if success else "secure deletion failed")
+            if not quiet:
+                print(f"[{done}/{submitted}] {'ok' if success else 'FAILED'} {path}")
+
+        totals = {'completed': 0, 'failed': 0, 'bytes_written': 0}
+        # One batch per device at a time; the window is checked between batches.
+        while window_open(windows):
+            paths = shred_queue.claim_batch(settings.get('schedule_batch_size', DEFAULT_BATCH_SIZE))
+            if not paths:
+                break
+            pool = ShredPool(lambda: _configured_secure_delete(settings, audit_log, throttle, io_priority),
+                             max_workers=settings.get('workers', 8),
+                             workers_per_device=settings.get('workers_per_device'),
+                             progress=report_progress)
+            for path in paths:
+                pool.submit(path)
+            summary = pool.join()
+            for key in totals:
+                totals[key] += summary[key]
+        if totals['completed']:
+            collect_vault_garbage(get_cryptodisk_folder(), _configured_secure_delete(settings, audit_log, throttle))
+        if audit_log is not None:
+            audit_log.close()
+        print(f"Deleted {totals['completed']} queued files, {totals['failed']} failed, "
+              f"{totals['bytes_written']} bytes overwritten")
+        return totals
+    finally:
+        shred_queue.close()
+
+def clear_queue(state):
+    if state == 'all':
+        confirm = input("Remove every scheduled deletion from the queue? (y/N): ")
+        if confirm.lower() != 'y':
+            return
+    from shred_queue import ShredQueue
+    shred_queue = ShredQueue()
+    try:
+        removed = shred_queue.remove(None if state == 'all' else state)
+    finally:
+        shred_queue.close()
+    print(f"Removed {removed} entries from the shred queue")
+
+def update_settings(args, settings_changed):
+    from secure_delete import SecureDelete
+    from settings import load_settings, save_settings, configure_secure_delete, secure_delete_settings
+
+    secure_delete = SecureDelete()
+    configure_secure_delete(secure_delete, load_settings())
+
+    if args.set_verify or args.set_verify_samples:
+        mode = args.set_verify or secure_delete.verify_mode
+        samples = args.set_verify_samples or secure_delete.verify_samples
+        secure_delete.set_verification(None if mode == 'off' else mode, samples)
+
+    if args.set_policy:
+        if args.set_policy == 'default':
+            secure_delete.set_policy(None)
+        else:
+            try:
+                if args.set_policy.lstrip().startswith('['):
+                    policy = json.loads(args.set_policy)
+                else:
+                    policy = [name.strip() for name in args.set_policy.split(',') if name.strip()]
+                secure_delete.set_policy(policy)
+            except ValueError as e:
+                print(f"Invalid overwrite policy: {e}")
+                return
+    if args.set_gutmann:
+        secure_delete.use_gutmann = args.set_gutmann == 'on'
+    if args.set_dod:
+        secure_delete.use_dod = args.set_dod == 'on'
+    if args.set_nist:
+        secure_delete.use_nist = args.set_nist == 'on'
+
+    updates = secure_delete_settings(secure_delete)
+    current = load_settings()
+    cipher_name = current.get('cipher', 'auto')
+    if args.set_cipher:
+        from ciphers import get_cipher
+        try:
+            cipher_name = args.set_cipher if args.set_cipher == 'auto' else get_cipher(args.set_cipher).name
+        except ValueError as e:
+            print(e)
+            return
+        updates['cipher'] = cipher_name
+
+    compression = current.get('compression') or 'off'
+    compression_level = current.get('compression_level')
+    if args.set_compression or args.set_compression_level is not None:
+        compression = args.set_compression or compression
+        if args.set_compression_level is not None:
+            compression_level = args.set_compression_level
+        elif args.set_compression:
+            compression_level = None
+        if compression != 'off':
+            from compression import get_compressor
+            try:
+                get_compressor(compression, compression_level)
+            except ValueError as e:
+                print(e)
+                return
+        updates['compression'] = compression
+        updates['compression_level'] = compression_level
+
+    dedup = bool(current.get('dedup'))
+    if args.set_dedup:
+        dedup = updates['dedup'] = args.set_dedup == 'on'
+
+    if args.set_rate_limit is not None:
+        updates['rate_limit'] = args.set_rate_limit or None
+    if args.set_iops_limit is not None:
+        updates['iops_limit'] = args.set_iops_limit or None
+    if args.set_io_priority:
+        updates['io_priority'] = args.set_io_priority
+    from block_cache import DEFAULT_CACHE_SIZE
+    block_cache_size = current.get('block_cache_size', DEFAULT_CACHE_SIZE)
+    if args.set_block_cache is not None:
+        block_cache_size = updates['block_cache_size'] = int(args.set_block_cache * 1024 * 1024)
+
+    recipients = current.get('recipients') or []
+    if args.set_recipient:
+        recipients = [] if 'none' in args.set_recipient else [str(Path(path).absolute()) for path in args.set_recipient]
+        from key_slots import load_public_key
+        try:
+            for path in recipients:
+                load_public_key(path)
+        except (OSError, ValueError) as e:
+            print(e)
+            return
+        updates['recipients'] = recipients
+
+    retention = current.get('retention_hours')
+    if args.set_retention is not None:
+        retention = updates['retention_hours'] = args.set_retention or None
+    windows = current.get('shred_windows') or []
+    if args.set_shred_window:
+        from shred_queue import parse_windows
+        windows = [] if 'always' in args.set_shred_window else args.set_shred_window
+        try:
+            parse_windows(windows)
+        except ValueError as e:
+            print(e)
+            return
+        updates['shred_windows'] = windows
+
+    if settings_changed:
+        save_settings(updates)
+        send_request({'cmd': 'reload'})
+        print("Settings updated")
+
+    if args.settings:
+        methods, total_passes = secure_delete.get_overwrite_info()
+        print("Current Settings:")
+        for method in methods:
+            print(f"  - {method}")
+        print(f"Total passes: {total_passes}")
+        plan = secure_delete.get_plan()
+        print(f"Pass plan: {', '.join(plan.describe())}")
+        if plan.merged:
+            print(f"Merged passes already written by an earlier method: {', '.join(plan.merged)}")
+        verify_mode = secure_delete.verify_mode or 'off'
+        if verify_mode == 'sampled':
+            verify_mode += f" ({secure_delete.verify_samples} blocks)"
+        print(f"Verification: {verify_mode}")
+        print(f"I/O limit: {secure_delete.throttle.describe() if secure_delete.throttle else 'unlimited'}, "
+              f"priority: {secure_delete.io_priority or 'normal'}")
+        print(f"Cipher: {cipher_name}")
+        if compression_level is not None and compression != 'off':
+            compression += f" (level {compression_level})"
+        print(f"Compression: {compression}")
+        print(f"Retention: {f'{retention:g} hours' if retention else 'off'}")
+        print(f"Shred windows: {'; '.join(windows) if windows else 'always'}")
+        print(f"Recipients: {', '.join(recipients) if recipients else 'none'}")
+        print(f"Block cache: {f'{block_cache_size / (1024 * 1024):g} MiB' if block_cache_size else 'off'}")
+        print(f"Deduplication: {'on' if dedup else 'off'}")
+        from settings import get_cryptodisk_folder
+        from dedup_store import open_vault_store
+        store = open_vault_store(get_cryptodisk_folder())
+        if store is not None:
+            stats = store.stats()
+            store.close()
+            print(f"  {stats['files']} files, {stats['chunks']} chunks, {stats['stored_bytes']} bytes stored "
+                  f"for {stats['referenced_bytes']} bytes referenced")
+
+def benchmark_ciphers():
+    from ciphers import benchmark_ciphers as run_benchmark
+
+    results = run_benchmark()
+    for name, speed in sorted(results.items(), key=lambda item: -item[1]):
+        print(f"  {name:<26} {speed:8.1f} MB/s")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='CryptoDisk - Secure File Destruction')
+    parser.add_argument('--delete', metavar='FILE', nargs='*', help='Delete files directly without GUI')
+    parser.add_argument('--encrypt', nargs=2, metavar=('SRC', 'DST'),
+                        help='Encrypt SRC to DST; either may be - for stdin/stdout')
+    parser.add_argument('--decrypt', nargs=2, metavar=('SRC', 'DST'),
+                        help='Decrypt SRC to DST; either may be - for stdin/stdout')
+    parser.add_argument('--password-file', metavar='FILE',
+                        help=f'Read the --encrypt/--decrypt password from FILE instead of {PASSWORD_ENV_VAR} '
+                             f'or a prompt')
+    parser.add_argument('--recipient', action='append', metavar='PUBKEY',
+                        help='With --encrypt, also encrypt to this X25519/RSA public key (PEM); repeatable. '
+                             'No password is asked for unless one is supplied')
+    parser.add_argument('--identity', action='append', metavar='KEYFILE',
+                        help='Private key (PEM) used to open files instead of a password; repeatable')
+    parser.add_argument('--generate-key', metavar='PATH',
+                        help='Write a new private key to PATH and its public key to PATH.pub')
+    parser.add_argument('--key-type', choices=['x25519', 'rsa'], default='x25519',
+                        help='Key type for --generate-key (default x25519)')
+    parser.add_argument('--add-recipient', nargs='+', metavar=('PUBKEY', 'FILE'),
+                        help='Give PUBKEY access to the encrypted FILEs by adding a key slot (payload untouched)')
+    parser.add_argument('--remove-recipient', nargs='+', metavar=('KEYID', 'FILE'),
+                        help='Remove the key slot of KEYID (or of a public key file) from the encrypted FILEs')
+    parser.add_argument('--rekey', nargs='*', metavar='PATH',
+                        help='Replace the password of encrypted files (default: the whole vault) by rewriting '
+                             'only their key slots; the old password opens them, or --identity')
+    parser.add_argument('--new-password-file', metavar='FILE',
+                        help=f'Read the --rekey password from FILE instead of {NEW_PASSWORD_ENV_VAR} or a prompt')
+    parser.add_argument('--mount', metavar='MOUNTPOINT',
+                        help='Show the vault read-only under original names through FUSE (needs fusepy); '
+                             'files are decrypted in memory as they are read')
+    parser.add_argument('--list-slots', metavar='FILE', help='List the key slots of an encrypted file')
+    parser.add_argument('--stdin', action='store_true',
+                        help='With --delete, also read paths from stdin (one per line)')
+    parser.add_argument('-0', '--null', action='store_true',
+                        help='Paths on stdin are NUL-separated (find -print0)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print progress for --delete and --rekey')
+    parser.add_argument('--wipe-free-space', metavar='PATH',
+                        help='Overwrite all free space on the filesystem containing PATH')
+    parser.add_argument('--wipe-streams', type=int, default=2, metavar='N',
+                        help='Parallel fill streams for --wipe-free-space (default 2)')
+    parser.add_argument('--rate-limit', type=float, metavar='MBPS',
+                        help='Limit the I/O of --delete, --empty and --wipe-free-space to MBPS MiB/s '
+                             '(on top of the configured limit) so other workloads keep their share')
+    parser.add_argument('--iops-limit', type=int, metavar='N',
+                        help='Limit --delete, --empty and --wipe-free-space to N I/O operations per second')
+    parser.add_argument('--io-priority', choices=['idle', 'best-effort', 'normal'],
+                        help='Linux I/O scheduling class for this job (idle: only use the disk when nothing '
+                             'else does)')
+    parser.add_argument('--background', action='store_true',
+                        help='Run headless as a daemon with a local control socket')
+    parser.add_argument('--status', action='store_true', help='Show the status of the background daemon')
+    parser.add_argument('--profile', metavar='TRACE_FILE',
+                        help=f'Record timing spans and write them at exit (Chrome trace JSON, or collapsed '
+                             f'stacks for .folded/.txt); also enabled by {PROFILE_ENV_VAR}')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='Serve Prometheus metrics on 127.0.0.1:PORT/metrics in background mode')
+    parser.add_argument('--empty', action='store_true', help='Empty CryptoDisk folder')
+    parser.add_argument('--schedule', action='store_true',
+                        help='With --empty, queue the files for the next shred window instead of deleting now')
+    parser.add_argument('--queue', action='store_true', help='Show the scheduled shred queue')
+    parser.add_argument('--run-queue', action='store_true',
+                        help='Delete queued files that are due, if a shred window is open (for cron/timers)')
+    parser.add_argument('--clear-queue', choices=['failed', 'all'],
+                        help='Remove failed or all entries from the shred queue (files are kept)')
+    parser.add_argument('--settings', action='store_true', help='Show settings in terminal')
+    parser.add_argument('--set-gutmann', choices=['on', 'off'], help='Enable/disable Gutmann method')
+    parser.add_argument('--set-dod', choices=['on', 'off'], help='Enable/disable DoD method')
+    parser.add_argument('--set-nist', choices=['on', 'off'], help='Enable/disable NIST method')
+    parser.add_argument('--set-verify', choices=['off', 'sampled', 'full'],
+                        help='Read back overwritten data after the last pass')
+    parser.add_argument('--set-verify-samples', type=int, metavar='N',
+                        help='Number of blocks checked by sampled verification')
+    parser.add_argument('--set-policy', metavar='POLICY',
+                        help='Overwrite policy: comma-separated names (nist,dod,gutmann,random,verify), '
+                             'a JSON pass list, or "default" to use the method switches')
+    parser.add_argument('--set-cipher', metavar='CIPHER',
+                        help='Cipher for new vault files: aes-256-gcm, chacha20-poly1305, '
+                             'aes-256-ctr-hmac-sha256, or "auto" to pick the fastest on this CPU')
+    parser.add_argument('--set-compression', choices=['off', 'zlib', 'zstd', 'auto'],
+                        help='Compress compressible files before encryption (auto: zstd if installed, else zlib)')
+    parser.add_argument('--set-compression-level', type=int, metavar='LEVEL',
+                        help='Compression level (zlib 0-9, zstd 1-22)')
+    parser.add_argument('--set-dedup', choices=['on', 'off'],
+                        help='Store repeated content in the vault only once (content-defined chunking)')
+    parser.add_argument('--set-block-cache', type=float, metavar='MIB',
+                        help='Memory for decrypted segments shared by readers in one process (0 = off)')
+    parser.add_argument('--set-rate-limit', type=float, metavar='MBPS',
+                        help='Limit all shredding I/O to MBPS MiB/s (0 to disable)')
+    parser.add_argument('--set-iops-limit', type=int, metavar='N',
+                        help='Limit all shredding to N I/O operations per second (0 to disable)')
+    parser.add_argument('--set-io-priority', choices=['idle', 'best-effort', 'normal'],
+                        help='Linux I/O scheduling class for shredding workers')
+    parser.add_argument('--set-retention', type=float, metavar='HOURS',
+                        help='Queue vault files for deletion HOURS after they were added (0 to disable)')
+    parser.add_argument('--set-shred-window', action='append', metavar='CRON',
+                        help='Off-peak window for queued deletions as cron fields "minute hour day month '
+                             'weekday", e.g. "* 22-23,0-5 * * 1-5"; repeat for several, "always" to clear')
+    parser.add_argument('--set-recipient', action='append', metavar='PUBKEY',
+                        help='Public key every new vault file is also encrypted to; repeat for several, '
+                             '"none" to clear')
+    parser.add_argument('--benchmark-ciphers', action='store_true',
+                        help='Measure the throughput of each supported cipher')
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    enable_profiling(args.profile)
+
+    if args.delete is not None or args.stdin:
+        paths = args.delete or []
+        if args.stdin:
+            paths = itertools.chain(paths, read_paths(sys.stdin.buffer, args.null))
+        try:
+            summary = delete_files(paths, quiet=not args.verbose, rate_limit=args.rate_limit,
+                                   iops_limit=args.iops_limit, io_priority=args.io_priority)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        if summary is not None and args.verbose:
+            print(f"Deleted {summary['completed']} files, {summary['failed']} failed, "
+                  f"{summary['bytes_written']} bytes overwritten on {summary['devices']} device(s)")
+            if summary['completed']:
+                calls = sum(summary['syscalls'].values()) / summary['completed']
+                print(f"{calls:.1f} file system calls per file, {summary['directory_syncs']} directory fsyncs")
+        return
+
+    if args.encrypt or args.decrypt:
+        mode = 'encrypt' if args.encrypt else 'decrypt'
+        source, target = args.encrypt or args.decrypt
+        try:
+            if args.recipient if mode == 'encrypt' else args.identity:
+                password = read_optional_password(args.password_file)
+            else:
+                password = read_password(args.password_file, confirm=mode == 'encrypt')
+            transform_file(mode, source, target, password, args.recipient, args.identity)
+        except (OSError, ValueError) as e:
+            print(f"Could not {mode} {source}: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if args.generate_key:
+        try:
+            generate_key(args.generate_key, args.key_type)
+        except (OSError, ValueError) as e:
+            print(f"Could not generate a key: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if args.list_slots:
+        try:
+            list_key_slots(args.list_slots)
+        except (OSError, ValueError) as e:
+            print(f"Could not read {args.list_slots}: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if args.add_recipient or args.remove_recipient:
+        action = 'add' if args.add_recipient else 'remove'
+        key, *paths = args.add_recipient or args.remove_recipient
+        if not paths:
+            print(f"--{action}-recipient needs at least one encrypted file", file=sys.stderr)
+            sys.exit(2)
+        try:
+            password = read_optional_password(args.password_file) if args.identity else read_password(args.password_file)
+            failed = change_recipient(action, key, paths, password, args.identity)
+        except (OSError, ValueError) as e:
+            print(f"Could not {action} recipient: {e}", file=sys.stderr)
+            sys.exit(1)
+        if failed:
+            sys.exit(1)
+        return
+
+    if args.rekey is not None:
+        try:
+            password = read_optional_password(args.password_file) if args.identity else read_password(args.password_file)
+            new_password = read_password(args.new_password_file, confirm=True, prompt="New password: ",
+                                         env_var=NEW_PASSWORD_ENV_VAR)
+            summary = rekey_vault(args.rekey, password, new_password, args.identity, quiet=not args.verbose)
+        except (OSError, ValueError) as e:
+            print(f"Could not re-key: {e}", file=sys.stderr)
+            sys.exit(1)
+        if summary['failed']:
+            sys.exit(1)
+        return
+
+    if args.mount:
+        try:
+            password = read_optional_password(args.password_file) if args.identity else read_password(args.password_file)
+            mount_vault(args.mount, password, args.identity)
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"Could not mount the vault: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if args.wipe_free_space:
+        try:
+            wipe_free_space(args.wipe_free_space, args.wipe_streams, args.rate_limit, quiet=not args.verbose,
+                            iops_limit=args.iops_limit, io_priority=args.io_priority)
+        except (OSError, ValueError) as e:
+            print(f"Free space wipe failed: {e}")
+            sys.exit(1)
+        return
+
+    if args.status:
+        response = send_request({'cmd': 'status'})
+        if response is None:
+            print("CryptoDisk daemon is not running")
+        elif response.get('no_reply'):
+            print(f"The CryptoDisk daemon did not answer: {response.get('error')}")
+        elif not response.get('ok'):
+            print(f"The CryptoDisk daemon refused the request: {response.get('error')}")
+        else:
+            print(json.dumps(response['status'], indent=2))
+        return
+
+    if args.background:
+        from daemon import CryptoDiskDaemon
+        try:
+            CryptoDiskDaemon(metrics_port=args.metrics_port).serve_forever()
+        except (OSError, RuntimeError) as e:
+            print(e)
+        return
+
+    if args.empty:
+        try:
+            empty_cryptodisk(args.rate_limit, args.iops_limit, args.io_priority, schedule=args.schedule)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if args.queue:
+        show_queue()
+        return
+
+    if args.run_queue:
+        try:
+            run_shred_queue(not args.verbose, args.rate_limit, args.iops_limit, args.io_priority)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        return
+
+    if args.clear_queue:
+        clear_queue(args.clear_queue)
+        return
+
+    if args.benchmark_ciphers:
+        benchmark_ciphers()
+        return
+
+    settings_changed = any(value is not None for value in (
+        args.set_gutmann, args.set_dod, args.set_nist, args.set_policy,
+        args.set_verify, args.set_verify_samples, args.set_cipher, args.set_compression,
+        args.set_compression_level, args.set_dedup, args.set_block_cache, args.set_rate_limit,
+        args.set_iops_limit, args.set_io_priority, args.set_retention, args.set_shred_window, args.set_recipient))
+
+    if args.settings or settings_changed:
+        update_settings(args, settings_changed)
+        return
+
+    from main import CryptoDisk
+    app = CryptoDisk()
+    try:
+        app.run()
+    finally:
+        app.stop()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
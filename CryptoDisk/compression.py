@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SAMPLE_SIZE = 64 * 1024
+# Data that zlib level 1 cannot shrink below this ratio (media, archives,
+# already encrypted files) is stored as-is.
+INCOMPRESSIBLE_RATIO = 0.95
+
+class ZlibCompressor:
+    name = 'zlib'
+    default_level = 6
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else int(level)
+        if not 0 <= self.level <= 9:
+            raise ValueError("zlib level must be between 0 and 9")
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, max_size):
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("Compressed segment is corrupted or larger than the chunk size")
+        return result
+
+class ZstdCompressor:
+    name = 'zstd'
+    default_level = 3
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else int(level)
+        if not 1 <= self.level <= 22:
+            raise ValueError("zstd level must be between 1 and 22")
+        self._compressor = zstandard.ZstdCompressor(level=self.level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data, max_size):
+        try:
+            return self._decompressor.decompress(data, max_output_size=max_size)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Compressed segment is corrupted: {e}")
+
+COMPRESSORS = {'zlib': ZlibCompressor, 'zstd': ZstdCompressor}
+
+def get_compressor(name, level=None):
+    if name == 'auto':
+        name = 'zstd' if zstandard is not None else 'zlib'
+    if name not in COMPRESSORS:
+        raise ValueError(f"Unknown compression: {name}")
+    if name == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+    return COMPRESSORS[name](level)
+
+def is_compressible(sample):
+    sample = bytes(sample[:SAMPLE_SIZE])
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * INCOMPRESSIBLE_RATIO
\ No newline at end of file
@@ -12,6 +12,7 @@ class ContextMenuIntegration:
         self.system = platform.system()
         self.app_dir = Path(__file__).parent.resolve()
         self.main_script = self.app_dir / "main.py"
+        self.cli_script = self.app_dir / "cli.py"
         if self.system == "Windows":
             pythonw_exe = Path(sys.executable).parent / "pythonw.exe"
             self.python_exe = str(pythonw_exe) if pythonw_exe.exists() else sys.executable
@@ -42,7 +43,7 @@ class ContextMenuIntegration:
                     reg.SetValueEx(key, "Icon", 0, reg.REG_SZ, str(self.icon_path))
                 
             with reg.CreateKey(reg.HKEY_CLASSES_ROOT, command_path) as key:
-                command = f'"{self.python_exe}" "{self.main_script}" --delete "%1"'
+                command = f'"{self.python_exe}" "{self.cli_script}" --delete "%1"'
                 reg.SetValue(key, "", reg.REG_SZ, command)
                 
             folder_key_path = r"Directory\shell\CryptoDisk"
@@ -54,7 +55,7 @@ class ContextMenuIntegration:
                     reg.SetValueEx(key, "Icon", 0, reg.REG_SZ, str(self.icon_path))
                 
             with reg.CreateKey(reg.HKEY_CLASSES_ROOT, folder_command_path) as key:
-                command = f'"{self.python_exe}" "{self.main_script}" --delete "%1"'
+                command = f'"{self.python_exe}" "{self.cli_script}" --delete "%1"'
                 reg.SetValue(key, "", reg.REG_SZ, command)
                 
             return True
@@ -92,7 +93,7 @@ Icon={self.app_dir}/icon.png
 Profiles=profile-zero;
 
 [X-Action-Profile profile-zero]
-Exec={self.python_exe} {self.main_script} --delete %f
+Exec={self.python_exe} {self.cli_script} --delete %F
 MimeTypes=application/octet-stream;text/plain;image/jpeg;image/png;video/mp4;audio/mpeg;application/pdf;text/html;
 """
 
@@ -109,10 +110,7 @@ MimeTypes=application/octet-stream;text/plain;image/jpeg;image/png;video/mp4;aud
             desktop_file_path.chmod(0o755)
             
             nautilus_script_content = f"""#!/bin/bash
-for file in "$@"; do
-    "{self.python_exe}" "{self.main_script}" --delete "$file" &
-done
-wait
+exec "{self.python_exe}" "{self.cli_script}" --delete "$@"
 """
             
             nautilus_script_path = nautilus_scripts_dir / "Delete with CryptoDisk"
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import hmac
+import json
+import os
+import platform
+import secrets
+import socket
+import stat
+from pathlib import Path
+
+TCP_FALLBACK_PORT = 47651
+TOKEN_FILE = "control.token"
+
+# Every request carries a random token the daemon writes to an owner-only
+# directory when it starts. The TCP fallback on Windows is open to every
+# local user, so the token, not the address, is what lets a client in.
+
+def get_runtime_dir():
+    if platform.system() == "Windows":
+        # The profile's ACL already limits LOCALAPPDATA to its owner.
+        return Path(os.environ.get('LOCALAPPDATA') or Path.home()) / "CryptoDisk"
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return Path(runtime_dir) / "cryptodisk"
+    import tempfile
+    return Path(tempfile.gettempdir()) / f"cryptodisk-{os.getuid()}"
+
+def _check_owner(path, directory=False):
+    # Someone else may have created the name first in a shared temp dir.
+    st = os.lstat(path)
+    kind_ok = stat.S_ISDIR(st.st_mode) if directory else not stat.S_ISLNK(st.st_mode)
+    if not kind_ok or (hasattr(os, 'getuid') and (st.st_uid != os.getuid() or st.st_mode & 0o077)):
+        raise PermissionError(f"{path} is not private to this user")
+
+def private_runtime_dir(create=False):
+    runtime_dir = get_runtime_dir()
+    if create:
+        runtime_dir.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.mkdir(runtime_dir, 0o700)
+        except FileExistsError:
+            pass
+    _check_owner(runtime_dir, directory=True)
+    return runtime_dir
+
+def get_control_address():
+    if hasattr(socket, 'AF_UNIX') and platform.system() != "Windows":
+        return socket.AF_UNIX, str(get_runtime_dir() / "control.sock")
+    return socket.AF_INET, ('127.0.0.1', TCP_FALLBACK_PORT)
+
+def write_token():
+    token = secrets.token_hex(32)
+    path = private_runtime_dir(create=True) / TOKEN_FILE
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+def read_token():
+    path = private_runtime_dir() / TOKEN_FILE
+    _check_owner(path)
+    return path.read_text().strip()
+
+def remove_token(token):
+    # Only our own: a second daemon that failed to start must not remove it.
+    try:
+        path = private_runtime_dir() / TOKEN_FILE
+        if read_token() == token:
+            path.unlink()
+    except OSError:
+        pass
+
+def check_token(request, token):
+    return hmac.compare_digest(str(request.get('token', '')), token)
+
+def send_request(request, timeout=5.0):
+    # None only when no daemon could be reached. Once the request is sent,
+    # a missing reply is reported with 'no_reply': the daemon may still act
+    # on it, so callers must not redo the work themselves.
+    family, address = get_control_address()
+    try:
+        token = read_token()
+        if family == socket.AF_UNIX:
+            _check_owner(address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+    except (OSError, ValueError):
+        return None
+    with sock:
+        try:
+            sock.settimeout(timeout)
+            sock.connect(address)
+        except OSError:
+            return None
+        try:
+            sock.sendall(json.dumps(dict(request, token=token)).encode() + b'\n')
+            with sock.makefile('rb') as reader:
+                line = reader.readline()
+            if line:
+                return json.loads(line)
+            error = "connection closed without a reply"
+        except (OSError, ValueError) as e:
+            error = str(e) or type(e).__name__
+    return {'ok': False, 'no_reply': True, 'error': f"no reply from the daemon: {error}"}
\ No newline at end of file
@@ -1,13 +1,66 @@
 #!/usr/bin/env python3
 
+import bisect
+import hmac as hmac_compare
+import io
 import os
 import secrets
 import string
+import threading
+import time
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, hmac, serialization
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from contextlib import contextmanager
 import json
 from pathlib import Path
+from ciphers import get_cipher, select_cipher
+from buffer_pool import DEFAULT_MAX_BUFFERS, get_buffer_pool
+from block_cache import get_block_cache
+from compression import get_compressor, is_compressible
+from dedup_store import format_recipe, open_vault_store, parse_recipe
+from key_slots import FILE_KEY_SIZE, derive_password_key, valid_iterations, password_slot, recipient_slot, unlock, pack_slots, unpack_slots, key_id
+from profiler import span
+from random_names import random_name
+from secure_memory import derive_into, secure_buffer, secure_random, wipe
+from metrics import BYTES_ENCRYPTED, ERRORS, FILES_PROCESSED, OPERATION_SECONDS
+
+# Container v2: MAGIC, header length, JSON header, HMAC of the header, then
+# length-prefixed AEAD segments. The first segment holds the metadata and is
+# bound to the header through its associated data; data segments carry their
+# index and a final flag (top bit of the length) in theirs, so reordering,
+# truncation and appended data are all detected. A trailer segment after the
+# final one records the plaintext size, which lets streams of unknown length
+# be encrypted in one pass. Files without MAGIC are the original CBC format.
+MAGIC = b'CDSK'
+FORMAT_VERSION = 3
+# v2 headers carry the PBKDF2 salt themselves; v3 files have a random file
+# key wrapped in key slots.
+PASSWORD_HEADER_VERSION = 2
+# Outputs in progress: hidden, and never matching *.crypted.
+PARTIAL_SUFFIX = ".partial"
+NONCE_PREFIX_SIZE = 8
+METADATA_INDEX = 0xFFFFFFFF
+TRAILER_INDEX = 0xFFFFFFFE
+FINAL_SEGMENT = 0x80000000
+HEADER_MAC_SIZE = 32
+MAX_HEADER_SIZE = 64 * 1024
+MAX_SLOT_AREA_SIZE = 1024 * 1024
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 4096
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# Room for the AEAD tag, so one pooled buffer holds a whole sealed segment.
+SEGMENT_OVERHEAD = 64
+
+def is_partial_output(path):
+    name = Path(path).name
+    return name.startswith('.') and name.endswith(PARTIAL_SUFFIX)
+
+class IntegrityError(ValueError):
+    def __init__(self, message, segment=None):
+        super().__init__(message)
+        self.segment = segment
 
 class CryptoEngine:
     def __init__(self):
@@ -15,106 +68,657 @@ class CryptoEngine:
         self.iv_size = 16
         self.salt_size = 32
         self.iterations = 100000
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        self.max_buffers = DEFAULT_MAX_BUFFERS
+        self.cipher_name = 'auto'
+        self.compression = None
+        self.compression_level = None
+        self.dedup_store = None
+        self.audit_log = None
+        # Public keys every new file is also encrypted to, and private keys
+        # (by key id) tried when opening files.
+        self.recipients = []
+        self.identities = {}
+        # Set to a key_slots.KeyCache for bulk operations such as a re-key.
+        self.key_cache = None
+        # Decrypted segments shared by every reader in the process; None
+        # decrypts from disk on every access.
+        self.block_cache = get_block_cache()
+        # Returns the SecureDelete that shreds the partial output of a failed
+        # decrypt; settings.configure_crypto_engine sets the configured one.
+        self.secure_delete_factory = None
         
     def generate_random_name(self, length=16):
-        chars = string.ascii_lowercase + string.digits
-        return ''.join(secrets.choice(chars) for _ in range(length))
-        
-    def generate_key_from_password(self, password, salt):
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=self.key_size,
-            salt=salt,
-            iterations=self.iterations,
-        )
-        return kdf.derive(password.encode())
+        return random_name(length, string.ascii_lowercase + string.digits)
+        
+    def generate_key_from_password(self, password, salt, iterations=None):
+        # A SecureBuffer: release it once the cipher using it is set up.
+        return derive_password_key(password, salt, iterations or self.iterations)
         
     def encrypt_file(self, input_file, output_file, password=None):
-        if password is None:
-            password = self.generate_random_password()
+        with span('encrypt_file'):
+            self._measure_encrypt(input_file, self._encrypt_file, input_file, output_file, password)
+            
+    def encrypt_stream(self, instream, outstream, password=None, name=None):
+        with span('encrypt_stream'):
+            return self._measure_encrypt(name or '-', self._encrypt_stream, instream, outstream, password,
+                                         self._new_metadata(name, None))
+            
+    def _measure_encrypt(self, audit_path, encrypt, *args):
+        started = time.time()
+        try:
+            original_size, cipher_name = encrypt(*args)
+        except Exception:
+            ERRORS.inc(operation='encrypt')
+            FILES_PROCESSED.inc(operation='encrypt', result='error')
+            raise
             
-        salt = os.urandom(self.salt_size)
-        iv = os.urandom(self.iv_size)
-        key = self.generate_key_from_password(password, salt)
+        duration = time.time() - started
+        FILES_PROCESSED.inc(operation='encrypt', result='ok')
+        BYTES_ENCRYPTED.inc(original_size)
+        OPERATION_SECONDS.observe(duration, operation='encrypt')
         
-        cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
-        encryptor = cipher.encryptor()
+        if self.audit_log is not None:
+            self.audit_log.record(
+                'encrypt',
+                path_hash=self.audit_log.hash_path(audit_path),
+                size=original_size,
+                cipher=cipher_name,
+                duration=round(duration, 6),
+                mb_per_s=round(original_size / duration / (1024 * 1024), 3) if duration > 0 else None
+            )
+        return original_size
+            
+    def set_chunk_size(self, chunk_size):
+        chunk_size = int(chunk_size)
+        if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE or chunk_size % MIN_CHUNK_SIZE:
+            raise ValueError(f"chunk_size must be a multiple of {MIN_CHUNK_SIZE} between "
+                             f"{MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE} bytes")
+        self.chunk_size = chunk_size
         
-        input_path = Path(input_file)
-        original_size = input_path.stat().st_size
+    def get_buffer_pool(self):
+        return get_buffer_pool(self.chunk_size + SEGMENT_OVERHEAD, self.max_buffers)
+        
+    def _read_full(self, infile, view):
+        filled = 0
+        while filled < len(view):
+            count = infile.readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+        return filled
+        
+    def get_cipher_name(self):
+        return select_cipher(self.cipher_name)
+        
+    def _segment_nonce(self, prefix, index):
+        return prefix + index.to_bytes(4, byteorder='big')
+        
+    def _segment_aad(self, index, final):
+        return index.to_bytes(4, byteorder='big') + (b'\x01' if final else b'\x00')
+        
+    def _derive_keys(self, password, header):
+        # One PBKDF2 run, then HKDF splits it into independent segment and
+        # header MAC keys: the first and second half of the returned buffer.
+        iterations = header.get('iterations', self.iterations)
+        if not valid_iterations(iterations):
+            raise IntegrityError(f"Implausible key derivation iteration count: {iterations!r}")
+        with self.generate_key_from_password(password, bytes.fromhex(header['salt']), iterations) as master:
+            return self._subkeys(master, b'cryptodisk container v2')
+            
+    def _file_subkeys(self, file_key):
+        return self._subkeys(file_key, b'cryptodisk container v3')
+        
+    def _subkeys(self, key, info):
+        subkeys = secure_buffer(64)
+        derive_into(HKDF(algorithm=hashes.SHA256(), length=64, salt=None, info=info), key.view, subkeys)
+        return subkeys
+        
+    def _header_mac(self, mac_key, header_bytes):
+        mac = hmac.HMAC(mac_key, hashes.SHA256())
+        mac.update(header_bytes)
+        return mac.finalize()
+        
+    def _write_segment(self, outfile, cipher, prefix, index, data, aad=None, final=False):
+        if aad is None:
+            aad = self._segment_aad(index, final)
+        sealed = cipher.encrypt(self._segment_nonce(prefix, index), data, aad)
+        outfile.write((len(sealed) | (FINAL_SEGMENT if final else 0)).to_bytes(4, byteorder='big'))
+        outfile.write(sealed)
+        
+    def _read_segment(self, infile, cipher, prefix, index, aad=None, buffer=None):
+        name = {METADATA_INDEX: 'metadata', TRAILER_INDEX: 'trailer'}.get(index, f"segment {index}")
+        segment = None if index in (METADATA_INDEX, TRAILER_INDEX) else index
+        length_bytes = infile.read(4)
+        if len(length_bytes) < 4:
+            raise IntegrityError(f"Encrypted file is truncated before {name}", segment)
+        length = int.from_bytes(length_bytes, byteorder='big')
+        final = bool(length & FINAL_SEGMENT)
+        length &= ~FINAL_SEGMENT
+        if length > MAX_CHUNK_SIZE + SEGMENT_OVERHEAD:
+            raise IntegrityError(f"Corrupted length in {name}", segment)
+        if buffer is not None and length <= len(buffer):
+            view = memoryview(buffer)[:length]
+            sealed = view[:self._read_full(infile, view)]
+        else:
+            sealed = infile.read(length)
+        if len(sealed) < length:
+            raise IntegrityError(f"Encrypted file is truncated in {name}", segment)
+        if aad is None:
+            aad = self._segment_aad(index, final)
+        try:
+            return cipher.decrypt(self._segment_nonce(prefix, index), sealed, aad), final
+        except InvalidTag:
+            raise IntegrityError(f"Authentication failed for {name}: the file is corrupted", segment)
+            
+    def _read_header(self, infile):
+        if infile.read(len(MAGIC)) != MAGIC:
+            if not infile.seekable():
+                raise ValueError("Not a CryptoDisk v2 stream (legacy AES-CBC files need a seekable input)")
+            infile.seek(0)
+            return None, None
+        header_size_bytes = infile.read(4)
+        header_size = int.from_bytes(header_size_bytes, byteorder='big')
+        if header_size > MAX_HEADER_SIZE:
+            raise IntegrityError("Corrupted container header")
+        header_json = infile.read(header_size)
+        try:
+            header = json.loads(header_json.decode())
+        except ValueError:
+            raise IntegrityError("Corrupted container header")
+        if header.get('version') not in (PASSWORD_HEADER_VERSION, FORMAT_VERSION):
+            raise ValueError(f"Unsupported container version: {header.get('version')}")
+        return header, MAGIC + header_size_bytes + header_json
+        
+    def _read_slots(self, infile):
+        size_bytes = infile.read(4)
+        size = int.from_bytes(size_bytes, byteorder='big')
+        if len(size_bytes) < 4 or size > MAX_SLOT_AREA_SIZE:
+            raise IntegrityError("Corrupted key slot area")
+        area = infile.read(size)
+        if len(area) < size:
+            raise IntegrityError("Encrypted file is truncated in the key slots")
+        try:
+            return size_bytes + area, unpack_slots(area)
+        except ValueError:
+            raise IntegrityError("Corrupted key slot area")
+            
+    def _unlock_container(self, infile, header, header_bytes, password):
+        # Returns the subkeys (segment key, then MAC key), the file key (None
+        # for v2) and the slots; the caller releases both key buffers. The
+        # MAC covers the header and the key slots and is checked before any
+        # decryption: a wrong password costs the KDF and a few KB of I/O.
+        if header['version'] == PASSWORD_HEADER_VERSION:
+            file_key, slots = None, None
+            subkeys = self._derive_keys(password, header)
+            authenticated = header_bytes
+        else:
+            slot_bytes, slots = self._read_slots(infile)
+            try:
+                file_key = unlock(slots, header_bytes, password, self.identities, self.key_cache)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                # Slots are read before anything authenticates them.
+                raise IntegrityError("Corrupted key slot area")
+            if file_key is None:
+                raise IntegrityError("Wrong password, no matching identity, or corrupted key slots")
+            subkeys = self._file_subkeys(file_key)
+            authenticated = header_bytes + slot_bytes
+        if not hmac_compare.compare_digest(infile.read(HEADER_MAC_SIZE),
+                                           self._header_mac(subkeys.view[32:], authenticated)):
+            subkeys.release()
+            if file_key is not None:
+                file_key.release()
+            raise IntegrityError("Wrong password or corrupted header")
+        return subkeys, file_key, slots
+        
+    def _open_container(self, infile, password):
+        header, header_bytes = self._read_header(infile)
+        if header is None:
+            return None, None, None, None
+        cipher_class = get_cipher(header['cipher'])
+        subkeys, file_key, _ = self._unlock_container(infile, header, header_bytes, password)
+        try:
+            # Ciphers copy their key, so the buffers can be wiped right away.
+            cipher = cipher_class(subkeys.view[:32])
+        finally:
+            subkeys.release()
+            if file_key is not None:
+                file_key.release()
+        prefix = bytes.fromhex(header['nonce'])
+        metadata_json, _ = self._read_segment(infile, cipher, prefix, METADATA_INDEX, header_bytes)
+        return header, cipher, prefix, self._load_metadata(metadata_json)
         
-        metadata = {
-            'original_name': input_path.name,
-            'original_size': original_size,
-            'password': password,
-            'timestamp': str(input_path.stat().st_mtime)
+    def _load_metadata(self, metadata_json):
+        metadata = json.loads(metadata_json.decode())
+        # Files written before passwords lived in locked memory carry theirs
+        # in the metadata; it is never handed on.
+        metadata.pop('password', None)
+        return metadata
+        
+    @contextmanager
+    def _atomic_output(self, output_file, shred=False):
+        # Written under a temporary name (which the folder watchers, --empty
+        # and the shred queue skip) and renamed only once everything was
+        # written and checked. With shred, a failed output is plaintext and is
+        # securely deleted rather than unlinked.
+        output_path = Path(output_file)
+        temp_path = output_path.with_name(f".{output_path.name}.{secrets.token_hex(4)}{PARTIAL_SUFFIX}")
+        try:
+            with open(temp_path, 'wb') as outfile:
+                yield outfile
+            os.replace(temp_path, output_path)
+        except BaseException:
+            self.discard_output(temp_path, shred)
+            raise
+            
+    def discard_output(self, temp_path, shred):
+        temp_path = Path(temp_path)
+        if shred and os.path.lexists(temp_path):
+            if self.secure_delete_factory is not None:
+                secure_delete = self.secure_delete_factory()
+            else:
+                from secure_delete import SecureDelete
+                secure_delete = SecureDelete()
+            if secure_delete.secure_delete_file(str(temp_path)):
+                return
+        try:
+            temp_path.unlink()
+        except OSError:
+            pass
+            
+    def _new_metadata(self, name, size, timestamp=None):
+        return {
+            'original_name': name,
+            'original_size': size,
+            'timestamp': str(timestamp if timestamp is not None else time.time())
         }
         
-        with open(input_file, 'rb') as infile, open(output_file, 'wb') as outfile:
-            outfile.write(salt)
-            outfile.write(iv)
+    def _encrypt_file(self, input_file, output_file, password=None):
+        input_path = Path(input_file)
+        stat = input_path.stat()
+        metadata = self._new_metadata(input_path.name, stat.st_size, stat.st_mtime)
+        if self.dedup_store is not None:
+            return self._encrypt_deduplicated(input_file, output_file, password, metadata)
+        
+        with open(input_file, 'rb') as infile, self._atomic_output(output_file) as outfile:
+            return self._encrypt_stream(infile, outfile, password, metadata)
+            
+    def _encrypt_deduplicated(self, input_file, output_file, password, metadata):
+        # The payload of a deduplicated file is its recipe, one "fingerprint
+        # size key" line per chunk; the chunks live in the store shared by the
+        # vault, so only chunks not seen before cost encryption and I/O.
+        store = self.dedup_store
+        file_id = secrets.token_hex(16)
+        try:
+            with open(input_file, 'rb') as infile, span('dedup', size=metadata['original_size']):
+                recipe, new_bytes = store.add_file(file_id, infile)
+            with self._atomic_output(output_file) as outfile:
+                _, cipher_name = self._encrypt_stream(io.BytesIO(format_recipe(recipe)), outfile, password,
+                                                      metadata, {'dedup': file_id})
+            store.commit_file(file_id, output_file)
+        except BaseException:
+            # Chunks this file stored before failing hold its plaintext.
+            for chunk_path in store.release(file_id):
+                self.discard_output(chunk_path, shred=True)
+                try:
+                    chunk_path.parent.rmdir()
+                except OSError:
+                    pass
+            raise
+        return sum(entry[1] for entry in recipe), cipher_name
+        
+    def _encrypt_stream(self, infile, outfile, password, metadata, header_fields=None):
+        # Without a password or recipients the file gets a random one that is
+        # wiped afterwards: the file is then sealed for good.
+        if password is None and not self.recipients:
+            with secure_random(32) as random_password:
+                return self._encrypt_stream(infile, outfile, random_password, metadata, header_fields)
+                
+        cipher_name = self.get_cipher_name()
+        cipher_class = get_cipher(cipher_name)
+        prefix = os.urandom(NONCE_PREFIX_SIZE)
+        header = {
+            'version': FORMAT_VERSION,
+            'cipher': cipher_name,
+            'nonce': prefix.hex(),
+            'chunk_size': self.chunk_size
+        }
+        header.update(header_fields or {})
+        # Segments are encrypted under a random file key; passwords and
+        # recipients only wrap that key, so they can change without
+        # touching the payload.
+        with secure_random(FILE_KEY_SIZE) as file_key, self._file_subkeys(file_key) as subkeys:
+            cipher = cipher_class(subkeys.view[:32])
+            return self._encrypt_segments(infile, outfile, password, metadata, header, cipher, prefix,
+                                          file_key, subkeys.view[32:])
             
-            metadata_json = json.dumps(metadata).encode()
-            metadata_size = len(metadata_json)
-            outfile.write(metadata_size.to_bytes(4, byteorder='big'))
+    def _encrypt_segments(self, infile, outfile, password, metadata, header, cipher, prefix, file_key, mac_key):
+        cipher_name = header['cipher']
+        original_size = 0
+        with self.get_buffer_pool().buffer() as buffer, \
+                span('encrypt_chunks', size=metadata['original_size'], cipher=cipher_name, chunk_size=self.chunk_size):
+            # buffer[0] is kept free for the per-segment compression flag, so
+            # a segment stored uncompressed is still encrypted in place.
+            view = memoryview(buffer)[1:self.chunk_size + 1]
+            count = self._read_full(infile, view)
             
-            encrypted_metadata = encryptor.update(self.pad_data(metadata_json))
-            outfile.write(encrypted_metadata)
+            compressor = None
+            if self.compression and is_compressible(view[:count]):
+                compressor = get_compressor(self.compression, self.compression_level)
+                header['compression'] = compressor.name
+                header['compression_level'] = compressor.level
+                
+            header_json = json.dumps(header).encode()
+            header_bytes = MAGIC + len(header_json).to_bytes(4, byteorder='big') + header_json
+            slot_bytes = self._pack_slot_area(self._new_slots(file_key, header_bytes, password))
+            outfile.write(header_bytes)
+            outfile.write(slot_bytes)
+            outfile.write(self._header_mac(mac_key, header_bytes + slot_bytes))
+            self._write_segment(outfile, cipher, prefix, METADATA_INDEX, json.dumps(metadata).encode(), header_bytes)
             
+            index = 0
             while True:
-                chunk = infile.read(8192)
-                if not chunk:
+                # A short read ends the stream; an exact multiple of
+                # chunk_size ends with an empty final segment.
+                final = count < self.chunk_size
+                self._write_segment(outfile, cipher, prefix, index, self._pack_segment(buffer, count, compressor),
+                                    final=final)
+                original_size += count
+                if final:
                     break
-                    
-                if len(chunk) < 8192:
-                    chunk = self.pad_data(chunk)
-                    
-                encrypted_chunk = encryptor.update(chunk)
-                outfile.write(encrypted_chunk)
-                
-            final_chunk = encryptor.finalize()
-            if final_chunk:
-                outfile.write(final_chunk)
+                index += 1
+                count = self._read_full(infile, view)
                 
+        trailer = json.dumps({'original_size': original_size, 'segments': index + 1}).encode()
+        self._write_segment(outfile, cipher, prefix, TRAILER_INDEX, trailer)
+        return original_size, cipher_name
+        
+    def _new_slots(self, file_key, header_bytes, password):
+        slots = []
+        if password is not None:
+            slots.append(password_slot(file_key, password, header_bytes, self.iterations))
+        for public_key in self.recipients:
+            slots.append(recipient_slot(file_key, public_key, header_bytes))
+        return slots
+        
+    def _pack_slot_area(self, slots, area_size=None):
+        area = pack_slots(slots, area_size)
+        return len(area).to_bytes(4, byteorder='big') + area
+        
+    def list_key_slots(self, encrypted_file):
+        # Read without a key, so not authenticated: for display only.
+        with open(encrypted_file, 'rb') as infile:
+            header, _ = self._read_header(infile)
+            if header is None or header['version'] != FORMAT_VERSION:
+                return None
+            return self._read_slots(infile)[1]
+            
+    def prepare_key_slots(self, encrypted_file, password, update):
+        # update(slots, file_key, aad) returns the new slot list. Nothing is
+        # written yet: the result holds the new slot area and MAC, which
+        # replace the bytes between 'offset' and 'end' in place, or, when the
+        # slots outgrew the area, go into a copy of the file.
+        with open(encrypted_file, 'rb') as f:
+            header, header_bytes = self._read_header(f)
+            if header is None or header['version'] != FORMAT_VERSION:
+                raise ValueError("Only v3 containers have key slots; decrypt and re-encrypt this file first")
+            slot_offset = f.tell()
+            subkeys, file_key, slots = self._unlock_container(f, header, header_bytes, password)
+            payload_offset = f.tell()
+            
+        try:
+            new_slots = update(list(slots), file_key, header_bytes)
+            if not new_slots:
+                raise ValueError("A file needs at least one key slot")
+            try:
+                slot_bytes = self._pack_slot_area(new_slots, payload_offset - slot_offset - 4 - HEADER_MAC_SIZE)
+            except ValueError:
+                slot_bytes = self._pack_slot_area(new_slots)
+            mac = self._header_mac(subkeys.view[32:], header_bytes + slot_bytes)
+        finally:
+            subkeys.release()
+            file_key.release()
+        return {
+            'path': str(encrypted_file),
+            'header': header_bytes,
+            'offset': slot_offset,
+            'end': payload_offset,
+            'data': slot_bytes + mac,
+            'slots': new_slots
+        }
+        
+    def apply_key_slots(self, rewrite):
+        # The payload is untouched: metadata and segments are authenticated
+        # against the header alone.
+        if rewrite['offset'] + len(rewrite['data']) == rewrite['end']:
+            with open(rewrite['path'], 'r+b') as f, span('rewrite_key_slots', size=len(rewrite['data'])):
+                f.seek(rewrite['offset'])
+                f.write(rewrite['data'])
+                f.flush()
+                os.fsync(f.fileno())
+            return
+            
+        with span('grow_key_slots', size=len(rewrite['data'])), self._atomic_output(rewrite['path']) as outfile:
+            outfile.write(rewrite['header'])
+            outfile.write(rewrite['data'])
+            with open(rewrite['path'], 'rb') as infile:
+                infile.seek(rewrite['end'])
+                while True:
+                    data = infile.read(self.chunk_size)
+                    if not data:
+                        break
+                    outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            
+    def rewrite_key_slots(self, encrypted_file, password, update, journal=None):
+        # An in-place rewrite spans several blocks and can be torn by a crash;
+        # with a journal (see rekey.py) it is logged first and replayed on
+        # the next run. Copies are replaced atomically and need none.
+        rewrite = self.prepare_key_slots(encrypted_file, password, update)
+        if journal is not None:
+            journal.write([rewrite])
+        self.apply_key_slots(rewrite)
+        if journal is not None:
+            journal.clear()
+        return rewrite['slots']
+        
+    def add_recipient(self, encrypted_file, public_key, password=None, journal=None):
+        recipient = key_id(public_key)
+        
+        def update(slots, file_key, aad):
+            slots = [slot for slot in slots if slot.get('id') != recipient]
+            slots.append(recipient_slot(file_key, public_key, aad))
+            return slots
+        return self.rewrite_key_slots(encrypted_file, password, update, journal)
+        
+    def remove_recipient(self, encrypted_file, recipient, password=None, journal=None):
+        # Removing a slot does not revoke a key the recipient already
+        # unwrapped; re-encrypt the file for that.
+        def update(slots, file_key, aad):
+            remaining = [slot for slot in slots if slot.get('id') != recipient]
+            if len(remaining) == len(slots):
+                raise ValueError(f"No key slot for recipient {recipient}")
+            return remaining
+        return self.rewrite_key_slots(encrypted_file, password, update, journal)
+        
+    def _pack_segment(self, buffer, count, compressor):
+        if compressor is None:
+            return memoryview(buffer)[1:count + 1]
+        compressed = compressor.compress(memoryview(buffer)[1:count + 1])
+        if len(compressed) < count:
+            return b'\x01' + compressed
+        buffer[0] = 0
+        return memoryview(buffer)[:count + 1]
+        
+    def _unpack_segment(self, chunk, compressor, chunk_size, index):
+        if not chunk or chunk[0] not in (0, 1):
+            raise IntegrityError(f"Invalid compression flag in segment {index}", index)
+        if chunk[0] == 0:
+            return memoryview(chunk)[1:]
+        try:
+            return compressor.decompress(memoryview(chunk)[1:], chunk_size)
+        except ValueError as e:
+            raise IntegrityError(f"Segment {index} does not decompress: {e}", index)
+            
     def decrypt_file(self, input_file, output_file, password):
+        try:
+            with OPERATION_SECONDS.time(operation='decrypt'), span('decrypt_file'):
+                metadata = self._decrypt_file(input_file, output_file, password)
+        except Exception:
+            ERRORS.inc(operation='decrypt')
+            FILES_PROCESSED.inc(operation='decrypt', result='error')
+            raise
+        FILES_PROCESSED.inc(operation='decrypt', result='ok')
+        return metadata
+        
+    def decrypt_stream(self, instream, outstream, password):
+        # Each segment is authenticated before it is written, but truncation
+        # is only known at the end of the stream: when this raises, whatever
+        # was already written to outstream must be discarded.
+        try:
+            with OPERATION_SECONDS.time(operation='decrypt'), span('decrypt_stream'):
+                header, cipher, prefix, metadata = self._open_container(instream, password)
+                if header is None:
+                    # Legacy AES-CBC: _read_header has rewound the (seekable) input.
+                    metadata = self._decrypt_legacy_stream(instream, outstream, password)
+                else:
+                    metadata['original_size'] = self._decrypt_payload(instream, header, cipher, prefix, outstream)
+        except Exception:
+            ERRORS.inc(operation='decrypt')
+            FILES_PROCESSED.inc(operation='decrypt', result='error')
+            raise
+        FILES_PROCESSED.inc(operation='decrypt', result='ok')
+        return metadata
+        
+    def _decrypt_segments(self, infile, header, cipher, prefix, outfile=None):
+        bytes_read = 0
+        compressor = None
+        if header.get('compression'):
+            compressor = get_compressor(header['compression'], header.get('compression_level'))
+        with self.get_buffer_pool().buffer() as buffer, \
+                span('decrypt_chunks', cipher=header['cipher'], chunk_size=header['chunk_size']):
+            index = 0
+            final = False
+            while not final:
+                chunk, final = self._read_segment(infile, cipher, prefix, index, buffer=buffer)
+                if compressor is not None:
+                    chunk = self._unpack_segment(chunk, compressor, header['chunk_size'], index)
+                if outfile is not None:
+                    outfile.write(chunk)
+                bytes_read += len(chunk)
+                index += 1
+                
+        trailer_json, _ = self._read_segment(infile, cipher, prefix, TRAILER_INDEX)
+        if json.loads(trailer_json.decode()).get('original_size') != bytes_read:
+            raise IntegrityError(f"Trailer size does not match the {bytes_read} decrypted bytes", index - 1)
+        if infile.read(1):
+            raise IntegrityError(f"Unexpected data after the trailer of {index} segments", index)
+        return bytes_read
+        
+    def _decrypt_payload(self, infile, header, cipher, prefix, outfile=None, vault_folder=None):
+        if not header.get('dedup'):
+            return self._decrypt_segments(infile, header, cipher, prefix, outfile)
+            
+        recipe = io.BytesIO()
+        self._decrypt_segments(infile, header, cipher, prefix, recipe)
+        store = self.dedup_store
+        if store is None and vault_folder is not None:
+            store = open_vault_store(vault_folder)
+        if store is None:
+            raise ValueError("This file was deduplicated and needs the vault's chunk store and dedup.key")
+        try:
+            return self._restore_chunks(store, recipe.getvalue(), outfile)
+        finally:
+            if store is not self.dedup_store:
+                store.close()
+                
+    def _restore_chunks(self, store, recipe, outfile):
+        bytes_read = 0
+        with span('restore_chunks'):
+            for index, (fp, size, key) in enumerate(parse_recipe(recipe)):
+                try:
+                    chunk = store.read_chunk(fp, key)
+                except (OSError, ValueError, InvalidTag) as e:
+                    raise IntegrityError(f"Chunk {index} of the recipe is missing or corrupted "
+                                         f"({e or type(e).__name__})", index)
+                if len(chunk) != size:
+                    raise IntegrityError(f"Chunk {index} of the recipe has the wrong size", index)
+                if outfile is not None:
+                    outfile.write(chunk)
+                bytes_read += len(chunk)
+        return bytes_read
+        
+    def _decrypt_file(self, input_file, output_file, password):
         with open(input_file, 'rb') as infile:
-            salt = infile.read(self.salt_size)
-            iv = infile.read(self.iv_size)
-            metadata_size = int.from_bytes(infile.read(4), byteorder='big')
-            
-            key = self.generate_key_from_password(password, salt)
-            cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
-            decryptor = cipher.decryptor()
-            
-            encrypted_metadata = infile.read(self.pad_size(metadata_size))
-            decrypted_metadata = decryptor.update(encrypted_metadata)
-            metadata_json = self.unpad_data(decrypted_metadata)[:metadata_size]
-            metadata = json.loads(metadata_json.decode())
-            
-            with open(output_file, 'wb') as outfile:
-                bytes_written = 0
-                target_size = metadata['original_size']
+            header, cipher, prefix, metadata = self._open_container(infile, password)
+            if header is None:
+                return self._decrypt_legacy_file(infile, output_file, password)
+            if self.block_cache is None:
+                with self._atomic_output(output_file, shred=True) as outfile:
+                    self._decrypt_payload(infile, header, cipher, prefix, outfile, Path(input_file).parent)
+                return metadata
+            # Through the reader, so segments of a hot file come from the
+            # block cache; its trailer is checked before anything is written.
+            reader = ContainerReader(self, input_file, infile, header, cipher, prefix, metadata, sequential=True)
+            try:
+                with self._atomic_output(output_file, shred=True) as outfile:
+                    reader.copy_to(outfile)
+            finally:
+                reader.close()
+        return metadata
+        
+    def verify_file(self, encrypted_file, password):
+        with open(encrypted_file, 'rb') as infile:
+            header, cipher, prefix, metadata = self._open_container(infile, password)
+            if header is None:
+                raise ValueError("Legacy AES-CBC files carry no authentication tags")
+            self._decrypt_payload(infile, header, cipher, prefix, None, Path(encrypted_file).parent)
+        return metadata
+        
+    def _open_legacy(self, infile, password):
+        salt = infile.read(self.salt_size)
+        iv = infile.read(self.iv_size)
+        metadata_size = int.from_bytes(infile.read(4), byteorder='big')
+        
+        # The cipher only reads the key when the decryptor is created.
+        with self.generate_key_from_password(password, salt) as key:
+            decryptor = Cipher(algorithms.AES(key.view), modes.CBC(iv)).decryptor()
+            
+        encrypted_metadata = infile.read(self.pad_size(metadata_size))
+        decrypted_metadata = decryptor.update(encrypted_metadata)
+        metadata_json = self.unpad_data(decrypted_metadata)[:metadata_size]
+        return decryptor, self._load_metadata(metadata_json)
+        
+    def _decrypt_legacy_file(self, infile, output_file, password):
+        with self._atomic_output(output_file, shred=True) as outfile:
+            return self._decrypt_legacy_stream(infile, outfile, password)
+            
+    def _decrypt_legacy_stream(self, infile, outfile, password):
+        decryptor, metadata = self._open_legacy(infile, password)
+        bytes_written = 0
+        target_size = metadata['original_size']
+        
+        while bytes_written < target_size:
+            chunk = infile.read(self.chunk_size)
+            if not chunk:
+                break
+                
+            decrypted_chunk = decryptor.update(chunk)
+            
+            remaining = target_size - bytes_written
+            if remaining < len(decrypted_chunk):
+                decrypted_chunk = decrypted_chunk[:remaining]
+                
+            outfile.write(decrypted_chunk)
+            bytes_written += len(decrypted_chunk)
+            
+        final_chunk = decryptor.finalize()
+        if final_chunk and bytes_written < target_size:
+            remaining = target_size - bytes_written
+            if remaining > 0:
+                outfile.write(final_chunk[:remaining])
                 
-                while bytes_written < target_size:
-                    chunk = infile.read(8192)
-                    if not chunk:
-                        break
-                        
-                    decrypted_chunk = decryptor.update(chunk)
-                    
-                    remaining = target_size - bytes_written
-                    if remaining < len(decrypted_chunk):
-                        decrypted_chunk = decrypted_chunk[:remaining]
-                        
-                    outfile.write(decrypted_chunk)
-                    bytes_written += len(decrypted_chunk)
-                    
-                final_chunk = decryptor.finalize()
-                if final_chunk and bytes_written < target_size:
-                    remaining = target_size - bytes_written
-                    if remaining > 0:
-                        outfile.write(final_chunk[:remaining])
-                        
         return metadata
         
     def pad_data(self, data):
@@ -130,26 +734,210 @@ class CryptoEngine:
         return ((size + 15) // 16) * 16
         
     def generate_random_password(self, length=32):
-        chars = string.ascii_letters + string.digits + "!@#$%^&*"
-        return ''.join(secrets.choice(chars) for _ in range(length))
+        return random_name(length, string.ascii_letters + string.digits + "!@#$%^&*")
         
     def secure_random_bytes(self, size):
         return os.urandom(size)
         
+    def open_reader(self, encrypted_file, password):
+        infile = open(encrypted_file, 'rb')
+        try:
+            header, cipher, prefix, metadata = self._open_container(infile, password)
+            if header is None:
+                raise ValueError("Legacy AES-CBC files can only be decrypted as a whole")
+            return ContainerReader(self, encrypted_file, infile, header, cipher, prefix, metadata)
+        except BaseException:
+            infile.close()
+            raise
+        
     def get_file_metadata(self, encrypted_file, password):
         try:
             with open(encrypted_file, 'rb') as infile:
-                salt = infile.read(self.salt_size)
-                iv = infile.read(self.iv_size)
-                metadata_size = int.from_bytes(infile.read(4), byteorder='big')
-                
-                key = self.generate_key_from_password(password, salt)
-                cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
-                decryptor = cipher.decryptor()
-                
-                encrypted_metadata = infile.read(self.pad_size(metadata_size))
-                decrypted_metadata = decryptor.update(encrypted_metadata)
-                metadata_json = self.unpad_data(decrypted_metadata)[:metadata_size]
-                return json.loads(metadata_json.decode())
+                header, _, _, metadata = self._open_container(infile, password)
+                if header is not None:
+                    return metadata
+                return self._open_legacy(infile, password)[1]
         except:
-            return None
\ No newline at end of file
+            return None
+
+class ContainerReader:
+    # Random access to the plaintext of a v2/v3 container without writing
+    # it anywhere: the segments are located once from their length
+    # prefixes, then decrypted and authenticated one at a time on demand.
+    # Every data segment but the last holds exactly chunk_size bytes, so an
+    # offset maps straight to a segment. Deduplicated files map offsets to
+    # the chunks of their recipe instead.
+    def __init__(self, crypto, encrypted_file, infile, header, cipher, prefix, metadata, sequential=False):
+        self.crypto = crypto
+        self.path = str(encrypted_file)
+        self.header = header
+        self.metadata = metadata
+        self.chunk_size = header['chunk_size']
+        self._file = infile
+        self._cipher = cipher
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._last = None
+        self._store = None
+        self._own_store = False
+        # The nonce prefix is random per encryption and the inode tells
+        # copies apart, so a rewritten file never hits stale blocks.
+        stat = os.fstat(infile.fileno())
+        self.file_id = (stat.st_dev, stat.st_ino, header['nonce'])
+        try:
+            self._compressor = None
+            if header.get('compression'):
+                self._compressor = get_compressor(header['compression'], header.get('compression_level'))
+            self._offsets, self.size = self._index_segments()
+            self._chunks = None
+            if header.get('dedup'):
+                self._load_recipe()
+        except BaseException:
+            self.close()
+            raise
+        self._cache = crypto.block_cache
+        # A whole-file decrypt reads each block once: it uses blocks already
+        # cached but never adds its own, so a one-shot --decrypt leaves no
+        # plaintext behind in the process.
+        self._fill_cache = not sequential
+            
+    def _index_segments(self):
+        offsets = []
+        final = False
+        with span('index_segments'):
+            while not final:
+                offset = self._file.tell()
+                length_bytes = self._file.read(4)
+                if len(length_bytes) < 4:
+                    raise IntegrityError(f"Encrypted file is truncated before segment {len(offsets)}", len(offsets))
+                length = int.from_bytes(length_bytes, byteorder='big')
+                final = bool(length & FINAL_SEGMENT)
+                offsets.append(offset)
+                self._file.seek(length & ~FINAL_SEGMENT, os.SEEK_CUR)
+            trailer_json, _ = self.crypto._read_segment(self._file, self._cipher, self._prefix, TRAILER_INDEX)
+        trailer = json.loads(trailer_json.decode())
+        size = trailer.get('original_size')
+        if trailer.get('segments') != len(offsets) or not isinstance(size, int) or \
+                not (len(offsets) - 1) * self.chunk_size <= size <= len(offsets) * self.chunk_size:
+            raise IntegrityError("Trailer does not match the segments of the file", len(offsets) - 1)
+        if self._file.read(1):
+            raise IntegrityError(f"Unexpected data after the trailer of {len(offsets)} segments", len(offsets))
+        return offsets, size
+        
+    def _load_recipe(self):
+        recipe = b''.join(self._segment(index) for index in range(len(self._offsets)))
+        self._store = self.crypto.dedup_store
+        if self._store is None:
+            self._store = open_vault_store(Path(self.path).parent)
+            self._own_store = self._store is not None
+        if self._store is None:
+            raise ValueError("This file was deduplicated and needs the vault's chunk store and dedup.key")
+        self._chunks = []
+        self._starts = []
+        self.size = 0
+        for fp, size, key in parse_recipe(recipe):
+            self._chunks.append((fp, size, key))
+            self._starts.append(self.size)
+            self.size += size
+            
+    def _segment(self, index):
+        self._file.seek(self._offsets[index])
+        chunk, final = self.crypto._read_segment(self._file, self._cipher, self._prefix, index)
+        if final != (index == len(self._offsets) - 1):
+            raise IntegrityError(f"Segment {index} has the wrong final flag", index)
+        if self._compressor is not None:
+            chunk = self.crypto._unpack_segment(chunk, self._compressor, self.chunk_size, index)
+        return bytes(chunk)
+        
+    def _chunk(self, index):
+        fp, size, key = self._chunks[index]
+        try:
+            chunk = self._store.read_chunk(fp, key)
+        except (OSError, ValueError, InvalidTag) as e:
+            raise IntegrityError(f"Chunk {index} of the recipe is missing or corrupted "
+                                 f"({e or type(e).__name__})", index)
+        if len(chunk) != size:
+            raise IntegrityError(f"Chunk {index} of the recipe has the wrong size", index)
+        return chunk
+        
+    def _key(self, index):
+        if self._chunks is not None:
+            # Chunks are content addressed, so files sharing one share its block.
+            return ('chunk', self._chunks[index][0])
+        return (self.file_id, index)
+        
+    def _decrypt_block(self, index):
+        block = self._chunk(index) if self._chunks is not None else self._segment(index)
+        if self._chunks is None:
+            expected = min(self.chunk_size, self.size - index * self.chunk_size)
+            if len(block) != expected:
+                raise IntegrityError(f"Segment {index} holds {len(block)} bytes instead of {expected}", index)
+        return block
+        
+    def _slice(self, index, start, end=None):
+        if self._cache is not None:
+            part = self._cache.get(self._key(index), start, end)
+            if part is not None:
+                return part
+        elif self._last is not None and self._last[0] == index:
+            return self._last[1][start:end]
+        block = self._decrypt_block(index)
+        if self._cache is not None:
+            if self._fill_cache:
+                self._cache.put(self._key(index), block)
+        else:
+            # Without the cache, the last block still serves small sequential reads.
+            self._last = (index, block)
+        return block[start:end]
+        
+    def _block_count(self):
+        return len(self._chunks) if self._chunks is not None else len(self._offsets)
+        
+    def _block_at(self, offset):
+        if self._chunks is None:
+            index = offset // self.chunk_size
+            return index, index * self.chunk_size
+        index = bisect.bisect_right(self._starts, offset) - 1
+        return index, self._starts[index]
+        
+    def read(self, offset, size):
+        size = max(0, min(size, self.size - offset))
+        parts = []
+        with self._lock:
+            while size > 0:
+                index, start = self._block_at(offset)
+                part = self._slice(index, offset - start, offset - start + size)
+                parts.append(part)
+                offset += len(part)
+                size -= len(part)
+        return b''.join(parts)
+        
+    def copy_to(self, outfile):
+        # Cached blocks go through one scratch buffer, wiped at the end,
+        # instead of a bytes copy each.
+        cache = self._cache
+        scratch = None
+        if cache is not None:
+            sizes = [size for _, size, _ in self._chunks] if self._chunks is not None else [self.chunk_size]
+            scratch = bytearray(max(sizes, default=0))
+        try:
+            with self._lock, span('decrypt_blocks', size=self.size, cached=cache is not None):
+                for index in range(self._block_count()):
+                    size = cache.copy_into(self._key(index), scratch) if cache is not None else None
+                    if size is None:
+                        outfile.write(self._decrypt_block(index))
+                    else:
+                        with memoryview(scratch) as view:
+                            outfile.write(view[:size])
+        finally:
+            if scratch is not None:
+                wipe(scratch)
+        return self.size
+        
+    def close(self):
+        with self._lock:
+            self._last = None
+            if self._own_store:
+                self._store.close()
+                self._own_store = False
+            self._file.close()
\ No newline at end of file
@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from crypto_engine import CryptoEngine, is_partial_output
+from secure_delete import SecureDelete
+from settings import load_settings, configure_secure_delete, configure_crypto_engine, get_cryptodisk_folder, io_throttle_for
+from audit_log import open_audit_log
+from metrics import MetricsServer, QUEUE_DEPTH
+from profiler import span
+from control import check_token, get_control_address, private_runtime_dir, remove_token, send_request, write_token
+from dedup_store import collect_vault_garbage
+from io_throttle import IO_PRIORITIES
+from shred_queue import ShredQueue, parse_windows, window_open, queue_status, DEFAULT_BATCH_SIZE
+
+MAX_FINISHED_JOBS = 1000
+SCHEDULE_INTERVAL = 60
+# Files of one directory deleted by a worker under a single directory fsync,
+# and the bytes after which a group is closed so large files run in parallel.
+DIRECTORY_BATCH = 64
+GROUP_BYTES = 16 * 1024 * 1024
+# Groups waiting in the worker pool per worker. A job's walk pauses once they
+# are all taken, so memory does not grow with the size of the tree.
+QUEUED_GROUPS_PER_WORKER = 4
+
+class CryptoDiskDaemon:
+    def __init__(self, workers=None, metrics_port=None):
+        self.settings = load_settings()
+        self.cryptodisk_folder = get_cryptodisk_folder()
+        self.crypto = CryptoEngine()
+        configure_crypto_engine(self.crypto, self.settings)
+        self.audit_log = open_audit_log(self.settings)
+        self.crypto.audit_log = self.audit_log
+        self.workers = workers or self.settings.get('workers', 4)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='cryptodisk-worker')
+        self._queue_slots = threading.Semaphore(self.workers * QUEUED_GROUPS_PER_WORKER)
+        self.metrics_port = metrics_port or self.settings.get('metrics_port')
+        self.metrics_server = None
+        self.observer = None
+
+        self.started = time.time()
+        self.jobs = {}
+        self.next_job_id = 1
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.settings_generation = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server_socket = None
+        self._token = None
+
+        self.shred_queue = ShredQueue()
+        recovered = self.shred_queue.recover()
+        if recovered:
+            print(f"Re-queued {recovered} scheduled deletions interrupted by the last shutdown")
+        self.shred_windows = self._load_windows()
+        self._scheduled_job = None
+        self._schedule_wakeup = threading.Event()
+        self._scheduler = None
+
+    def get_secure_delete(self):
+        # SecureDelete keeps per-file report state, so each worker gets its own.
+        local = self._local
+        if getattr(local, 'generation', None) != self.settings_generation:
+            local.secure_delete = SecureDelete()
+            configure_secure_delete(local.secure_delete, self.settings)
+            local.secure_delete.audit_log = self.audit_log
+            local.generation = self.settings_generation
+        return local.secure_delete
+
+    def _job_secure_delete(self, job):
+        # Workers are shared by all jobs, so each item sets its own job's limits.
+        secure_delete = self.get_secure_delete()
+        limits = job.get('limits', {})
+        secure_delete.throttle = job.get('throttle') or io_throttle_for(self.settings)
+        secure_delete.io_priority = limits.get('io_priority') or self.settings.get('io_priority')
+        return secure_delete
+
+    def reload_settings(self):
+        self.settings = load_settings()
+        configure_crypto_engine(self.crypto, self.settings)
+        self.shred_windows = self._load_windows()
+        self.settings_generation += 1
+        self._schedule_wakeup.set()
+
+    def _load_windows(self):
+        try:
+            return parse_windows(self.settings.get('shred_windows'))
+        except ValueError as e:
+            # Never shred outside the intended hours because of a typo.
+            print(f"Scheduled deletion paused: {e}")
+            return None
+
+    def _walk(self, job, paths):
+        # Directories are walked as their files are queued, never up front;
+        # the emptied trees are removed once the job has finished.
+        walker = self.get_secure_delete()
+        for path in paths:
+            path = Path(path)
+            if path.is_dir() and not path.is_symlink():
+                job.setdefault('directories', []).append(str(path))
+                yield from walker.iter_directory_files(path)
+            else:
+                yield path
+
+    def _group_by_directory(self, paths):
+        # Consecutive files of a directory share one batch and so one
+        # directory fsync. A group also closes after GROUP_BYTES, so large
+        # files keep being shredded in parallel.
+        group, group_bytes = [], 0
+        for path in paths:
+            try:
+                size = path.lstat().st_size
+            except OSError:
+                size = 0
+            if group and (path.parent != group[0].parent or len(group) >= DIRECTORY_BATCH
+                          or group_bytes >= GROUP_BYTES):
+                yield group
+                group, group_bytes = [], 0
+            group.append(path)
+            group_bytes += size
+        if group:
+            yield group
+
+    def submit(self, kind, paths, limits=None, scheduled=False):
+        # Returns at once: the items are queued by a thread of the job, so a
+        # client gets its reply before a large tree has even been walked.
+        with self._lock:
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            job = {'id': job_id, 'kind': kind, 'total': 0, 'done': 0, 'failed': 0, 'state': 'queued',
+                   'submitted': time.time(), 'feeding': True, 'directories': [],
+                   'finished_event': threading.Event()}
+            if scheduled:
+                job['scheduled'] = True
+            if limits:
+                job['limits'] = limits
+                job['throttle'] = io_throttle_for(self.settings, limits.get('rate_limit'), limits.get('iops_limit'))
+            self.jobs[job_id] = job
+            self._trim_jobs()
+        threading.Thread(target=self._feed, args=(job, paths), name=f'cryptodisk-job-{job_id}',
+                         daemon=True).start()
+        return job
+
+    def _feed(self, job, paths):
+        try:
+            if job['kind'] == 'delete':
+                for group in self._group_by_directory(self._walk(job, paths)):
+                    if self._stopped.is_set():
+                        break
+                    self._queue(job, self._delete_group, group, len(group))
+            else:
+                for path in paths:
+                    if self._stopped.is_set():
+                        break
+                    self._queue(job, self._ingest_one, Path(path), 1)
+        except Exception as e:
+            print(f"Error queueing the items of job {job['id']}: {e}")
+        finally:
+            with self._lock:
+                job['feeding'] = False
+                finished = self._job_complete(job)
+            if finished:
+                self._job_finished(job)
+
+    def _queue(self, job, worker, item, count):
+        # Blocks while the pool already holds enough work for every worker;
+        # the worker gives its slot back when the item is done.
+        self._queue_slots.acquire()
+        with self._lock:
+            job['total'] += count
+            self.pending += count
+        QUEUE_DEPTH.inc(count)
+        try:
+            self.pool.submit(worker, job, item)
+        except RuntimeError:
+            # The pool is shutting down: the item never ran.
+            self._queue_slots.release()
+            with self._lock:
+                job['total'] -= count
+                self.pending -= count
+            QUEUE_DEPTH.dec(count)
+            raise
+
+    def _trim_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['state'] == 'finished']
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def _finish_item(self, job, success):
+        with self._lock:
+            job['done'] += 1
+            self.pending -= 1
+            if success:
+                self.completed += 1
+            else:
+                job['failed'] += 1
+                self.failed += 1
+            job['state'] = 'running'
+            finished = self._job_complete(job)
+        QUEUE_DEPTH.dec()
+        if finished:
+            self._job_finished(job)
+
+    def _job_complete(self, job):
+        # Called under self._lock; true for exactly one caller per job.
+        if job['feeding'] or job['done'] != job['total'] or job['state'] == 'finished':
+            return False
+        job['state'] = 'finished'
+        return True
+
+    def _job_finished(self, job):
+        if job.get('scheduled'):
+            self._schedule_wakeup.set()
+        if job.get('directories'):
+            self._remove_directories(job)
+        if job['kind'] == 'delete':
+            # Chunks of deduplicated files are only shredded once no vault file uses them.
+            try:
+                self.pool.submit(self._collect_garbage)
+            except RuntimeError:
+                pass
+        job['finished_event'].set()
+
+    def _remove_directories(self, job):
+        walker = self.get_secure_delete()
+        for directory in job['directories']:
+            try:
+                if not walker.remove_empty_directories(directory):
+                    print(f"Could not remove every directory under {directory}")
+            except OSError as e:
+                print(f"Error removing {directory}: {e}")
+
+    def _collect_garbage(self):
+        try:
+            collect_vault_garbage(self.cryptodisk_folder, self._job_secure_delete({}))
+        except Exception as e:
+            print(f"Error collecting deduplicated chunks: {e}")
+
+    def run_schedule(self):
+        # Queues expired vault files, then hands the next per-device batch of
+        # due files to the workers while a shred window is open.
+        retention = self.settings.get('retention_hours')
+        if retention:
+            self.shred_queue.add_vault(self.cryptodisk_folder, retention * 3600)
+        if self.shred_windows is None or not window_open(self.shred_windows):
+            return None
+        with self._lock:
+            if self._scheduled_job is not None and self._scheduled_job['state'] != 'finished':
+                return None
+        paths = self.shred_queue.claim_batch(self.settings.get('schedule_batch_size', DEFAULT_BATCH_SIZE))
+        if not paths:
+            return None
+        job = self.submit('delete', paths, scheduled=True)
+        with self._lock:
+            self._scheduled_job = job
+        return job
+
+    def _schedule_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_schedule()
+            except Exception as e:
+                print(f"Error running scheduled deletions: {e}")
+            self._schedule_wakeup.wait(SCHEDULE_INTERVAL)
+            self._schedule_wakeup.clear()
+
+    def _delete_group(self, job, paths):
+        results = [False] * len(paths)
+        try:
+            secure_delete = self._job_secure_delete(job)
+            with secure_delete.batch():
+                for index, path in enumerate(paths):
+                    results[index] = self._delete_one(secure_delete, path)
+        except Exception as e:
+            print(f"Error deleting files in {paths[0].parent}: {e}")
+        finally:
+            # Only reported once the batch made the unlinks durable.
+            for path, success in zip(paths, results):
+                if job.get('scheduled'):
+                    self._finish_scheduled(path, success)
+                self._finish_item(job, success)
+            self._queue_slots.release()
+        return results
+
+    def _delete_one(self, secure_delete, path):
+        try:
+            if path.is_dir() and not path.is_symlink():
+                return secure_delete.secure_delete_directory(path)
+            if path.exists() or path.is_symlink():
+                return secure_delete.secure_delete_file(str(path))
+        except Exception as e:
+            print(f"Error deleting {path}: {e}")
+        return False
+
+    def _finish_scheduled(self, path, success):
+        try:
+            self.shred_queue.finish(str(path), success, None if success else "secure deletion failed")
+        except Exception as e:
+            print(f"Error updating the shred queue for {path}: {e}")
+
+    def _ingest_one(self, job, path):
+        success = False
+        try:
+            if path.exists():
+                with span('ingest'):
+                    encrypted_path = self.cryptodisk_folder / f"{self.crypto.generate_random_name()}.crypted"
+                    self.crypto.encrypt_file(str(path), str(encrypted_path))
+                    success = self._job_secure_delete(job).secure_delete_file(str(path))
+        except Exception as e:
+            print(f"Error processing {path}: {e}")
+        finally:
+            self._finish_item(job, success)
+            self._queue_slots.release()
+        return success
+
+    def wait_for(self, job, timeout=None):
+        return job['finished_event'].wait(timeout)
+
+    def status(self):
+        with self._lock:
+            active = [self._job_summary(job) for job in self.jobs.values() if job['state'] != 'finished']
+            status = {
+                'pid': os.getpid(),
+                'uptime': round(time.time() - self.started, 1),
+                'workers': self.workers,
+                'pending': self.pending,
+                'completed': self.completed,
+                'failed': self.failed,
+                'vault_files': sum(1 for _ in self.cryptodisk_folder.glob("*.crypted")),
+                'active_jobs': active
+            }
+        status['shred_queue'] = self.queue_status()
+        return status
+
+    def queue_status(self):
+        return queue_status(self.shred_queue, self.shred_windows)
+
+    def _job_summary(self, job):
+        return {key: value for key, value in job.items() if key not in ('finished_event', 'throttle', 'directories')}
+
+    def handle_request(self, request):
+        command = request.get('cmd')
+        if command == 'ping':
+            return {'ok': True, 'pid': os.getpid()}
+        if command == 'status':
+            return {'ok': True, 'status': self.status()}
+        if command == 'reload':
+            self.reload_settings()
+            return {'ok': True}
+        if command in ('delete', 'empty'):
+            if command == 'empty':
+                paths = [str(path) for path in self.cryptodisk_folder.glob("*.crypted")]
+            else:
+                paths = [str(Path(path).absolute()) for path in request.get('paths', [])]
+            limits = {key: request[key] for key in ('rate_limit', 'iops_limit', 'io_priority') if request.get(key)}
+            if limits.get('io_priority', 'normal') not in IO_PRIORITIES:
+                return {'ok': False, 'error': f"unknown io_priority: {limits['io_priority']}"}
+            job = self.submit('delete', paths, limits)
+            if request.get('wait'):
+                self.wait_for(job)
+            return {'ok': True, 'job': self._job_summary(job)}
+        if command == 'queue':
+            return {'ok': True, 'queue': self.queue_status()}
+        if command == 'run_queue':
+            self._schedule_wakeup.set()
+            return {'ok': True}
+        if command == 'job':
+            job = self.jobs.get(request.get('id'))
+            if job is None:
+                return {'ok': False, 'error': 'unknown job'}
+            return {'ok': True, 'job': self._job_summary(job)}
+        return {'ok': False, 'error': f"unknown command: {command}"}
+
+    def _handle_connection(self, connection):
+        with connection, connection.makefile('rwb') as stream:
+            line = stream.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+                if check_token(request, self._token):
+                    response = self.handle_request(request)
+                else:
+                    response = {'ok': False, 'error': 'not authorized'}
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+            stream.write(json.dumps(response).encode() + b'\n')
+            stream.flush()
+
+    def _bind(self):
+        family, address = get_control_address()
+        private_runtime_dir(create=True)
+        if family == socket.AF_UNIX:
+            if send_request({'cmd': 'ping'}, timeout=1.0) is not None:
+                raise RuntimeError("Another CryptoDisk daemon is already running")
+            try:
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+            server = socket.socket(family, socket.SOCK_STREAM)
+            old_umask = os.umask(0o177)
+            try:
+                server.bind(address)
+            finally:
+                os.umask(old_umask)
+        else:
+            server = socket.socket(family, socket.SOCK_STREAM)
+            server.bind(address)
+        server.listen(64)
+        self._token = write_token()
+        return server
+
+    def _start_watcher(self):
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+
+        daemon = self
+
+        class DropFolderHandler(FileSystemEventHandler):
+            def on_created(self, event):
+                if not event.is_directory:
+                    file_path = Path(event.src_path)
+                    if file_path.suffix != '.crypted' and file_path.name != '.gitkeep' and \
+                            not is_partial_output(file_path):
+                        daemon.submit('ingest', [str(file_path)])
+
+        self.observer = Observer()
+        self.observer.schedule(DropFolderHandler(), str(self.cryptodisk_folder), recursive=False)
+        self.observer.start()
+
+    def serve_forever(self, watch_folder=True):
+        self._server_socket = self._bind()
+        if watch_folder:
+            self._start_watcher()
+        self._scheduler = threading.Thread(target=self._schedule_loop, name='cryptodisk-scheduler', daemon=True)
+        self._scheduler.start()
+        if self.metrics_port:
+            try:
+                self.metrics_server = MetricsServer(self.metrics_port).start()
+            except OSError as e:
+                print(f"Could not start metrics endpoint on port {self.metrics_port}: {e}")
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+        print(f"CryptoDisk daemon running ({self.workers} workers)...")
+        self._server_socket.settimeout(0.5)
+        try:
+            while not self._stopped.is_set():
+                try:
+                    connection, _ = self._server_socket.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                connection.settimeout(None)
+                threading.Thread(target=self._handle_connection, args=(connection,), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+            print("CryptoDisk background service stopped")
+
+    def stop(self):
+        self._stopped.set()
+        self._schedule_wakeup.set()
+
+    def shutdown(self):
+        self._stopped.set()
+        self._schedule_wakeup.set()
+        if self._server_socket is not None:
+            self._server_socket.close()
+            family, address = get_control_address()
+            if family == socket.AF_UNIX:
+                try:
+                    os.unlink(address)
+                except OSError:
+                    pass
+            remove_token(self._token)
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self._scheduler is not None:
+            self._scheduler.join()
+        self.pool.shutdown(wait=True)
+        self.shred_queue.close()
+        if self.audit_log is not None:
+            self.audit_log.close()
\ No newline at end of file
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+import hashlib
+import hmac
+import os
+import random
+import secrets
+import sqlite3
+import threading
+from pathlib import Path
+from processes import process_alive
+
+STORE_DIR_NAME = ".chunks"
+DEFAULT_KEY_FILE = Path(__file__).parent / "dedup.key"
+# Vault files CryptoDisk shredded, one path per line, for the garbage collector.
+DELETED_LOG = "deleted.log"
+
+MIN_CHUNK = 16 * 1024
+AVG_CHUNK = 64 * 1024
+MAX_CHUNK = 256 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+# Content-defined boundaries: every byte is mapped to one bit through a fixed
+# random table, and a chunk ends where the last ANCHOR_BITS mapped bits equal
+# a fixed pattern. A boundary therefore depends only on the few bytes before
+# it, so inserting data early in a file leaves later boundaries (and chunks)
+# unchanged. translate() and find() run in C, which keeps chunking at I/O
+# speed where a per-byte rolling hash in Python would not.
+_ANCHOR_RANDOM = random.Random(0x43445348)
+BIT_TABLE = bytes(ord('01'[_ANCHOR_RANDOM.getrandbits(1)]) for _ in range(256))
+ANCHOR_BITS = AVG_CHUNK.bit_length() + 1
+# Alternating bits at the start so runs of identical bytes (zeros, padding)
+# never match and fall back to MAX_CHUNK cuts.
+ANCHOR = b'01' + bytes(ord('01'[_ANCHOR_RANDOM.getrandbits(1)]) for _ in range(ANCHOR_BITS - 4)) + b'10'
+# Normalized chunking: the full pattern before the average size and a shorter
+# suffix of it after, which keeps chunk sizes close to AVG_CHUNK.
+ANCHOR_LARGE = ANCHOR[4:]
+
+def find_boundary(bits, start, end):
+    length = end - start
+    if length <= MIN_CHUNK:
+        return end
+    normal = start + min(AVG_CHUNK, length)
+    stop = start + min(MAX_CHUNK, length)
+    found = bits.find(ANCHOR, start + MIN_CHUNK - len(ANCHOR), normal)
+    if found >= 0:
+        return found + len(ANCHOR)
+    found = bits.find(ANCHOR_LARGE, normal - len(ANCHOR_LARGE) + 1, stop)
+    if found >= 0:
+        return found + len(ANCHOR_LARGE)
+    return stop
+
+def iter_chunks(stream, read_size=READ_SIZE):
+    pending = b''
+    eof = False
+    while True:
+        if not eof and len(pending) < MAX_CHUNK:
+            data = stream.read(read_size)
+            if data:
+                pending = pending + data if pending else data
+            else:
+                eof = True
+        if not pending:
+            return
+        if not eof and len(pending) < MAX_CHUNK:
+            continue
+
+        view = memoryview(pending)
+        bits = pending.translate(BIT_TABLE)
+        start = 0
+        # Cut chunks while a full MAX_CHUNK window is available; the tail is
+        # carried into the next read so boundaries do not depend on read size.
+        while len(pending) - start >= MAX_CHUNK or (eof and start < len(pending)):
+            end = find_boundary(bits, start, len(pending))
+            yield view[start:end]
+            start = end
+        pending = pending[start:]
+
+# Each chunk is encrypted under a key derived from its content, and that key
+# is only kept in the recipe of every file using the chunk, which is
+# encrypted under the file key. dedup.key alone therefore opens nothing: it
+# fingerprints content for deduplication, and derives the key of a chunk
+# only from that chunk's plaintext.
+
+def format_recipe(recipe):
+    return ''.join(' '.join(str(field) for field in entry if field is not None) + '\n'
+                   for entry in recipe).encode()
+
+def parse_recipe(data):
+    # (fingerprint, size, chunk key or None) per line; chunks written before
+    # keys were per chunk have no key field and use the store-wide key.
+    recipe = []
+    for line in data.splitlines():
+        fp, size, *key = line.decode().split()
+        recipe.append((fp, int(size), key[0] if key else None))
+    return recipe
+
+def record_deletion(path):
+    # Called once CryptoDisk shredded a .crypted file. Chunks are released
+    # for files recorded here, never just because a path is gone: a file
+    # moved out of the vault still needs them.
+    path = Path(path).absolute()
+    store_dir = path.parent / STORE_DIR_NAME
+    if not store_dir.is_dir():
+        return
+    try:
+        with open(store_dir / DELETED_LOG, 'ab') as f:
+            f.write(os.fsencode(str(path)) + b'\n')
+    except OSError as e:
+        print(f"Could not record the deletion of {path.name} for the chunk store: {e}")
+
+def _load_key(key_file, create=True):
+    key_file = Path(key_file)
+    try:
+        return key_file.read_bytes()
+    except FileNotFoundError:
+        if not create:
+            raise
+
+    key = secrets.token_bytes(32)
+    key_file.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        return key_file.read_bytes()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+class DedupStore:
+    def __init__(self, root, key_file=DEFAULT_KEY_FILE, create=True):
+        from ciphers import get_cipher, select_cipher
+        self.root = Path(root)
+        if create:
+            self.root.mkdir(parents=True, exist_ok=True)
+        key = _load_key(key_file, create)
+        self._fingerprint_key = hmac.new(key, b'cryptodisk dedup fingerprint', hashlib.sha256).digest()
+        self._content_key = hmac.new(key, b'cryptodisk dedup content', hashlib.sha256).digest()
+        # Only for chunks stored before keys were per chunk.
+        self._chunk_key = hmac.new(key, b'cryptodisk dedup chunk', hashlib.sha256).digest()
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.root / "index.sqlite3"), check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS chunks (fp TEXT PRIMARY KEY, size INTEGER, refs INTEGER);
+            CREATE TABLE IF NOT EXISTS files (file_id TEXT PRIMARY KEY, path TEXT);
+            CREATE TABLE IF NOT EXISTS file_chunks (file_id TEXT, fp TEXT, count INTEGER,
+                                                    PRIMARY KEY (file_id, fp));
+        """)
+        # Stores created before per-chunk keys and ingest owners.
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(chunks)")}
+        if 'keyed' not in columns:
+            with self._db:
+                self._db.execute("ALTER TABLE chunks ADD COLUMN keyed INTEGER DEFAULT 0")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(files)")}
+        if 'pid' not in columns:
+            with self._db:
+                self._db.execute("ALTER TABLE files ADD COLUMN pid INTEGER")
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'cipher'").fetchone()
+        if row is None:
+            with self._db:
+                self._db.execute("INSERT INTO meta VALUES ('cipher', ?)", (select_cipher(),))
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'cipher'").fetchone()
+        self.cipher_name = row[0]
+        self._cipher_class = get_cipher(self.cipher_name)
+        self._cipher = self._cipher_class(self._chunk_key)
+
+    def fingerprint(self, data):
+        return hmac.new(self._fingerprint_key, data, hashlib.sha256).hexdigest()
+
+    def chunk_path(self, fp):
+        return self.root / fp[:2] / fp[2:]
+
+    def chunk_key(self, data):
+        return hmac.new(self._content_key, data, hashlib.sha256).digest()
+
+    def _seal_chunk(self, fp, data, key):
+        # Written under a temporary name; the caller moves it into place.
+        nonce = os.urandom(12)
+        sealed = self._cipher_class(key).encrypt(nonce, data, bytes.fromhex(fp))
+        path = self.chunk_path(fp)
+        path.parent.mkdir(exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.{secrets.token_hex(4)}")
+        with open(temp_path, 'wb') as f:
+            f.write(nonce)
+            f.write(sealed)
+        return temp_path
+
+    def read_chunk(self, fp, key=None):
+        data = self.chunk_path(fp).read_bytes()
+        cipher = self._cipher if key is None else self._cipher_class(bytes.fromhex(key))
+        plaintext = cipher.decrypt(data[:12], data[12:], bytes.fromhex(fp))
+        if not hmac.compare_digest(self.fingerprint(plaintext), fp):
+            raise ValueError(f"Chunk {fp[:16]} does not match its fingerprint")
+        return plaintext
+
+    def add_file(self, file_id, stream):
+        # Returns the recipe [(fingerprint, size, key), ...] and the number of
+        # new bytes stored. Chunking and encryption run without the lock,
+        # which is only held to update the index one chunk at a time, so
+        # files are ingested concurrently. Every chunk counts for the file as
+        # soon as it is stored, so release() undoes a failed ingest. The file
+        # only becomes eligible for garbage collection once commit_file()
+        # records where its recipe was written.
+        recipe = []
+        new_bytes = 0
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO files (file_id, path, pid) VALUES (?, NULL, ?)", (file_id, os.getpid()))
+        for chunk in iter_chunks(stream):
+            fp = self.fingerprint(chunk)
+            key = self.chunk_key(chunk)
+            with self._lock:
+                known = self._db.execute("SELECT 1 FROM chunks WHERE fp = ?", (fp,)).fetchone()
+            temp_path = None if known else self._seal_chunk(fp, chunk, key)
+            try:
+                with self._lock, self._db:
+                    row = self._db.execute("SELECT keyed FROM chunks WHERE fp = ?", (fp,)).fetchone()
+                    if row is None:
+                        if temp_path is None:
+                            temp_path = self._seal_chunk(fp, chunk, key)
+                        os.replace(temp_path, self.chunk_path(fp))
+                        temp_path = None
+                        self._db.execute("INSERT INTO chunks (fp, size, refs, keyed) VALUES (?, ?, 1, 1)",
+                                         (fp, len(chunk)))
+                        new_bytes += len(chunk)
+                        keyed = True
+                    else:
+                        self._db.execute("UPDATE chunks SET refs = refs + 1 WHERE fp = ?", (fp,))
+                        keyed = row[0]
+                    self._db.execute("INSERT INTO file_chunks VALUES (?, ?, 1) ON CONFLICT (file_id, fp) "
+                                     "DO UPDATE SET count = count + 1", (file_id, fp))
+            finally:
+                if temp_path is not None:
+                    # Another ingest stored the same chunk first.
+                    try:
+                        temp_path.unlink()
+                    except OSError:
+                        pass
+            recipe.append((fp, len(chunk), key.hex() if keyed else None))
+        return recipe, new_bytes
+
+    def commit_file(self, file_id, path):
+        with self._lock, self._db:
+            self._db.execute("UPDATE files SET path = ? WHERE file_id = ?", (str(Path(path).absolute()), file_id))
+
+    def release(self, file_id):
+        # Drops a file's references and returns the chunk files nothing uses
+        # any more; the caller decides how to destroy them. They are moved
+        # aside under the lock, so an ingest storing the same chunk again
+        # cannot lose its copy to that destruction.
+        released = []
+        with self._lock, self._db:
+            rows = self._db.execute("SELECT fp, count FROM file_chunks WHERE file_id = ?", (file_id,)).fetchall()
+            self._db.executemany("UPDATE chunks SET refs = refs - ? WHERE fp = ?", [(count, fp) for fp, count in rows])
+            unused = [fp for (fp,) in self._db.execute("SELECT fp FROM chunks WHERE refs <= 0")]
+            self._db.execute("DELETE FROM chunks WHERE refs <= 0")
+            self._db.execute("DELETE FROM file_chunks WHERE file_id = ?", (file_id,))
+            self._db.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+            for fp in unused:
+                path = self.chunk_path(fp)
+                released_path = path.with_name(f".{path.name}.released")
+                try:
+                    os.replace(path, released_path)
+                except FileNotFoundError:
+                    continue
+                released.append(released_path)
+        return released
+
+    def _deleted_paths(self):
+        # Takes the log over before reading it; deletions recorded meanwhile
+        # go to a new log for the next run.
+        log = self.root / DELETED_LOG
+        taken = log.with_name(f".{DELETED_LOG}.{os.getpid()}")
+        try:
+            os.replace(log, taken)
+        except FileNotFoundError:
+            return set()
+        try:
+            return {os.fsdecode(line) for line in taken.read_bytes().splitlines() if line}
+        finally:
+            taken.unlink()
+
+    def collect_garbage(self, secure_delete=None):
+        deleted = self._deleted_paths()
+        with self._lock:
+            rows = self._db.execute("SELECT file_id, path, pid FROM files").fetchall()
+        removed = 0
+        for file_id, path, pid in rows:
+            if path is None:
+                # An ingest that never finished: only if its process is gone.
+                if pid is None or process_alive(pid):
+                    continue
+            elif path not in deleted or os.path.lexists(path):
+                continue
+            for chunk_path in self.release(file_id):
+                try:
+                    if secure_delete is not None:
+                        secure_delete.secure_delete_file(str(chunk_path))
+                    else:
+                        chunk_path.unlink()
+                    removed += 1
+                except OSError as e:
+                    print(f"Error removing chunk {chunk_path.name}: {e}")
+                try:
+                    chunk_path.parent.rmdir()
+                except OSError:
+                    pass
+        return removed
+
+    def stats(self):
+        with self._lock:
+            chunks, stored, referenced = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refs), 0) FROM chunks").fetchone()
+            files = self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return {'files': files, 'chunks': chunks, 'stored_bytes': stored, 'referenced_bytes': referenced}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def store_for_vault(vault_folder, create=True):
+    return DedupStore(Path(vault_folder) / STORE_DIR_NAME, create=create)
+
+def open_vault_store(vault_folder):
+    # For readers and the garbage collector: never creates a store or key.
+    if not (Path(vault_folder) / STORE_DIR_NAME).is_dir():
+        return None
+    try:
+        return store_for_vault(vault_folder, create=False)
+    except FileNotFoundError:
+        return None
+
+def collect_vault_garbage(vault_folder, secure_delete=None):
+    store = open_vault_store(vault_folder)
+    if store is None:
+        return 0
+    try:
+        return store.collect_garbage(secure_delete)
+    finally:
+        store.close()
\ No newline at end of file
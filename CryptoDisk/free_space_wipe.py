@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import errno
+import os
+import secrets
+import shutil
+import threading
+import time
+from pathlib import Path
+from profiler import span
+
+WIPE_DIR_PREFIX = ".cryptodisk-wipe-"
+DEFAULT_FILE_SIZE = 1024 * 1024 * 1024
+MIN_FILE_SIZE = 1024 * 1024
+
+class FreeSpaceWipe:
+    def __init__(self, mount_point, secure_delete_factory, streams=2, file_size=DEFAULT_FILE_SIZE,
+                 reserve=0, throttle=None, progress=None):
+        self.mount_point = Path(mount_point)
+        self.secure_delete_factory = secure_delete_factory
+        self.streams = max(1, streams)
+        self.file_size = max(MIN_FILE_SIZE, file_size)
+        self.reserve = reserve
+        self.throttle = throttle
+        self.progress = progress
+
+        self.bytes_written = 0
+        self.files = 0
+        self.errors = []
+        self._wipe_dir = None
+        self._full = threading.Event()
+        self._lock = threading.Lock()
+
+    def _next_size(self):
+        # Sized from what is free right now, so the streams together stop at
+        # the reserve instead of each assuming the whole remaining space.
+        with self._lock:
+            free = shutil.disk_usage(self._wipe_dir).free - self.reserve
+            size = min(self.file_size, free - free % MIN_FILE_SIZE)
+            if size < MIN_FILE_SIZE:
+                self._full.set()
+                return 0
+            return size
+
+    def _preallocate(self, fd, size):
+        # posix_fallocate reserves real blocks up front, so ENOSPC shows up here
+        # rather than halfway through an overwrite pass.
+        while size >= MIN_FILE_SIZE:
+            try:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+                return size
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    os.ftruncate(fd, 0)
+                    size //= 2
+                elif e.errno in (errno.EOPNOTSUPP, errno.EINVAL):
+                    os.ftruncate(fd, size)
+                    return size
+                else:
+                    raise
+        return 0
+
+    def _fill_one(self, secure_delete, path):
+        size = self._next_size()
+        if not size:
+            return False
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            size = self._preallocate(fd, size)
+        finally:
+            os.close(fd)
+        if not size:
+            self._full.set()
+            return False
+        try:
+            written = secure_delete.fill_file(path, size)
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            # Filesystems without real preallocation run out during the pass.
+            self._full.set()
+            written = secure_delete.get_last_report().get('bytes_written', 0)
+        with self._lock:
+            self.bytes_written += written
+            self.files += 1
+        if self.progress is not None:
+            self.progress(self.files, self.bytes_written)
+        return True
+
+    def _stream(self, number):
+        secure_delete = self.secure_delete_factory()
+        if self.throttle is not None:
+            secure_delete.throttle = self.throttle
+        count = 0
+        try:
+            while not self._full.is_set():
+                path = self._wipe_dir / f"fill-{number}-{count}"
+                count += 1
+                if not self._fill_one(secure_delete, path):
+                    break
+        except Exception as e:
+            self._full.set()
+            with self._lock:
+                self.errors.append(str(e))
+
+    def _remove_wipe_dir(self, wipe_dir):
+        try:
+            paths = list(wipe_dir.iterdir())
+        except OSError as e:
+            self.errors.append(f"Could not list {wipe_dir}: {e}")
+            return
+        for path in paths:
+            try:
+                path.unlink()
+            except OSError as e:
+                self.errors.append(f"Could not remove {path}: {e}")
+        try:
+            wipe_dir.rmdir()
+        except OSError as e:
+            self.errors.append(f"Could not remove {wipe_dir}: {e}")
+
+    def _cleanup(self):
+        # The filler files only hold overwrite patterns, so a plain unlink is
+        # enough; what matters is giving the space back quickly.
+        with span('wipe_cleanup'):
+            self._remove_wipe_dir(self._wipe_dir)
+            if hasattr(os, 'O_DIRECTORY'):
+                fd = os.open(self.mount_point, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def _remove_stale(self):
+        # Left over from an interrupted run, and still holding the space.
+        for stale in self.mount_point.glob(f"{WIPE_DIR_PREFIX}*"):
+            if stale.is_dir() and not stale.is_symlink():
+                self._remove_wipe_dir(stale)
+                continue
+            # A file or link under that name only ever held filler data, if
+            # anything of ours: dropping the name is enough, never a target.
+            try:
+                stale.unlink()
+            except OSError as e:
+                self.errors.append(f"Could not remove {stale}: {e}")
+
+    def run(self):
+        if not self.mount_point.is_dir():
+            raise ValueError(f"Not a directory: {self.mount_point}")
+        self._remove_stale()
+
+        started = time.time()
+        free_before = shutil.disk_usage(self.mount_point).free
+        self._wipe_dir = self.mount_point / f"{WIPE_DIR_PREFIX}{secrets.token_hex(4)}"
+        self._wipe_dir.mkdir(mode=0o700)
+
+        try:
+            with span('free_space_wipe', streams=self.streams):
+                threads = [threading.Thread(target=self._stream, args=(number,), daemon=True)
+                           for number in range(self.streams)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            free_at_peak = shutil.disk_usage(self.mount_point).free
+        finally:
+            self._cleanup()
+
+        return {
+            'mount_point': str(self.mount_point),
+            'free_before': free_before,
+            'free_at_peak': free_at_peak,
+            'bytes_written': self.bytes_written,
+            'files': self.files,
+            'streams': self.streams,
+            'duration': round(time.time() - started, 3),
+            'errors': self.errors
+        }
\ No newline at end of file
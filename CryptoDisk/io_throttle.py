@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import os
+import platform
+import threading
+import time
+
+MIB = 1024 * 1024
+IO_PRIORITIES = ('idle', 'best-effort', 'normal')
+
+# ioprio_set(2) has no wrapper in the standard library.
+IOPRIO_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314,
+                   'ppc64le': 273, 'riscv64': 30, 's390x': 282}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+# 'normal' clears the class, so the thread follows its CPU nice level again.
+IOPRIO_CLASSES = {'normal': 0, 'best-effort': 2, 'idle': 3}
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        # Up to one second of I/O may go through in a burst.
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Tokens may go negative: each caller then sleeps off its share of
+            # the debt, which keeps concurrent streams at the combined rate.
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+class IOThrottle:
+    def __init__(self, bytes_per_second=None, iops=None, parent=None):
+        self.bytes_per_second = bytes_per_second
+        self.iops = iops
+        self.parent = parent
+        self._bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self._ops = TokenBucket(iops) if iops else None
+
+    def consume(self, nbytes, ops=1):
+        wait = 0
+        if self._bytes is not None:
+            wait = max(wait, self._bytes.take(nbytes))
+        if self._ops is not None:
+            wait = max(wait, self._ops.take(ops))
+        if wait > 0:
+            time.sleep(wait)
+        # A per-job limit never lets a job exceed the global one.
+        if self.parent is not None:
+            self.parent.consume(nbytes, ops)
+
+    def describe(self):
+        limits = []
+        if self.bytes_per_second:
+            limits.append(f"{self.bytes_per_second / MIB:g} MiB/s")
+        if self.iops:
+            limits.append(f"{self.iops} IOPS")
+        return ', '.join(limits) or 'unlimited'
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+def get_shared_throttle(bytes_per_second=None, iops=None):
+    # Every worker configured from the same settings draws from one bucket.
+    if not bytes_per_second and not iops:
+        return None
+    with _shared_lock:
+        key = (bytes_per_second or None, iops or None)
+        throttle = _shared.get(key)
+        if throttle is None:
+            throttle = _shared[key] = IOThrottle(bytes_per_second, iops)
+        return throttle
+
+def set_io_priority(priority):
+    # Applies to the calling thread only: Linux I/O priorities are per task.
+    if priority not in IOPRIO_CLASSES or platform.system() != "Linux":
+        return False
+    number = IOPRIO_SYSCALLS.get(os.uname().machine)
+    if number is None:
+        return False
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    value = IOPRIO_CLASSES[priority] << IOPRIO_CLASS_SHIFT
+    if priority == 'best-effort':
+        # Lowest level within the class.
+        value |= 7
+    return libc.syscall(number, IOPRIO_WHO_PROCESS, 0, value) == 0
\ No newline at end of file
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import hashlib
+import hmac
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, x25519
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from ciphers import get_cipher
+from profiler import span
+from secure_memory import derive_into, secret_bytes, secure_buffer, secure_copy
+
+FILE_KEY_SIZE = 32
+SLOT_CIPHER = 'aes-256-gcm'
+DEFAULT_ITERATIONS = 100000
+# Iteration counts come from the file before anything in it is
+# authenticated; a crafted count must not stall the reader in the KDF.
+MAX_ITERATIONS = 10 * DEFAULT_ITERATIONS
+MIN_RSA_BITS = 2048
+# Slot areas are padded to whole blocks so recipients can be added or
+# rotated by rewriting the area in place.
+SLOT_AREA_BLOCK = 4096
+
+def derive_password_key(password, salt, iterations=DEFAULT_ITERATIONS):
+    # Returns a SecureBuffer; the caller releases it.
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=iterations)
+    key = secure_buffer(32)
+    with span('kdf', iterations=iterations):
+        derive_into(kdf, secret_bytes(password), key)
+    return key
+
+def valid_iterations(iterations):
+    return isinstance(iterations, int) and not isinstance(iterations, bool) and 1 <= iterations <= MAX_ITERATIONS
+
+class KeyCache:
+    # Password keys derived during one bulk operation, by password, salt and
+    # iterations. Files whose slots share a salt (every file re-keyed in one
+    # run does) then cost one KDF between them instead of one each.
+    def __init__(self):
+        self._keys = {}
+        self._lock = threading.Lock()
+        self.derivations = 0
+
+    def derive(self, password, salt, iterations=DEFAULT_ITERATIONS):
+        # The key stays owned by the cache, until clear(). Passwords are kept
+        # in locked memory to recognise them, never as dictionary keys.
+        secret = secret_bytes(password)
+        cache_key = (bytes(salt), iterations)
+        with self._lock:
+            for known, key in self._keys.get(cache_key, []):
+                if hmac.compare_digest(known.view, secret):
+                    return key
+        key = derive_password_key(password, salt, iterations)
+        with self._lock:
+            self._keys.setdefault(cache_key, []).append((secure_copy(secret), key))
+            self.derivations += 1
+        return key
+
+    def clear(self):
+        with self._lock:
+            for entries in self._keys.values():
+                for known, key in entries:
+                    known.release()
+                    key.release()
+            self._keys.clear()
+
+@contextmanager
+def _password_key(password, salt, iterations, key_cache):
+    if key_cache is not None:
+        yield key_cache.derive(password, salt, iterations)
+        return
+    key = derive_password_key(password, salt, iterations)
+    try:
+        yield key
+    finally:
+        key.release()
+
+def _public_bytes(public_key):
+    return public_key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+def key_id(public_key):
+    return hashlib.sha256(_public_bytes(public_key)).hexdigest()[:16]
+
+def _check_key(key):
+    public_key = key.public_key() if hasattr(key, 'private_bytes') else key
+    if isinstance(public_key, rsa.RSAPublicKey):
+        if public_key.key_size < MIN_RSA_BITS:
+            raise ValueError(f"RSA keys need at least {MIN_RSA_BITS} bits")
+    elif not isinstance(public_key, x25519.X25519PublicKey):
+        raise ValueError("Only X25519 and RSA keys can be recipients")
+    return key
+
+def load_public_key(path):
+    data = Path(path).read_bytes()
+    try:
+        return _check_key(serialization.load_pem_public_key(data))
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}")
+
+def load_private_key(path, passphrase=None):
+    data = Path(path).read_bytes()
+    try:
+        return _check_key(serialization.load_pem_private_key(
+            data, passphrase.encode() if passphrase else None))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{path}: {e}")
+
+def load_identities(paths):
+    identities = {}
+    for path in paths or []:
+        private_key = load_private_key(path)
+        identities[key_id(private_key.public_key())] = private_key
+    return identities
+
+def generate_keypair(path, kind='x25519', bits=3072):
+    # Writes the private key to path (owner-only) and the public key to path.pub.
+    if kind == 'x25519':
+        private_key = x25519.X25519PrivateKey.generate()
+    elif kind == 'rsa':
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+    else:
+        raise ValueError(f"Unknown key type: {kind}")
+    path = Path(path)
+    private_pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                            serialization.NoEncryption())
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(private_pem)
+    public_path = path.with_name(path.name + '.pub')
+    public_path.write_bytes(private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+    return public_path, key_id(private_key.public_key())
+
+def _wrap(kek, file_key, aad):
+    cipher = get_cipher(SLOT_CIPHER)(kek.view)
+    nonce = os.urandom(cipher.nonce_size)
+    return nonce, cipher.encrypt(nonce, secret_bytes(file_key), aad)
+
+def _unwrap(kek, slot, aad):
+    # The file key is decrypted straight into a SecureBuffer.
+    wrapped = bytes.fromhex(slot['key'])
+    file_key = secure_buffer(max(len(wrapped) - 16, 0))
+    try:
+        get_cipher(SLOT_CIPHER)(kek.view).decrypt_into(bytes.fromhex(slot['nonce']), wrapped, aad, file_key.view)
+    except (InvalidTag, ValueError):
+        file_key.release()
+        return None
+    return file_key
+
+def _x25519_kek(shared, ephemeral, recipient):
+    kek = secure_buffer(32)
+    derive_into(HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                     info=b'cryptodisk x25519 key slot' + ephemeral + recipient), shared, kek)
+    return kek
+
+def _rsa_padding(aad):
+    return padding.OAEP(mgf=padding.MGF1(hashes.SHA256()), algorithm=hashes.SHA256(),
+                        label=hashlib.sha256(aad).digest())
+
+def password_slot(file_key, password, aad, iterations=DEFAULT_ITERATIONS, salt=None, key_cache=None):
+    salt = salt or os.urandom(32)
+    with _password_key(password, salt, iterations, key_cache) as kek:
+        nonce, wrapped = _wrap(kek, file_key, aad)
+    return {'type': 'password', 'kdf': 'pbkdf2-sha256', 'iterations': iterations, 'salt': salt.hex(),
+            'nonce': nonce.hex(), 'key': wrapped.hex()}
+
+def recipient_slot(file_key, public_key, aad):
+    if isinstance(public_key, x25519.X25519PublicKey):
+        ephemeral = x25519.X25519PrivateKey.generate()
+        ephemeral_bytes = ephemeral.public_key().public_bytes(serialization.Encoding.Raw,
+                                                              serialization.PublicFormat.Raw)
+        recipient_bytes = public_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        with _x25519_kek(ephemeral.exchange(public_key), ephemeral_bytes, recipient_bytes) as kek:
+            nonce, wrapped = _wrap(kek, file_key, aad)
+        return {'type': 'x25519', 'id': key_id(public_key), 'ephemeral': ephemeral_bytes.hex(),
+                'nonce': nonce.hex(), 'key': wrapped.hex()}
+    # RSA encryption only takes bytes.
+    return {'type': 'rsa-oaep-sha256', 'id': key_id(public_key),
+            'key': public_key.encrypt(bytes(secret_bytes(file_key)), _rsa_padding(aad)).hex()}
+
+def unwrap_slot(slot, aad, password=None, identities=None, key_cache=None):
+    # Returns the file key as a SecureBuffer the caller releases, or None
+    # when this slot is not for the given password or identities.
+    kind = slot.get('type')
+    if kind == 'password':
+        if password is None:
+            return None
+        if not valid_iterations(slot.get('iterations')):
+            # The slot is not authenticated yet; never run the KDF for it.
+            return None
+        with _password_key(password, bytes.fromhex(slot['salt']), slot['iterations'], key_cache) as kek:
+            return _unwrap(kek, slot, aad)
+
+    private_key = (identities or {}).get(slot.get('id'))
+    if private_key is None:
+        return None
+    if kind == 'x25519' and isinstance(private_key, x25519.X25519PrivateKey):
+        ephemeral = bytes.fromhex(slot['ephemeral'])
+        recipient = private_key.public_key().public_bytes(serialization.Encoding.Raw,
+                                                          serialization.PublicFormat.Raw)
+        shared = private_key.exchange(x25519.X25519PublicKey.from_public_bytes(ephemeral))
+        with _x25519_kek(shared, ephemeral, recipient) as kek:
+            return _unwrap(kek, slot, aad)
+    if kind == 'rsa-oaep-sha256' and isinstance(private_key, rsa.RSAPrivateKey):
+        try:
+            return secure_copy(private_key.decrypt(bytes.fromhex(slot['key']), _rsa_padding(aad)))
+        except ValueError:
+            return None
+    return None
+
+def unlock(slots, aad, password=None, identities=None, key_cache=None):
+    # Public key slots first: they are cheap, a password slot costs the KDF.
+    for slot in sorted(slots, key=lambda slot: slot.get('type') == 'password'):
+        file_key = unwrap_slot(slot, aad, password, identities, key_cache)
+        if file_key is not None:
+            return file_key
+    return None
+
+def pack_slots(slots, area_size=None):
+    # Raises ValueError when the slots do not fit a given area size.
+    data = json.dumps(slots).encode()
+    needed = 4 + len(data)
+    if area_size is None:
+        area_size = -(-needed // SLOT_AREA_BLOCK) * SLOT_AREA_BLOCK
+    if needed > area_size:
+        raise ValueError("Key slots do not fit the reserved area")
+    return len(data).to_bytes(4, byteorder='big') + data + bytes(area_size - needed)
+
+def unpack_slots(area):
+    length = int.from_bytes(area[:4], byteorder='big')
+    if length > len(area) - 4:
+        raise ValueError("Corrupted key slot area")
+    slots = json.loads(bytes(area[4:4 + length]).decode())
+    if not isinstance(slots, list):
+        raise ValueError("Corrupted key slot area")
+    return slots
+
+def describe_slot(slot):
+    if slot.get('type') == 'password':
+        return f"password (pbkdf2-sha256, {slot.get('iterations')} iterations)"
+    return f"{slot.get('type')} recipient {slot.get('id')}"
\ No newline at end of file
@@ -9,11 +9,13 @@ import time
 from pathlib import Path
 import shutil
 from tkinterdnd2 import DND_FILES, TkinterDnD
-from crypto_engine import CryptoEngine
+from crypto_engine import CryptoEngine, is_partial_output
 from secure_delete import SecureDelete
+from audit_log import open_audit_log
+from profiler import span
+from metrics import QUEUE_DEPTH
+from settings import load_settings, save_settings, configure_secure_delete, configure_crypto_engine, secure_delete_settings, get_cryptodisk_folder
 import platform
-import argparse
-import json
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
@@ -23,9 +25,11 @@ class CryptoDiskFolderHandler(FileSystemEventHandler):
         
     def on_created(self, event):
         if not event.is_directory:
-            file_path = Path(event.src_path)
-            if not file_path.suffix == '.crypted' and file_path.name != '.gitkeep':
-                self.app.process_dropped_file(str(file_path))
+            with span('watcher_event'):
+                file_path = Path(event.src_path)
+                if file_path.suffix != '.crypted' and file_path.name != '.gitkeep' and \
+                        not is_partial_output(file_path):
+                    self.app.process_dropped_file(str(file_path))
 
 class CryptoDisk:
     def __init__(self, background_mode=False):
@@ -35,6 +39,9 @@ class CryptoDisk:
         self.crypto = CryptoEngine()
         self.secure_delete = SecureDelete()
         self.load_settings()
+        self.audit_log = open_audit_log(load_settings(self.settings_file))
+        self.crypto.audit_log = self.audit_log
+        self.secure_delete.audit_log = self.audit_log
         
         if not background_mode:
             self.setup_gui()
@@ -44,42 +51,21 @@ class CryptoDisk:
         self.setup_folder_monitoring()
         
     def setup_paths(self):
-        if self.system == "Windows":
-            self.desktop = Path.home() / "Desktop"
-        else:
-            self.desktop = Path.home() / "Desktop"
-            if not self.desktop.exists():
-                self.desktop = Path.home()
-        
-        self.cryptodisk_folder = self.desktop / "CryptoDisk"
-        self.cryptodisk_folder.mkdir(exist_ok=True)
+        self.cryptodisk_folder = get_cryptodisk_folder()
+        self.desktop = self.cryptodisk_folder.parent
         
         self.app_dir = Path(__file__).parent
         self.icon_path = self.app_dir / "icon.ico"
         self.settings_file = self.app_dir / "settings.json"
         
     def load_settings(self):
-        try:
-            if self.settings_file.exists():
-                with open(self.settings_file, 'r') as f:
-                    settings = json.load(f)
-                    self.secure_delete.set_methods(
-                        gutmann=settings.get('gutmann', True),
-                        dod=settings.get('dod', True),
-                        nist=settings.get('nist', True)
-                    )
-        except:
-            pass
+        settings = load_settings(self.settings_file)
+        configure_secure_delete(self.secure_delete, settings)
+        configure_crypto_engine(self.crypto, settings)
             
     def save_settings(self):
         try:
-            settings = {
-                'gutmann': self.secure_delete.use_gutmann,
-                'dod': self.secure_delete.use_dod,
-                'nist': self.secure_delete.use_nist
-            }
-            with open(self.settings_file, 'w') as f:
-                json.dump(settings, f)
+            save_settings(secure_delete_settings(self.secure_delete), self.settings_file)
         except:
             pass
         
@@ -164,6 +150,7 @@ class CryptoDisk:
         self.observer.start()
         
     def process_dropped_file(self, file_path):
+        QUEUE_DEPTH.inc()
         threading.Thread(target=self._process_file_thread, args=(file_path,), daemon=True).start()
         
     def _process_file_thread(self, file_path):
@@ -178,8 +165,9 @@ class CryptoDisk:
             random_name = self.crypto.generate_random_name()
             encrypted_path = self.cryptodisk_folder / f"{random_name}.crypted"
             
-            self.crypto.encrypt_file(str(original_path), str(encrypted_path))
-            self.secure_delete.secure_delete_file(str(original_path))
+            with span('ingest'):
+                self.crypto.encrypt_file(str(original_path), str(encrypted_path))
+                self.secure_delete.secure_delete_file(str(original_path))
             
             if not self.background_mode:
                 self.root.after(0, self.update_file_list)
@@ -188,6 +176,8 @@ class CryptoDisk:
         except Exception as e:
             if not self.background_mode:
                 messagebox.showerror("Error", f"Failed to process {file_path}: {str(e)}")
+        finally:
+            QUEUE_DEPTH.dec()
         
     def on_drop(self, event):
         files = self.root.tk.splitlist(event.data)
@@ -214,16 +204,21 @@ class CryptoDisk:
         if not result:
             return
             
+        QUEUE_DEPTH.inc(len(files))
         threading.Thread(target=self._empty_cryptodisk_thread, args=(files,), daemon=True).start()
         
     def _empty_cryptodisk_thread(self, files):
-        for i, file_path in enumerate(files, 1):
-            try:
-                self.status_var.set(f"Securely deleting {i}/{len(files)}: {file_path.name}")
-                self.secure_delete.secure_delete_file(str(file_path))
-            except Exception as e:
-                print(f"Error deleting {file_path}: {e}")
-                
+        # One directory fsync for the whole vault instead of one per file.
+        with self.secure_delete.batch():
+            for i, file_path in enumerate(files, 1):
+                try:
+                    self.status_var.set(f"Securely deleting {i}/{len(files)}: {file_path.name}")
+                    self.secure_delete.secure_delete_file(str(file_path))
+                except Exception as e:
+                    print(f"Error deleting {file_path}: {e}")
+                finally:
+                    QUEUE_DEPTH.dec()
+                    
         self.status_var.set("Ready - CryptoDisk emptied successfully")
         self.root.after(0, self.update_file_list)
         
@@ -300,88 +295,9 @@ class CryptoDisk:
         if hasattr(self, 'observer'):
             self.observer.stop()
             self.observer.join()
-
-def delete_file_directly(file_path):
-    try:
-        secure_delete = SecureDelete()
-        
-        original_path = Path(file_path)
-        if not original_path.exists():
-            return
-            
-        if secure_delete.secure_delete_file(str(original_path)):
-            try:
-                original_path.unlink(missing_ok=True)
-            except:
-                pass
-        
-    except Exception as e:
-        pass
-
-def main():
-    parser = argparse.ArgumentParser(description='CryptoDisk - Secure File Destruction')
-    parser.add_argument('--delete', metavar='FILE', help='Delete file directly without GUI')
-    parser.add_argument('--background', action='store_true', help='Run in background mode')
-    parser.add_argument('--empty', action='store_true', help='Empty CryptoDisk folder')
-    parser.add_argument('--settings', action='store_true', help='Show settings in terminal')
-    parser.add_argument('--set-gutmann', choices=['on', 'off'], help='Enable/disable Gutmann method')
-    parser.add_argument('--set-dod', choices=['on', 'off'], help='Enable/disable DoD method')
-    parser.add_argument('--set-nist', choices=['on', 'off'], help='Enable/disable NIST method')
-    
-    args = parser.parse_args()
-    
-    if args.delete:
-        delete_file_directly(args.delete)
-        return
-        
-    if args.empty:
-        desktop = Path.home() / "Desktop"
-        cryptodisk_folder = desktop / "CryptoDisk"
-        files = list(cryptodisk_folder.glob("*.crypted"))
-        
-        if not files:
-            print("CryptoDisk is already empty")
-            return
-            
-        print(f"Found {len(files)} files to delete")
-        confirm = input(f"Delete {len(files)} files permanently? (y/N): ")
-        
-        if confirm.lower() == 'y':
-            secure_delete = SecureDelete()
-            for i, file_path in enumerate(files, 1):
-                print(f"Deleting {i}/{len(files)}: {file_path.name}")
-                secure_delete.secure_delete_file(str(file_path))
-            print("CryptoDisk emptied successfully")
-        return
-        
-    app = CryptoDisk(background_mode=args.background)
-    
-    if args.settings or args.set_gutmann or args.set_dod or args.set_nist:
-        app.load_settings()
-        
-        if args.set_gutmann:
-            app.secure_delete.use_gutmann = args.set_gutmann == 'on'
-        if args.set_dod:
-            app.secure_delete.use_dod = args.set_dod == 'on'
-        if args.set_nist:
-            app.secure_delete.use_nist = args.set_nist == 'on'
-            
-        if args.set_gutmann or args.set_dod or args.set_nist:
-            app.save_settings()
-            print("Settings updated")
-            
-        if args.settings:
-            methods, total_passes = app.secure_delete.get_overwrite_info()
-            print("Current Settings:")
-            for method in methods:
-                print(f"  - {method}")
-            print(f"Total passes: {total_passes}")
-        return
-        
-    try:
-        app.run()
-    finally:
-        app.stop()
+        if self.audit_log is not None:
+            self.audit_log.close()
 
 if __name__ == "__main__":
+    from cli import main
     main()
\ No newline at end of file
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, 300.0)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return '{' + pairs + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, dict(key), value) for key, value in self._values.items()]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total, count) in self._series.items():
+                labels = dict(key)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    result.append((self.name + '_bucket', dict(labels, le=str(bound)), bucket_count))
+                result.append((self.name + '_bucket', dict(labels, le='+Inf'), count))
+                result.append((self.name + '_sum', labels, total))
+                result.append((self.name + '_count', labels, count))
+        return result
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self._register(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+FILES_PROCESSED = REGISTRY.counter('cryptodisk_files_processed_total', 'Files handled, by operation and result')
+BYTES_OVERWRITTEN = REGISTRY.counter('cryptodisk_bytes_overwritten_total', 'Bytes written by overwrite passes')
+BYTES_ENCRYPTED = REGISTRY.counter('cryptodisk_bytes_encrypted_total', 'Plaintext bytes encrypted')
+SYSCALLS = REGISTRY.counter('cryptodisk_syscalls_total', 'File system calls made by secure deletion, by call')
+ERRORS = REGISTRY.counter('cryptodisk_errors_total', 'Failed operations, by operation')
+BLOCK_CACHE_REQUESTS = REGISTRY.counter('cryptodisk_block_cache_requests_total',
+                                        'Decrypted block cache lookups, by result')
+BLOCK_CACHE_BYTES = REGISTRY.gauge('cryptodisk_block_cache_bytes', 'Decrypted bytes held by the block cache')
+QUEUE_DEPTH = REGISTRY.gauge('cryptodisk_queue_depth', 'Files waiting or in progress')
+OPERATION_SECONDS = REGISTRY.histogram('cryptodisk_operation_seconds', 'Per-file operation latency')
+QUEUE_DEPTH.set(0)
+
+def _make_handler(registry):
+    # http.server is imported here so short-lived CLI runs don't pay for it.
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+class MetricsServer:
+    def __init__(self, port=9464, host='127.0.0.1', registry=REGISTRY):
+        from http.server import ThreadingHTTPServer
+        self.server = ThreadingHTTPServer((host, port), _make_handler(registry))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
\ No newline at end of file
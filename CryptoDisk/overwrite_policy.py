@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import secrets
+
+PASS_TYPES = ('byte', 'pattern', 'random', 'verify')
+
+BUILTIN_POLICIES = {
+    'nist': [
+        {'type': 'random'}
+    ],
+    'dod': [
+        {'type': 'byte', 'value': '0x00'},
+        {'type': 'byte', 'value': '0xFF'},
+        {'type': 'random'}
+    ],
+    'gutmann': [
+        {'type': 'random'}, {'type': 'random'}, {'type': 'random'}, {'type': 'random'},
+        {'type': 'byte', 'value': '0x55'}, {'type': 'byte', 'value': '0xAA'},
+        {'type': 'pattern', 'value': '924924'}, {'type': 'pattern', 'value': '492492'},
+        {'type': 'pattern', 'value': '249249'},
+        {'type': 'byte', 'value': '0x00'}, {'type': 'byte', 'value': '0x11'},
+        {'type': 'byte', 'value': '0x22'}, {'type': 'byte', 'value': '0x33'},
+        {'type': 'byte', 'value': '0x44'}, {'type': 'byte', 'value': '0x55'},
+        {'type': 'byte', 'value': '0x66'}, {'type': 'byte', 'value': '0x77'},
+        {'type': 'byte', 'value': '0x88'}, {'type': 'byte', 'value': '0x99'},
+        {'type': 'byte', 'value': '0xAA'}, {'type': 'byte', 'value': '0xBB'},
+        {'type': 'byte', 'value': '0xCC'}, {'type': 'byte', 'value': '0xDD'},
+        {'type': 'byte', 'value': '0xEE'}, {'type': 'byte', 'value': '0xFF'},
+        {'type': 'pattern', 'value': '924924'}, {'type': 'pattern', 'value': '492492'},
+        {'type': 'pattern', 'value': '249249'}, {'type': 'pattern', 'value': '6DB6DB'},
+        {'type': 'pattern', 'value': 'B6DB6D'}, {'type': 'pattern', 'value': 'DB6DB6'},
+        {'type': 'random'}, {'type': 'random'}, {'type': 'random'}, {'type': 'random'}
+    ]
+}
+
+BUILTIN_LABELS = {
+    'nist': "NIST 800-88",
+    'dod': "DoD 5220.22-M",
+    'gutmann': "Gutmann Method"
+}
+
+class PolicyError(ValueError):
+    pass
+
+class OverwritePass:
+    def __init__(self, kind, pattern=None):
+        self.kind = kind
+        self.pattern = pattern
+        self.block = None
+
+    def prepare(self, block_size):
+        if self.kind in ('byte', 'pattern'):
+            repeat_count = block_size // len(self.pattern) + 2
+            self.block = self.pattern * repeat_count
+
+    def new_block(self, size):
+        if self.kind == 'random':
+            return secrets.token_bytes(size)
+        return self.block
+
+    def data_at(self, block, offset, length):
+        if self.kind == 'random':
+            return block[:length]
+        phase = offset % len(self.pattern)
+        return block[phase:phase + length]
+
+    def describe(self):
+        if self.kind == 'random':
+            return "random"
+        if self.kind == 'verify':
+            return "verify"
+        return "0x" + self.pattern.hex().upper()
+
+    def __eq__(self, other):
+        return isinstance(other, OverwritePass) and (self.kind, self.pattern) == (other.kind, other.pattern)
+
+    def __hash__(self):
+        return hash((self.kind, self.pattern))
+
+class OverwritePlan:
+    def __init__(self, passes, block_size, merged=None):
+        self.passes = passes
+        self.block_size = block_size
+        # Passes of combined built-in methods that an earlier method already wrote.
+        self.merged = merged or []
+
+    @property
+    def write_passes(self):
+        return sum(1 for p in self.passes if p.kind != 'verify')
+
+    @property
+    def verify_passes(self):
+        return sum(1 for p in self.passes if p.kind == 'verify')
+
+    def describe(self):
+        return [p.describe() for p in self.passes]
+
+def _parse_pattern(kind, value):
+    if isinstance(value, int):
+        if kind != 'byte' or not 0 <= value <= 255:
+            raise PolicyError(f"Invalid {kind} value: {value}")
+        return bytes([value])
+
+    if not isinstance(value, str):
+        raise PolicyError(f"Invalid {kind} value: {value!r}")
+
+    text = value.strip()
+    if text.lower().startswith('0x'):
+        text = text[2:]
+    try:
+        pattern = bytes.fromhex(text)
+    except ValueError:
+        raise PolicyError(f"Invalid {kind} value: {value!r}")
+
+    if not pattern or (kind == 'byte' and len(pattern) != 1):
+        raise PolicyError(f"Invalid {kind} value: {value!r}")
+    return pattern
+
+def _minimal_period(pattern):
+    for size in range(1, len(pattern) + 1):
+        if len(pattern) % size == 0 and pattern[:size] * (len(pattern) // size) == pattern:
+            return pattern[:size]
+    return pattern
+
+def _expand_groups(spec):
+    # Yields (built-in name or None, passes) in the order they were declared.
+    if isinstance(spec, str):
+        spec = [spec]
+    if not isinstance(spec, list):
+        raise PolicyError("Overwrite policy must be a list of passes or policy names")
+
+    for item in spec:
+        if isinstance(item, str):
+            name = item.strip().lower()
+            if name in BUILTIN_POLICIES:
+                yield name, BUILTIN_POLICIES[name]
+            elif name in ('random', 'verify'):
+                yield None, [{'type': name}]
+            else:
+                raise PolicyError(f"Unknown overwrite policy: {item}")
+        elif isinstance(item, dict):
+            yield None, [item]
+        else:
+            raise PolicyError(f"Invalid overwrite pass: {item!r}")
+
+def expand_policy(spec):
+    return [item for _, items in _expand_groups(spec) for item in items]
+
+def compile_policy(spec, block_size=1024 * 1024, merge_methods=False):
+    # The schedule runs as declared. Only with merge_methods, used when
+    # several built-in methods are enabled together, a fixed pass that an
+    # earlier method already wrote is left out; random passes never are.
+    passes = []
+    merged = []
+    written = set()
+
+    for name, items in _expand_groups(spec):
+        patterns = set()
+        for item in items:
+            kind = item.get('type')
+            if kind not in PASS_TYPES:
+                raise PolicyError(f"Unknown pass type: {kind!r}")
+
+            if kind in ('byte', 'pattern'):
+                current = OverwritePass(kind, _minimal_period(_parse_pattern(kind, item.get('value'))))
+                if merge_methods and name is not None and current.pattern in written:
+                    merged.append(f"{current.describe()} ({name})")
+                    continue
+                patterns.add(current.pattern)
+            else:
+                current = OverwritePass(kind)
+
+            if kind == 'verify' and not passes:
+                raise PolicyError("A verify pass needs a write pass before it")
+
+            current.prepare(block_size)
+            passes.append(current)
+        if name is not None:
+            written |= patterns
+
+    return OverwritePlan(passes, block_size, merged)
\ No newline at end of file
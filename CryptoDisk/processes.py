@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import os
+import platform
+
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+ERROR_ACCESS_DENIED = 5
+
+def process_alive(pid):
+    # Whether a process recorded as the owner of a journal, queue item or
+    # ingest may still be running. Unsure answers are "alive": the callers
+    # only ever take over work from processes known to be gone.
+    if pid <= 0:
+        return False
+    if platform.system() == "Windows":
+        # os.kill(pid, 0) sends CTRL_C_EVENT there instead of probing.
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.OpenProcess.restype = wintypes.HANDLE
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            # Another user's process exists but cannot be opened.
+            return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+        try:
+            code = wintypes.DWORD()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return True
+            return code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists, owned by someone else.
+        pass
+    return True
\ No newline at end of file
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import atexit
+import json
+import os
+import threading
+import time
+
+PROFILE_ENV_VAR = "CRYPTODISK_PROFILE"
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.parent = stack[-1] if stack else None
+        self.path = (self.parent.path + ';' + self.name) if self.parent else self.name
+        self.child_time = 0
+        stack.append(self)
+        self.started = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter_ns() - self.started
+        self.tracer._stack().pop()
+        if self.parent is not None:
+            self.parent.child_time += duration
+        if exc_type is not None:
+            self.args = dict(self.args, error=exc_type.__name__)
+        self.tracer._record(self, duration)
+        return False
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.output_path = None
+        self._events = []
+        self._folded = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter_ns()
+
+    def enable(self, output_path):
+        if self.enabled:
+            return
+        self.output_path = output_path
+        self.enabled = True
+        atexit.register(self.dump)
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _record(self, span, duration):
+        event = {
+            'name': span.name,
+            'ph': 'X',
+            'ts': (span.started - self._origin) / 1000,
+            'dur': duration / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident()
+        }
+        if span.args:
+            event['args'] = span.args
+        self_time = max(duration - span.child_time, 0) // 1000
+        with self._lock:
+            self._events.append(event)
+            self._folded[span.path] = self._folded.get(span.path, 0) + self_time
+
+    def dump(self, output_path=None):
+        output_path = output_path or self.output_path
+        if not output_path:
+            return
+        with self._lock:
+            events = list(self._events)
+            folded = dict(self._folded)
+
+        # .folded/.txt gives collapsed stacks for flamegraph.pl / speedscope,
+        # anything else is a Chrome trace for chrome://tracing or Perfetto.
+        if str(output_path).endswith(('.folded', '.txt')):
+            content = ''.join(f"{path} {count}\n" for path, count in sorted(folded.items()))
+        else:
+            content = json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+        with open(output_path, 'w') as f:
+            f.write(content)
+
+TRACER = Tracer()
+span = TRACER.span
+
+def enable_profiling(output_path=None):
+    output_path = output_path or os.environ.get(PROFILE_ENV_VAR)
+    if output_path:
+        TRACER.enable(output_path)
+    return TRACER.enabled
\ No newline at end of file
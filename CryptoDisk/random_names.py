@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+import os
+import string
+
+NAME_ALPHABET = string.ascii_letters + string.digits
+
+def random_name(length, alphabet=NAME_ALPHABET):
+    # The whole name comes from one os.urandom() call instead of one
+    # secrets.choice() (and one getrandom syscall) per character. The extra
+    # 64 bits keep the modulo bias below 2**-64.
+    base = len(alphabet)
+    space = base ** length
+    value = int.from_bytes(os.urandom((space.bit_length() + 64 + 7) // 8), 'big') % space
+    chars = []
+    for _ in range(length):
+        value, index = divmod(value, base)
+        chars.append(alphabet[index])
+    return ''.join(chars)
\ No newline at end of file
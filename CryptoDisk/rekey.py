@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import base64
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+from crypto_engine import IntegrityError
+from key_slots import KeyCache, password_slot
+from processes import process_alive
+from profiler import span
+from secure_delete import sync_directories
+
+DEFAULT_JOURNAL_DIR = Path(__file__).parent / "rekey_journal"
+DEFAULT_BATCH_SIZE = 64
+
+# A slot rewrite replaces a few KB in place, which a crash can tear. Each
+# worker logs the new bytes of a batch to its journal and fsyncs it once,
+# then writes and fsyncs the files, then empties the journal. Records left
+# behind are replayed before the next rewrite: replaying one is idempotent
+# and only touches a file whose size and header still match.
+
+class SlotJournal:
+    def __init__(self, journal_dir=DEFAULT_JOURNAL_DIR, name=None):
+        self.journal_dir = Path(journal_dir)
+        self.path = self.journal_dir / f"{name or os.getpid()}.journal"
+        self._file = None
+
+    def _open(self):
+        self.journal_dir.mkdir(mode=0o700, exist_ok=True)
+        self._file = open(self.path, 'wb')
+        # The journal has to survive the crash it is there for.
+        sync_directories([str(self.journal_dir)])
+
+    def write(self, rewrites):
+        # Grown slot areas go to a copy that replaces the file atomically.
+        records = []
+        for rewrite in rewrites:
+            if rewrite['offset'] + len(rewrite['data']) != rewrite['end']:
+                continue
+            records.append(json.dumps({
+                'path': rewrite['path'],
+                'size': os.path.getsize(rewrite['path']),
+                'header_size': len(rewrite['header']),
+                'header': hashlib.sha256(rewrite['header']).hexdigest(),
+                'offset': rewrite['offset'],
+                'data': base64.b64encode(zlib.compress(rewrite['data'])).decode()
+            }) + '\n')
+        if not records:
+            return
+        if self._file is None:
+            self._open()
+        self._file.write(''.join(records).encode())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def clear(self):
+        if self._file is None or self._file.tell() == 0:
+            return
+        self._file.seek(0)
+        self._file.truncate()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+
+def _replay_record(record):
+    path = record['path']
+    with open(path, 'r+b') as f:
+        if os.fstat(f.fileno()).st_size != record['size']:
+            return False
+        if hashlib.sha256(f.read(record['header_size'])).hexdigest() != record['header']:
+            return False
+        f.seek(record['offset'])
+        f.write(zlib.decompress(base64.b64decode(record['data'])))
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+def recover_journals(journal_dir=DEFAULT_JOURNAL_DIR):
+    # Journals of a process that is still running are left alone.
+    replayed = 0
+    journal_dir = Path(journal_dir)
+    if not journal_dir.is_dir():
+        return replayed
+    for journal_path in sorted(journal_dir.glob("*.journal")):
+        pid = journal_path.stem.split('-')[0]
+        if pid.isdigit() and int(pid) != os.getpid() and process_alive(int(pid)):
+            continue
+        with open(journal_path, 'rb') as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            try:
+                record = json.loads(line.decode())
+            except ValueError:
+                # Torn tail: the crash hit before the fsync, so the files of
+                # that batch were never touched.
+                break
+            try:
+                if _replay_record(record):
+                    replayed += 1
+            except (OSError, ValueError, zlib.error) as e:
+                print(f"Could not replay the key slot journal for {record.get('path')}: {e}")
+        journal_path.unlink()
+    return replayed
+
+def iter_encrypted_files(paths):
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            # Dot files are partial outputs of an encryption in progress.
+            for file_path in sorted(path.rglob("*.crypted")):
+                if not file_path.name.startswith('.') and file_path.is_file():
+                    yield file_path
+        else:
+            yield path
+
+class VaultRekey:
+    def __init__(self, crypto, password, new_password, workers=8, batch_size=DEFAULT_BATCH_SIZE,
+                 journal_dir=DEFAULT_JOURNAL_DIR, progress=None):
+        self.crypto = crypto
+        self.password = password
+        self.new_password = new_password
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.journal_dir = Path(journal_dir)
+        self.progress = progress
+
+        # Every slot written in this run shares one salt, so the new
+        # password costs a single KDF however many files there are.
+        self.salt = os.urandom(32)
+        self.key_cache = KeyCache()
+
+        self.files = 0
+        self.rekeyed = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.grown = 0
+        self.errors = []
+        self._paths = None
+        self._lock = threading.Lock()
+
+    def _update(self, slots, file_key, aad):
+        # Recipient slots stay as they are; every password slot is replaced.
+        slots = [slot for slot in slots if slot.get('type') != 'password']
+        slots.append(password_slot(file_key, self.new_password, aad, self.crypto.iterations,
+                                   self.salt, self.key_cache))
+        return slots
+
+    def _prepare(self, path):
+        try:
+            return self.crypto.prepare_key_slots(path, self.password, self._update), None
+        except IntegrityError as e:
+            # A file a previous, interrupted run already re-keyed.
+            try:
+                self.crypto.prepare_key_slots(path, self.new_password, lambda slots, file_key, aad: slots)
+                return None, None
+            except (OSError, ValueError, KeyError):
+                return None, e
+        except (OSError, ValueError, KeyError) as e:
+            return None, e
+
+    def _next_batch(self):
+        with self._lock:
+            return list(itertools.islice(self._paths, self.batch_size))
+
+    def _finish(self, path, outcome, error=None):
+        with self._lock:
+            self.files += 1
+            if outcome == 'failed':
+                self.failed += 1
+                if len(self.errors) < 20:
+                    self.errors.append({'path': str(path), 'error': str(error)})
+            elif outcome == 'unchanged':
+                self.unchanged += 1
+            else:
+                self.rekeyed += 1
+            done = self.files
+        if self.progress is not None:
+            self.progress(done, path, outcome)
+
+    def _worker(self, number):
+        journal = SlotJournal(self.journal_dir, f"{os.getpid()}-{number}")
+        try:
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    break
+                with span('rekey_batch', files=len(batch)):
+                    rewrites = []
+                    for path in batch:
+                        rewrite, error = self._prepare(path)
+                        if rewrite is not None:
+                            rewrites.append(rewrite)
+                        else:
+                            self._finish(path, 'failed' if error else 'unchanged', error)
+                    try:
+                        journal.write(rewrites)
+                    except OSError as e:
+                        for rewrite in rewrites:
+                            self._finish(rewrite['path'], 'failed', f"Could not write the journal: {e}")
+                        continue
+                    for rewrite in rewrites:
+                        grown = rewrite['offset'] + len(rewrite['data']) != rewrite['end']
+                        try:
+                            self.crypto.apply_key_slots(rewrite)
+                        except OSError as e:
+                            self._finish(rewrite['path'], 'failed', e)
+                            continue
+                        if grown:
+                            with self._lock:
+                                self.grown += 1
+                        self._finish(rewrite['path'], 'rekeyed')
+                    journal.clear()
+        finally:
+            journal.close()
+
+    def run(self, paths):
+        recovered = recover_journals(self.journal_dir)
+        started = time.monotonic()
+        self._paths = iter_encrypted_files(paths)
+        previous_cache = self.crypto.key_cache
+        self.crypto.key_cache = self.key_cache
+        try:
+            threads = [threading.Thread(target=self._worker, args=(number,), daemon=True)
+                       for number in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.crypto.key_cache = previous_cache
+            derivations = self.key_cache.derivations
+            self.key_cache.clear()
+        seconds = time.monotonic() - started
+        return {
+            'files': self.files,
+            'rekeyed': self.rekeyed,
+            'unchanged': self.unchanged,
+            'failed': self.failed,
+            'grown': self.grown,
+            'recovered': recovered,
+            'key_derivations': derivations,
+            'seconds': seconds,
+            'files_per_second': self.files / seconds if seconds > 0 else 0,
+            'errors': self.errors
+        }
\ No newline at end of file
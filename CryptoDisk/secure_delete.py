@@ -1,10 +1,47 @@
 #!/usr/bin/env python3
 
+import bisect
+import errno
+import json
+import mmap
 import os
-import random
 import secrets
+import stat
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 from pathlib import Path
 import platform
+from io_throttle import set_io_priority
+from overwrite_policy import compile_policy
+from profiler import span
+from random_names import random_name
+from metrics import BYTES_OVERWRITTEN, ERRORS, FILES_PROCESSED, OPERATION_SECONDS, SYSCALLS
+
+_thread_state = threading.local()
+
+def sync_directories(directories):
+    # Makes renames and unlinks durable. Windows has no directory handles
+    # to fsync. Returns the number of syscalls issued.
+    if platform.system() == "Windows" or not hasattr(os, 'O_DIRECTORY'):
+        return 0
+    calls = 0
+    with span('fsync_dirs', count=len(directories)):
+        for directory in directories:
+            try:
+                fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError:
+                calls += 1
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+            calls += 3
+    return calls
 
 class SecureDelete:
     def __init__(self):
@@ -12,41 +49,143 @@ class SecureDelete:
         self.use_gutmann = True
         self.use_dod = True
         self.use_nist = True
+        self.block_size = 1024 * 1024
+        self.last_report = {}
+        self.audit_log = None
+        self.throttle = None
+        self.io_priority = None
+        # Renames are only worth repeating if each one reaches the disk; with
+        # one directory fsync per batch, a single rename hides the name.
+        self.rename_passes = 1
+        self.last_batch = {}
+        self._batch_dirs = None
+        self._syscalls = Counter()
+        
+        self.policy = None
+        self._plan = None
+        self._plan_key = None
         
-        self.gutmann_patterns = [
-            b'\x55', b'\xAA', b'\x92\x49\x24', b'\x49\x24\x92', b'\x24\x92\x49',
-            b'\x00', b'\x11', b'\x22', b'\x33', b'\x44', b'\x55', b'\x66', b'\x77',
-            b'\x88', b'\x99', b'\xAA', b'\xBB', b'\xCC', b'\xDD', b'\xEE', b'\xFF',
-            b'\x92\x49\x24', b'\x49\x24\x92', b'\x24\x92\x49', b'\x6D\xB6\xDB',
-            b'\xB6\xDB\x6D', b'\xDB\x6D\xB6', None, b'\x92\x49\x24', b'\x49\x24\x92',
-            b'\x24\x92\x49', b'\x6D\xB6\xDB', b'\xB6\xDB\x6D', b'\xDB\x6D\xB6',
-            None, None
-        ]
+        self.verify_mode = None
+        self.verify_samples = 64
+        self.verify_sample_size = 4096
         
     def set_methods(self, gutmann=True, dod=True, nist=True):
         self.use_gutmann = gutmann
         self.use_dod = dod
         self.use_nist = nist
         
+    def set_policy(self, policy):
+        if policy is not None:
+            compile_policy(policy, self.block_size)
+        self.policy = policy
+        
+    def set_verification(self, mode=None, samples=64):
+        if mode not in (None, 'sampled', 'full'):
+            raise ValueError(f"Unknown verification mode: {mode}")
+        self.verify_mode = mode
+        self.verify_samples = max(1, int(samples))
+        
+    def _apply_io_priority(self):
+        # I/O priority is per thread, and workers reuse their thread for many
+        # files, so the syscall only runs when the setting changes. A job
+        # without a priority resets what an earlier job set on this thread;
+        # a thread never changed keeps the one the process started with.
+        current = getattr(_thread_state, 'io_priority', None)
+        priority = self.io_priority or ('normal' if current is not None else None)
+        if priority and current != priority:
+            if not set_io_priority(priority):
+                print(f"I/O priority '{priority}' is not supported here")
+            _thread_state.io_priority = priority
+            
+    def _count(self, call, amount=1):
+        self._syscalls[call] += amount
+        
+    @contextmanager
+    def batch(self):
+        # Renames and unlinks inside the batch share one fsync per parent
+        # directory, issued when the batch ends. A nested batch joins the
+        # outer one.
+        if self._batch_dirs is not None:
+            yield
+            return
+        self._batch_dirs = set()
+        try:
+            yield
+        finally:
+            directories, self._batch_dirs = self._batch_dirs, None
+            synced = self._sync_directories(directories)
+            self.last_batch = {'directories': len(directories), 'directory_syscalls': synced}
+            
+    def _directory_changed(self, directory):
+        if self._batch_dirs is not None:
+            self._batch_dirs.add(str(directory))
+        else:
+            self._count('dir_sync', self._sync_directories([str(directory)]))
+            
+    def _sync_directories(self, directories):
+        if self.system == "Windows":
+            return 0
+        return sync_directories(directories)
+        
+    def _consume(self, nbytes, ops=1):
+        if self.throttle is not None:
+            self.throttle.consume(nbytes, ops)
+            
+    def get_plan(self):
+        if self.policy is not None:
+            spec = self.policy
+        else:
+            enabled = [('nist', self.use_nist), ('dod', self.use_dod), ('gutmann', self.use_gutmann)]
+            spec = [name for name, use in enabled if use]
+            
+        # An explicit policy runs exactly as written.
+        merge = self.policy is None
+        plan_key = (json.dumps(spec, sort_keys=True), self.block_size, merge)
+        if plan_key != self._plan_key:
+            self._plan = compile_policy(spec, self.block_size, merge)
+            self._plan_key = plan_key
+        return self._plan
+        
     def secure_delete_file(self, file_path):
         file_path = Path(file_path)
-        if not file_path.exists():
+        self._syscalls = Counter(stat=1)
+        try:
+            file_stat = file_path.lstat()
+        except FileNotFoundError:
             return False
+        if stat.S_ISLNK(file_stat.st_mode):
+            # Never overwrite through a link: drop the link, leave the target alone.
+            file_path.unlink()
+            return True
             
-        file_size = file_path.stat().st_size
+        self._apply_io_priority()
+        started = time.time()
+        file_size = file_stat.st_size
+        self.last_report = {
+            'logical_size': file_size,
+            'allocated_size': file_size,
+            'extents': 0,
+            'passes': 0,
+            'bytes_written': 0,
+            'verification': []
+        }
         
         try:
-            if self.use_nist:
-                self._nist_overwrite(file_path, file_size)
+            # Opening the file may fail too; that goes through the same error path.
+            extents = self._get_allocated_extents(file_path, file_size)
+            self.last_report['allocated_size'] = sum(end - start for start, end in extents)
+            self.last_report['extents'] = len(extents)
+            with span('secure_delete', size=file_size):
+                self._execute_plan(file_path, extents, self.get_plan())
                 
-            if self.use_dod:
-                self._dod_overwrite(file_path, file_size)
-                
-            if self.use_gutmann:
-                self._gutmann_overwrite(file_path, file_size)
-                
-            renamed_path = self._rename_file_randomly(file_path)
-            renamed_path.unlink()
+                renamed_path = self._rename_file_randomly(file_path)
+                with span('unlink'):
+                    os.unlink(renamed_path)
+                self._count('unlink')
+                self._consume(0)
+                self._directory_changed(file_path.parent)
+            self._record_result(file_path, started, True)
+            self._release_chunks(file_path)
             return True
             
         except Exception as e:
@@ -55,136 +194,387 @@ class SecureDelete:
                 file_path.unlink()
             except:
                 pass
+            self._record_result(file_path, started, False, str(e))
+            if not os.path.lexists(file_path):
+                self._release_chunks(file_path)
             return False
             
-    def _nist_overwrite(self, file_path, file_size):
-        with open(file_path, 'r+b') as f:
-            random_data = secrets.token_bytes(min(file_size, 1024 * 1024))
+    def _release_chunks(self, file_path):
+        # A deduplicated vault file's chunks may only go once CryptoDisk
+        # itself deleted the file; see dedup_store.record_deletion.
+        if file_path.suffix == '.crypted' and (file_path.parent / '.chunks').is_dir():
+            from dedup_store import record_deletion
+            record_deletion(file_path)
+            
+    def fill_file(self, file_path, size):
+        # Runs the plan over a preallocated file end to end. Used by the
+        # free-space wipe, which removes the file itself afterwards.
+        self.last_report = {
+            'logical_size': size,
+            'allocated_size': size,
+            'extents': 1,
+            'passes': 0,
+            'bytes_written': 0,
+            'verification': []
+        }
+        self._apply_io_priority()
+        self._syscalls = Counter()
+        if size:
+            with span('fill_file', size=size):
+                self._execute_plan(file_path, [(0, size)], self.get_plan())
+        BYTES_OVERWRITTEN.inc(self.last_report['bytes_written'])
+        return self.last_report['bytes_written']
+        
+    def get_last_report(self):
+        return dict(self.last_report)
+        
+    def get_strategy_name(self):
+        if self.policy is not None:
+            return "custom"
+        enabled = [('nist', self.use_nist), ('dod', self.use_dod), ('gutmann', self.use_gutmann)]
+        return "+".join(name for name, use in enabled if use) or "none"
+        
+    def _record_result(self, file_path, started, success, error=None):
+        duration = time.time() - started
+        self.last_report['duration'] = duration
+        self.last_report['syscalls'] = dict(self._syscalls)
+        
+        for call, count in self._syscalls.items():
+            SYSCALLS.inc(count, call=call)
+        FILES_PROCESSED.inc(operation='secure_delete', result='ok' if success else 'error')
+        BYTES_OVERWRITTEN.inc(self.last_report['bytes_written'])
+        OPERATION_SECONDS.observe(duration, operation='secure_delete')
+        if not success:
+            ERRORS.inc(operation='secure_delete')
+            
+        if self.audit_log is None:
+            return
+            
+        report = self.last_report
+        entry = {
+            'path_hash': self.audit_log.hash_path(file_path),
+            'size': report['logical_size'],
+            'allocated_size': report['allocated_size'],
+            'strategy': self.get_strategy_name(),
+            'passes': report['passes'],
+            'bytes_written': report['bytes_written'],
+            'duration': round(duration, 6),
+            'mb_per_s': round(report['bytes_written'] / duration / (1024 * 1024), 3) if duration > 0 else None,
+            'verified': all(record['passed'] for record in report['verification']) if report['verification'] else None,
+            'syscalls': sum(report['syscalls'].values()),
+            'success': success
+        }
+        if error:
+            entry['error'] = error
+        self.audit_log.record('secure_delete', **entry)
+        
+    def _get_allocated_extents(self, file_path, file_size):
+        if file_size == 0:
+            return []
+        if not hasattr(os, 'SEEK_DATA') or not hasattr(os, 'SEEK_HOLE'):
+            return [(0, file_size)]
+            
+        extents = []
+        fd = os.open(file_path, os.O_RDONLY)
+        self._count('open')
+        try:
+            offset = 0
+            while offset < file_size:
+                self._count('lseek', 2)
+                try:
+                    start = os.lseek(fd, offset, os.SEEK_DATA)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        break
+                    return [(0, file_size)]
+                end = min(os.lseek(fd, start, os.SEEK_HOLE), file_size)
+                if end <= start:
+                    break
+                extents.append((start, end))
+                offset = end
+        except OSError:
+            return [(0, file_size)]
+        finally:
+            os.close(fd)
+            self._count('close')
             
-            for offset in range(0, file_size, len(random_data)):
-                f.seek(offset)
-                remaining = min(len(random_data), file_size - offset)
-                if remaining < len(random_data):
-                    f.write(random_data[:remaining])
+        return extents
+        
+    def _execute_plan(self, file_path, extents, plan):
+        largest_extent = max((end - start for start, end in extents), default=0)
+        block_size = min(largest_extent, plan.block_size)
+        last_pass = None
+        last_block = None
+        # One descriptor for every write pass of the file.
+        fd = os.open(file_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        self._count('open')
+        try:
+            for overwrite_pass in plan.passes:
+                if overwrite_pass.kind == 'verify':
+                    self._verify_pass(file_path, extents, block_size, last_pass, last_block,
+                                      self.verify_mode or 'full')
                 else:
-                    f.write(random_data)
-            f.flush()
+                    last_block = self._overwrite_pass(fd, extents, block_size, overwrite_pass)
+                    last_pass = overwrite_pass
+        finally:
+            os.close(fd)
+            self._count('close')
+                
+        if self.verify_mode and last_pass is not None and plan.passes[-1].kind != 'verify':
+            self._verify_pass(file_path, extents, block_size, last_pass, last_block, self.verify_mode)
+            
+    def _iter_blocks(self, extents, block_size):
+        for start, end in extents:
+            for offset in range(start, end, block_size):
+                yield start, offset, min(block_size, end - offset)
+                
+    def _write_at(self, fd, data, offset):
+        # pwrite() is one syscall per block where seek() + write() is two.
+        if not hasattr(os, 'pwrite'):
+            os.lseek(fd, offset, os.SEEK_SET)
+            self._count('lseek')
+        data = memoryview(data)
+        while data:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, data, offset)
+            else:
+                written = os.write(fd, data)
+            self._count('write')
+            data = data[written:]
+            offset += written
+            
+    def _overwrite_pass(self, fd, extents, block_size, overwrite_pass):
+        block = overwrite_pass.new_block(block_size) if block_size else b''
+        data = memoryview(block)
+        
+        with span('overwrite_pass', pattern=overwrite_pass.describe()):
+            for _, offset, length in self._iter_blocks(extents, block_size):
+                self._write_at(fd, overwrite_pass.data_at(data, offset, length), offset)
+                self.last_report['bytes_written'] += length
+                self._consume(length)
             if self.system != "Windows":
-                os.fsync(f.fileno())
+                with span('fsync'):
+                    os.fsync(fd)
+                self._count('fsync')
                 
-    def _dod_overwrite(self, file_path, file_size):
-        patterns = [b'\x00', b'\xFF', None]
+        self.last_report['passes'] += 1
+        return block
         
-        for pattern in patterns:
-            with open(file_path, 'r+b') as f:
-                if pattern is None:
-                    data = secrets.token_bytes(min(file_size, 1024 * 1024))
-                else:
-                    data = pattern * min(file_size, 1024 * 1024)
-                    
-                for offset in range(0, file_size, len(data)):
-                    f.seek(offset)
-                    remaining = min(len(data), file_size - offset)
-                    if remaining < len(data):
-                        if pattern is None:
-                            f.write(data[:remaining])
-                        else:
-                            f.write(pattern * remaining)
-                    else:
-                        f.write(data)
-                f.flush()
-                if self.system != "Windows":
-                    os.fsync(f.fileno())
-                    
-    def _gutmann_overwrite(self, file_path, file_size):
-        for pattern in self.gutmann_patterns:
-            with open(file_path, 'r+b') as f:
-                if pattern is None:
-                    data = secrets.token_bytes(min(file_size, 1024 * 1024))
-                else:
-                    if len(pattern) == 1:
-                        data = pattern * min(file_size, 1024 * 1024)
-                    else:
-                        repeat_count = min(file_size, 1024 * 1024) // len(pattern) + 1
-                        data = (pattern * repeat_count)[:min(file_size, 1024 * 1024)]
-                        
-                for offset in range(0, file_size, len(data)):
-                    f.seek(offset)
-                    remaining = min(len(data), file_size - offset)
-                    if remaining < len(data):
-                        if pattern is None:
-                            f.write(data[:remaining])
-                        else:
-                            if len(pattern) == 1:
-                                f.write(pattern * remaining)
-                            else:
-                                repeat_count = remaining // len(pattern) + 1
-                                write_data = (pattern * repeat_count)[:remaining]
-                                f.write(write_data)
-                    else:
-                        f.write(data)
-                f.flush()
-                if self.system != "Windows":
-                    os.fsync(f.fileno())
+    def _sample_blocks(self, extents, block_size):
+        sample_size = min(self.verify_sample_size, block_size)
+        slots = []
+        total_slots = 0
+        for start, end in extents:
+            total_slots += (end - start + sample_size - 1) // sample_size
+            slots.append((total_slots, start, end))
+            
+        slot_ends = [last for last, _, _ in slots]
+        chosen = sorted(secrets.SystemRandom().sample(range(total_slots), min(self.verify_samples, total_slots)))
+        for slot in chosen:
+            index = bisect.bisect_right(slot_ends, slot)
+            first_slot = slots[index - 1][0] if index else 0
+            _, start, end = slots[index]
+            offset = start + (slot - first_slot) * sample_size
+            yield start, offset, min(sample_size, end - offset)
+            
+    def _expected_data(self, overwrite_pass, data, extent_start, block_size, offset, length):
+        block_offset = extent_start + (offset - extent_start) // block_size * block_size
+        skip = offset - block_offset
+        return overwrite_pass.data_at(data, block_offset, skip + length)[skip:]
+        
+    def _open_for_verify(self, file_path):
+        if hasattr(os, 'O_DIRECT'):
+            try:
+                return os.open(file_path, os.O_RDONLY | os.O_DIRECT), True
+            except OSError:
+                pass
+                
+        fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+        return fd, False
+        
+    def _read_block(self, fd, buffer, direct_io, offset, length):
+        if not direct_io:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+            
+        alignment = self.verify_sample_size
+        aligned_offset = offset - offset % alignment
+        aligned_end = (offset + length + alignment - 1) // alignment * alignment
+        read = os.preadv(fd, [memoryview(buffer)[:aligned_end - aligned_offset]], aligned_offset)
+        skip = offset - aligned_offset
+        return buffer[skip:min(skip + length, read)]
+        
+    def _verify_pass(self, file_path, extents, block_size, last_pass, last_block, mode):
+        with span('verify', mode=mode):
+            self._verify_blocks(file_path, extents, block_size, last_pass, last_block, mode)
+            
+    def _verify_blocks(self, file_path, extents, block_size, last_pass, last_block, mode):
+        started = time.time()
+        data = memoryview(last_block)
+        record = {
+            'mode': mode,
+            'pass': last_pass.describe(),
+            'blocks_checked': 0,
+            'bytes_checked': 0,
+            'mismatches': 0,
+            'first_mismatch': None,
+            'direct_io': False
+        }
+        
+        if not extents:
+            blocks = []
+        elif mode == 'sampled':
+            blocks = self._sample_blocks(extents, block_size)
+        else:
+            blocks = self._iter_blocks(extents, block_size)
+            
+        fd, direct_io = self._open_for_verify(file_path)
+        self._count('open')
+        buffer = None
+        try:
+            if direct_io:
+                buffer = mmap.mmap(-1, block_size + 2 * self.verify_sample_size)
+            for extent_start, offset, length in blocks:
+                try:
+                    actual = self._read_block(fd, buffer, direct_io, offset, length)
+                except OSError:
+                    if not direct_io:
+                        raise
+                    os.close(fd)
+                    fd, direct_io = self._open_for_verify(file_path)
+                    actual = self._read_block(fd, buffer, direct_io, offset, length)
+                self._count('read')
+                self._consume(length)
                     
+                expected = self._expected_data(last_pass, data, extent_start, block_size, offset, length)
+                record['blocks_checked'] += 1
+                record['bytes_checked'] += length
+                if actual != expected:
+                    record['mismatches'] += 1
+                    if record['first_mismatch'] is None:
+                        record['first_mismatch'] = offset
+        finally:
+            os.close(fd)
+            self._count('close')
+            if buffer is not None:
+                buffer.close()
+                
+        record['direct_io'] = direct_io
+        record['passed'] = record['mismatches'] == 0
+        record['duration'] = round(time.time() - started, 6)
+        if mode == 'sampled':
+            # Chance of catching damage that affects 1% of the sampled blocks.
+            record['detection_confidence_1pct'] = round(1 - 0.99 ** record['blocks_checked'], 6)
+        self.last_report['verification'].append(record)
+        
+        if not record['passed']:
+            raise IOError(f"Verification failed at offset {record['first_mismatch']}")
+            
     def _rename_file_randomly(self, file_path):
         original_dir = file_path.parent
         original_name = file_path.name
         
-        for i in range(3):
-            random_name = self._generate_random_filename(len(original_name))
-            new_path = original_dir / random_name
+        for i in range(self.rename_passes):
+            new_path = original_dir / self._generate_random_filename(len(original_name))
             
             try:
-                file_path.rename(new_path)
+                with span('rename'):
+                    os.rename(file_path, new_path)
+                self._count('rename')
                 file_path = new_path
+                self._consume(0)
             except:
                 break
                 
         return file_path
         
     def _generate_random_filename(self, length):
-        chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-        return ''.join(secrets.choice(chars) for _ in range(length))
+        return random_name(length)
         
     def secure_delete_directory(self, dir_path):
         dir_path = Path(dir_path)
-        if not dir_path.exists() or not dir_path.is_dir():
+        if dir_path.is_symlink() or not dir_path.is_dir():
             return False
             
         try:
-            for item in dir_path.rglob('*'):
-                if item.is_file():
+            with self.batch():
+                for item in self.iter_directory_files(dir_path):
                     self.secure_delete_file(item)
                     
-            for item in sorted(dir_path.rglob('*'), key=lambda x: len(str(x)), reverse=True):
-                if item.is_dir():
-                    try:
-                        item.rmdir()
-                    except:
-                        pass
-                        
-            dir_path.rmdir()
-            return True
+            return self.remove_empty_directories(dir_path)
             
         except Exception as e:
             print(f"Error during directory secure deletion: {e}")
             return False
             
+    def iter_directory_files(self, dir_path):
+        # Depth-first with one scandir iterator per level, so memory depends on
+        # tree depth rather than on how many entries the tree holds.
+        stack = [os.scandir(dir_path)]
+        try:
+            while stack:
+                entry = next(stack[-1], None)
+                if entry is None:
+                    stack.pop().close()
+                    continue
+                    
+                if entry.is_symlink():
+                    # Remove the link itself; its target may live outside the tree.
+                    os.unlink(entry.path)
+                elif entry.is_dir(follow_symlinks=False):
+                    stack.append(os.scandir(entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    yield Path(entry.path)
+                else:
+                    os.unlink(entry.path)
+        finally:
+            for iterator in stack:
+                iterator.close()
+                
+    def remove_empty_directories(self, dir_path):
+        stack = [(str(dir_path), os.scandir(dir_path))]
+        removed_root = False
+        try:
+            while stack:
+                path, iterator = stack[-1]
+                entry = next(iterator, None)
+                if entry is None:
+                    iterator.close()
+                    stack.pop()
+                    try:
+                        os.rmdir(path)
+                        removed_root = not stack
+                    except OSError:
+                        pass
+                elif entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, os.scandir(entry.path)))
+        finally:
+            for _, iterator in stack:
+                iterator.close()
+        return removed_root
+        
     def get_overwrite_info(self):
         methods = []
-        total_passes = 0
+        plan = self.get_plan()
         
-        if self.use_nist:
-            methods.append("NIST 800-88 (1 pass)")
-            total_passes += 1
-            
-        if self.use_dod:
-            methods.append("DoD 5220.22-M (3 passes)")
-            total_passes += 3
-            
-        if self.use_gutmann:
-            methods.append("Gutmann Method (35 passes)")
-            total_passes += 35
+        if self.policy is not None:
+            methods.append(f"Custom policy ({plan.write_passes} passes)")
+        else:
+            if self.use_nist:
+                methods.append("NIST 800-88 (1 pass)")
+                
+            if self.use_dod:
+                methods.append("DoD 5220.22-M (3 passes)")
+                
+            if self.use_gutmann:
+                methods.append("Gutmann Method (35 passes)")
+                
+        if plan.verify_passes:
+            methods.append(f"Read-back verification ({plan.verify_passes} passes)")
             
-        return methods, total_passes
\ No newline at end of file
+        return methods, plan.write_passes
\ No newline at end of file
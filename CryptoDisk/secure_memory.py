@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import atexit
+import ctypes
+import mmap
+import os
+import platform
+import threading
+
+ARENA_SIZE = 64 * 1024
+MIN_SLOT_SIZE = 64
+
+def wipe(buffer):
+    # In place: assigning zeros to a slice would allocate a second buffer.
+    if len(buffer):
+        ctypes.memset((ctypes.c_char * len(buffer)).from_buffer(buffer), 0, len(buffer))
+
+def _address(buffer):
+    return ctypes.addressof(ctypes.c_char.from_buffer(buffer))
+
+def _lock_pages(arena):
+    # Keeps the arena out of swap. Fails without privileges once
+    # RLIMIT_MEMLOCK is used up; the memory is then still usable, just not locked.
+    address, size = ctypes.c_void_p(_address(arena)), ctypes.c_size_t(len(arena))
+    try:
+        if platform.system() == "Windows":
+            return bool(ctypes.windll.kernel32.VirtualLock(address, size))
+        return ctypes.CDLL(None, use_errno=True).mlock(address, size) == 0
+    except (AttributeError, OSError):
+        return False
+
+class SecureBuffer:
+    # A slot of a locked arena. Use .view (a writable memoryview) wherever
+    # bytes are accepted; release() zeroes the whole slot and returns it to
+    # the pool.
+    def __init__(self, pool, slot, size):
+        self.view = slot[:size]
+        self._pool = pool
+        self._slot = slot
+
+    def __len__(self):
+        return len(self.view)
+
+    def wipe(self):
+        wipe(self._slot)
+
+    def release(self):
+        if self._pool is None:
+            return
+        wipe(self._slot)
+        self._pool._release(self._slot)
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class SecureMemoryPool:
+    # Slots of power-of-two sizes carved from mmap arenas that are locked
+    # and excluded from core dumps once, when the arena is created, so
+    # handing out a buffer per file or per key costs no system call.
+    def __init__(self, arena_size=ARENA_SIZE):
+        self.arena_size = arena_size
+        self.arenas = 0
+        self.locked_bytes = 0
+        self.unlocked_bytes = 0
+        self.in_use = 0
+        self._arenas = []
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def _slot_size(self, size):
+        slot_size = MIN_SLOT_SIZE
+        while slot_size < size:
+            slot_size *= 2
+        return slot_size
+
+    def _grow(self, slot_size):
+        arena_size = max(self.arena_size, -(-slot_size // mmap.PAGESIZE) * mmap.PAGESIZE)
+        arena = mmap.mmap(-1, arena_size)
+        if hasattr(mmap, 'MADV_DONTDUMP'):
+            arena.madvise(mmap.MADV_DONTDUMP)
+        if _lock_pages(arena):
+            self.locked_bytes += arena_size
+        else:
+            self.unlocked_bytes += arena_size
+        self.arenas += 1
+        self._arenas.append(arena)
+        view = memoryview(arena)
+        return [view[offset:offset + slot_size] for offset in range(0, arena_size - slot_size + 1, slot_size)]
+
+    def allocate(self, size):
+        slot_size = self._slot_size(max(size, 1))
+        with self._lock:
+            free = self._free.setdefault(slot_size, [])
+            if not free:
+                free.extend(self._grow(slot_size))
+            slot = free.pop()
+            self.in_use += 1
+        return SecureBuffer(self, slot, size)
+
+    def _release(self, slot):
+        with self._lock:
+            self._free[len(slot)].append(slot)
+            self.in_use -= 1
+
+    def wipe_all(self):
+        # At exit, for buffers nobody released: unmapping does not zero them.
+        with self._lock:
+            for arena in self._arenas:
+                wipe(arena)
+
+    def stats(self):
+        with self._lock:
+            return {'arenas': self.arenas, 'locked_bytes': self.locked_bytes,
+                    'unlocked_bytes': self.unlocked_bytes, 'in_use': self.in_use}
+
+_pool = None
+_pool_lock = threading.Lock()
+_random_fd = None
+
+def get_secure_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SecureMemoryPool()
+            atexit.register(_pool.wipe_all)
+        return _pool
+
+def secure_buffer(size):
+    return get_secure_pool().allocate(size)
+
+def secure_copy(data):
+    buffer = secure_buffer(len(data))
+    buffer.view[:] = data
+    return buffer
+
+def secure_text(text):
+    # The str itself is immutable and cannot be wiped; convert it once, as
+    # early as possible, and pass the buffer on instead.
+    return secure_copy(text.encode())
+
+def secure_random(size):
+    global _random_fd
+    buffer = secure_buffer(size)
+    if platform.system() == "Windows":
+        buffer.view[:] = os.urandom(size)
+        return buffer
+    # Read straight into the locked slot rather than through a bytes object.
+    with _pool_lock:
+        if _random_fd is None:
+            _random_fd = os.open("/dev/urandom", os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+    filled = 0
+    while filled < size:
+        filled += os.readv(_random_fd, [buffer.view[filled:]])
+    return buffer
+
+def derive_into(kdf, material, buffer):
+    # Recent cryptography releases write KDF output straight into the buffer.
+    if hasattr(kdf, 'derive_into'):
+        kdf.derive_into(material, buffer.view)
+    else:
+        buffer.view[:] = kdf.derive(bytes(material))
+
+def secret_bytes(secret):
+    # Passwords and keys may be given as str, bytes or SecureBuffer.
+    if isinstance(secret, SecureBuffer):
+        return secret.view
+    if isinstance(secret, str):
+        return secret.encode()
+    return secret
\ No newline at end of file
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import json
+import platform
+from pathlib import Path
+from io_throttle import IOThrottle, IO_PRIORITIES, MIB, get_shared_throttle
+
+SETTINGS_FILE = Path(__file__).parent / "settings.json"
+
+def get_cryptodisk_folder():
+    desktop = Path.home() / "Desktop"
+    if not desktop.exists() and platform.system() != "Windows":
+        desktop = Path.home()
+    cryptodisk_folder = desktop / "CryptoDisk"
+    cryptodisk_folder.mkdir(exist_ok=True)
+    return cryptodisk_folder
+
+def load_settings(settings_file=SETTINGS_FILE):
+    try:
+        with open(settings_file, 'r') as f:
+            settings = json.load(f)
+            if isinstance(settings, dict):
+                return settings
+    except:
+        pass
+    return {}
+
+def save_settings(updates, settings_file=SETTINGS_FILE):
+    settings = load_settings(settings_file)
+    settings.update(updates)
+    with open(settings_file, 'w') as f:
+        json.dump(settings, f, indent=2)
+    return settings
+
+def configure_secure_delete(secure_delete, settings):
+    secure_delete.set_methods(
+        gutmann=settings.get('gutmann', True),
+        dod=settings.get('dod', True),
+        nist=settings.get('nist', True)
+    )
+    try:
+        secure_delete.set_verification(settings.get('verify_mode'), settings.get('verify_samples', 64))
+    except ValueError as e:
+        print(f"Ignoring invalid verify_mode in settings: {e}")
+    policy = settings.get('overwrite_policy')
+    if policy:
+        try:
+            secure_delete.set_policy(policy)
+        except ValueError as e:
+            print(f"Ignoring invalid overwrite_policy in settings: {e}")
+    secure_delete.throttle = io_throttle_for(settings)
+    priority = settings.get('io_priority')
+    if priority is not None and priority not in IO_PRIORITIES:
+        print(f"Ignoring invalid io_priority in settings: {priority}")
+        priority = None
+    secure_delete.io_priority = priority
+
+def io_throttle_for(settings, rate_limit=None, iops_limit=None):
+    # rate_limit is in MiB/s. The global limits are shared by every worker in
+    # the process; per-job limits stack on top, so a job can only be slower.
+    global_rate = settings.get('rate_limit')
+    throttle = get_shared_throttle(int(global_rate * MIB) if global_rate else None, settings.get('iops_limit'))
+    if rate_limit or iops_limit:
+        throttle = IOThrottle(int(rate_limit * MIB) if rate_limit else None, iops_limit, parent=throttle)
+    return throttle
+
+def configure_crypto_engine(crypto, settings):
+    def secure_delete_factory():
+        from secure_delete import SecureDelete
+        secure_delete = SecureDelete()
+        configure_secure_delete(secure_delete, settings)
+        return secure_delete
+    crypto.secure_delete_factory = secure_delete_factory
+    crypto.cipher_name = settings.get('cipher', 'auto')
+    crypto.max_buffers = settings.get('buffer_pool_size', crypto.max_buffers)
+    compression = settings.get('compression')
+    if compression and compression != 'off':
+        try:
+            from compression import get_compressor
+            get_compressor(compression, settings.get('compression_level'))
+            crypto.compression = compression
+            crypto.compression_level = settings.get('compression_level')
+        except ValueError as e:
+            print(f"Ignoring invalid compression in settings: {e}")
+    else:
+        crypto.compression = None
+    if settings.get('dedup'):
+        if crypto.dedup_store is None:
+            import sqlite3
+            from dedup_store import store_for_vault
+            try:
+                crypto.dedup_store = store_for_vault(get_cryptodisk_folder())
+            except (OSError, sqlite3.Error) as e:
+                print(f"Deduplication disabled: {e}")
+    else:
+        crypto.dedup_store = None
+    if settings.get('chunk_size'):
+        try:
+            crypto.set_chunk_size(settings['chunk_size'])
+        except ValueError as e:
+            print(f"Ignoring invalid chunk_size in settings: {e}")
+    recipients = []
+    for path in settings.get('recipients') or []:
+        from key_slots import load_public_key
+        try:
+            recipients.append(load_public_key(path))
+        except (OSError, ValueError) as e:
+            print(f"Ignoring recipient key in settings: {e}")
+    crypto.recipients = recipients
+    if 'block_cache_size' in settings:
+        from block_cache import get_block_cache
+        crypto.block_cache = get_block_cache(settings['block_cache_size'])
+
+def secure_delete_settings(secure_delete):
+    return {
+        'gutmann': secure_delete.use_gutmann,
+        'dod': secure_delete.use_dod,
+        'nist': secure_delete.use_nist,
+        'overwrite_policy': secure_delete.policy,
+        'verify_mode': secure_delete.verify_mode,
+        'verify_samples': secure_delete.verify_samples
+    }
\ No newline at end of file
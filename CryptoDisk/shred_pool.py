@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import os
+import platform
+import queue
+import threading
+from pathlib import Path
+
+_STOP = object()
+
+def get_device_workers(device, default=2):
+    if platform.system() != "Linux":
+        return default
+    major, minor = os.major(device), os.minor(device)
+    block_dir = Path(f"/sys/dev/block/{major}:{minor}")
+    # Partitions have no queue/ of their own, the parent disk does.
+    for candidate in (block_dir / "queue" / "rotational", block_dir / ".." / "queue" / "rotational"):
+        try:
+            rotational = candidate.read_text().strip()
+        except OSError:
+            continue
+        return 1 if rotational == "1" else 4
+    return default
+
+class ShredPool:
+    def __init__(self, secure_delete_factory, max_workers=8, workers_per_device=None,
+                 queue_size=256, progress=None, batch_size=64):
+        self.secure_delete_factory = secure_delete_factory
+        self.max_workers = max_workers
+        self.workers_per_device = workers_per_device
+        self.queue_size = queue_size
+        self.progress = progress
+        self.batch_size = batch_size
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.directory_syncs = 0
+        self.syscalls = {}
+        self._devices = {}
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _device_queue(self, device):
+        device_queue = self._devices.get(device)
+        if device_queue is not None:
+            return device_queue
+
+        device_queue = queue.Queue(maxsize=self.queue_size)
+        self._devices[device] = device_queue
+        workers = self.workers_per_device
+        if not workers:
+            workers = get_device_workers(device) if device is not None else 2
+        workers = max(1, min(workers, self.max_workers - len(self._threads)))
+        for _ in range(workers):
+            thread = threading.Thread(target=self._worker, args=(device_queue,), daemon=True)
+            thread.start()
+            self._threads.append((thread, device_queue))
+        return device_queue
+
+    def submit(self, path):
+        path = Path(path)
+        try:
+            device = path.lstat().st_dev
+        except OSError:
+            device = None
+        self.submitted += 1
+        # put() blocks once a device queue is full, which keeps memory bounded
+        # however many paths the caller streams in.
+        self._device_queue(device).put(path)
+
+    def _next_batch(self, device_queue):
+        # Whatever is already queued, up to batch_size, without waiting for more.
+        batch = [device_queue.get()]
+        while batch[-1] is not _STOP and len(batch) < self.batch_size:
+            try:
+                batch.append(device_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self, device_queue):
+        secure_delete = self.secure_delete_factory()
+        while True:
+            batch = self._next_batch(device_queue)
+            results = []
+            # Files of a batch share one fsync per parent directory, so they are
+            # reported once the batch, renames and unlinks included, is durable.
+            with secure_delete.batch():
+                for path in batch:
+                    if path is _STOP:
+                        break
+                    success = False
+                    try:
+                        success = secure_delete.secure_delete_file(str(path))
+                    except Exception as e:
+                        print(f"Error deleting {path}: {e}")
+                    results.append((path, success, secure_delete.get_last_report()))
+            for path, success, report in results:
+                with self._lock:
+                    if success:
+                        self.completed += 1
+                        self.bytes_written += report.get('bytes_written', 0)
+                        for call, count in report.get('syscalls', {}).items():
+                            self.syscalls[call] = self.syscalls.get(call, 0) + count
+                    else:
+                        self.failed += 1
+                    done = self.completed + self.failed
+                if self.progress is not None:
+                    self.progress(done, self.submitted, path, success)
+            with self._lock:
+                self.directory_syncs += secure_delete.last_batch.get('directories', 0)
+                self.syscalls['dir_sync'] = self.syscalls.get('dir_sync', 0) + \
+                    secure_delete.last_batch.get('directory_syscalls', 0)
+            if batch[-1] is _STOP:
+                return
+
+    def join(self):
+        for _, device_queue in self._threads:
+            device_queue.put(_STOP)
+        for thread, _ in self._threads:
+            thread.join()
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'bytes_written': self.bytes_written,
+            'devices': len(self._devices),
+            'directory_syncs': self.directory_syncs,
+            'syscalls': dict(self.syscalls)
+        }
\ No newline at end of file
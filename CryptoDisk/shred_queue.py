@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from processes import process_alive
+
+DEFAULT_QUEUE_FILE = Path(__file__).parent / "shred_queue.sqlite3"
+DEFAULT_BATCH_SIZE = 100
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 15 * 60
+
+# Windows use the five cron fields: minute hour day-of-month month day-of-week
+# (0 or 7 = Sunday). Shredding may run during any minute a rule matches, so
+# "* 22-23,0-5 * * 1-5" is weekday nights and "* * * * 0,6" whole weekends.
+CRON_FIELDS = [('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7)]
+
+def _parse_field(text, low, high):
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError(f"Invalid step in '{text}'")
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(value) for value in part.split('-', 1))
+        else:
+            start = end = int(part)
+        if not low <= start <= end <= high:
+            raise ValueError(f"'{text}' is outside {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+class ShredWindow:
+    def __init__(self, rule):
+        fields = rule.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f"Shred window '{rule}' needs 5 cron fields: minute hour day month weekday")
+        self.rule = rule
+        try:
+            parsed = [_parse_field(field, low, high) for field, (_, low, high) in zip(fields, CRON_FIELDS)]
+        except ValueError as e:
+            raise ValueError(f"Invalid shred window '{rule}': {e}")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = parsed
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+
+    def matches(self, moment):
+        return (moment.minute in self.minutes and moment.hour in self.hours and moment.day in self.days
+                and moment.month in self.months and (moment.weekday() + 1) % 7 in self.weekdays)
+
+def parse_windows(rules):
+    return [ShredWindow(rule) for rule in rules or []]
+
+def window_open(windows, moment=None):
+    # No windows configured means shredding may run at any time.
+    if not windows:
+        return True
+    moment = moment or datetime.now()
+    return any(window.matches(moment) for window in windows)
+
+def next_window_start(windows, moment=None):
+    moment = (moment or datetime.now()).replace(second=0, microsecond=0)
+    if window_open(windows, moment):
+        return moment
+    # Minute resolution over a bit more than a week covers every weekly rule.
+    for _ in range(8 * 24 * 60):
+        moment += timedelta(minutes=1)
+        if window_open(windows, moment):
+            return moment
+    return None
+
+class ShredQueue:
+    def __init__(self, queue_file=DEFAULT_QUEUE_FILE):
+        self.queue_file = Path(queue_file)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.queue_file), check_same_thread=False, timeout=30)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS queue (path TEXT PRIMARY KEY, device INTEGER, size INTEGER,
+                                              queued REAL, due REAL, state TEXT, attempts INTEGER,
+                                              error TEXT);
+            CREATE INDEX IF NOT EXISTS queue_due ON queue (state, due);
+        """)
+        # Queues created before claimed items recorded the claiming process.
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(queue)")}
+        if 'owner' not in columns:
+            with self._db:
+                self._db.execute("ALTER TABLE queue ADD COLUMN owner INTEGER")
+
+    def add(self, paths, due=None):
+        due = time.time() if due is None else due
+        rows = []
+        for path in paths:
+            path = Path(path).absolute()
+            try:
+                stat = path.lstat()
+            except OSError:
+                continue
+            rows.append((str(path), stat.st_dev, stat.st_size, time.time(), due))
+        # A path that is already queued keeps the earlier of its two deadlines.
+        with self._lock, self._db:
+            before = self._db.total_changes
+            self._db.executemany("""
+                INSERT INTO queue VALUES (?, ?, ?, ?, ?, 'pending', 0, NULL, NULL)
+                ON CONFLICT (path) DO UPDATE SET due = MIN(due, excluded.due)
+                WHERE state = 'pending'
+            """, rows)
+            return self._db.total_changes - before
+
+    def add_vault(self, vault_folder, retention):
+        # Every vault file expires retention seconds after it was written,
+        # whichever way it got into the vault.
+        with self._lock:
+            queued = {path for (path,) in self._db.execute("SELECT path FROM queue")}
+        added = 0
+        for path in Path(vault_folder).absolute().glob("*.crypted"):
+            if str(path) not in queued:
+                try:
+                    added += self.add([path], path.stat().st_mtime + retention)
+                except OSError:
+                    pass
+        return added
+
+    def recover(self):
+        # Items claimed by a process that stopped before finishing them. A
+        # timer run or daemon that is still working keeps its claims, so
+        # overlapping runs never shred the same file twice. Called before this
+        # process claims anything, so rows with its pid are from an earlier one.
+        with self._lock, self._db:
+            owners = [owner for (owner,) in self._db.execute(
+                "SELECT DISTINCT owner FROM queue WHERE state = 'running'")]
+            dead = [(owner,) for owner in owners
+                    if owner is None or owner == os.getpid() or not process_alive(owner)]
+            before = self._db.total_changes
+            self._db.executemany("UPDATE queue SET state = 'pending', owner = NULL "
+                                 "WHERE state = 'running' AND owner IS ?", dead)
+            return self._db.total_changes - before
+
+    def claim_batch(self, limit=DEFAULT_BATCH_SIZE, now=None):
+        # One batch holds due files of a single device, in path order, so a
+        # run works through one disk at a time with directory locality.
+        now = time.time() if now is None else now
+        with self._lock, self._db:
+            while True:
+                row = self._db.execute("SELECT device FROM queue WHERE state = 'pending' AND due <= ? "
+                                       "ORDER BY due LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return []
+                paths = [path for (path,) in self._db.execute(
+                    "SELECT path FROM queue WHERE state = 'pending' AND due <= ? AND device = ? "
+                    "ORDER BY path LIMIT ?", (now, row[0], limit))]
+                gone = [path for path in paths if not os.path.lexists(path)]
+                if gone:
+                    self._db.executemany("DELETE FROM queue WHERE path = ?", [(path,) for path in gone])
+                paths = [path for path in paths if path not in gone]
+                if paths:
+                    self._db.executemany("UPDATE queue SET state = 'running', owner = ? WHERE path = ?",
+                                         [(os.getpid(), path) for path in paths])
+                    return paths
+
+    def finish(self, path, success, error=None):
+        with self._lock, self._db:
+            if success or not os.path.lexists(path):
+                self._db.execute("DELETE FROM queue WHERE path = ?", (str(path),))
+                return
+            # Failed items are retried later, then kept as 'failed' for --queue.
+            self._db.execute("""
+                UPDATE queue SET attempts = attempts + 1, error = ?,
+                    state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, due = ?, owner = NULL
+                WHERE path = ?
+            """, (error, MAX_ATTEMPTS, time.time() + RETRY_DELAY, str(path)))
+
+    def remove(self, state=None):
+        with self._lock, self._db:
+            if state is None:
+                return self._db.execute("DELETE FROM queue").rowcount
+            return self._db.execute("DELETE FROM queue WHERE state = ?", (state,)).rowcount
+
+    def stats(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            states = dict(self._db.execute("SELECT state, COUNT(*) FROM queue GROUP BY state"))
+            due, due_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM queue "
+                                              "WHERE state = 'pending' AND due <= ?", (now,)).fetchone()
+            next_due = self._db.execute("SELECT MIN(due) FROM queue WHERE state = 'pending'").fetchone()[0]
+            devices = self._db.execute("SELECT device, COUNT(*), COALESCE(SUM(size), 0) FROM queue "
+                                       "WHERE state = 'pending' GROUP BY device").fetchall()
+            failed = self._db.execute("SELECT path, error FROM queue WHERE state = 'failed' "
+                                      "ORDER BY path LIMIT 20").fetchall()
+        return {
+            'pending': states.get('pending', 0),
+            'running': states.get('running', 0),
+            'failed': states.get('failed', 0),
+            'due': due,
+            'due_bytes': due_bytes,
+            'next_due': next_due,
+            'devices': [{'device': device, 'files': files, 'bytes': size} for device, files, size in devices],
+            'failed_files': [{'path': path, 'error': error} for path, error in failed]
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def queue_status(shred_queue, windows):
+    status = shred_queue.stats()
+    if windows is None:
+        status['window'] = 'paused (invalid shred_windows)'
+        return status
+    status['window'] = 'open' if window_open(windows) else 'closed'
+    start = next_window_start(windows)
+    status['next_window'] = start.isoformat(timespec='minutes') if start else None
+    return status
\ No newline at end of file
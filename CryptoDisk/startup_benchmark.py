@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+APP_DIR = Path(__file__).parent
+FORBIDDEN_MODULES = ('tkinter', 'tkinterdnd2', 'watchdog', 'cryptography', 'http.server')
+
+def run_delete(work_dir, importtime=False):
+    target = Path(work_dir) / f"sample-{time.perf_counter_ns()}.bin"
+    target.write_bytes(os.urandom(4096))
+
+    # Point the control socket at an empty directory so a running daemon
+    # doesn't turn the measurement into a socket round trip.
+    env = dict(os.environ, XDG_RUNTIME_DIR=str(work_dir), PYTHONDONTWRITEBYTECODE='1')
+    env.pop('CRYPTODISK_PROFILE', None)
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += [str(APP_DIR / "cli.py"), '--delete', str(target)]
+
+    started = time.perf_counter()
+    result = subprocess.run(command, env=env, cwd=work_dir, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+
+    if target.exists():
+        raise RuntimeError(f"--delete left {target} behind: {result.stderr.strip()}")
+    return elapsed, result.stderr
+
+def parse_importtime(output):
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start benchmark for the --delete entry point')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=150.0,
+                        help='Fail if the median wall time of a right-click delete exceeds this')
+    parser.add_argument('--top', type=int, default=10, help='Show the N slowest imports')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        run_delete(work_dir)
+        timings = [run_delete(work_dir)[0] for _ in range(args.runs)]
+        _, importtime_output = run_delete(work_dir, importtime=True)
+
+    modules = parse_importtime(importtime_output)
+    loaded_forbidden = [name for name in modules
+                        if any(name == forbidden or name.startswith(forbidden + '.') for forbidden in FORBIDDEN_MODULES)]
+    median_ms = statistics.median(timings) * 1000
+
+    print(f"--delete cold start: median {median_ms:.1f} ms, min {min(timings) * 1000:.1f} ms "
+          f"over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+    print("Slowest imports (cumulative):")
+    for name, cumulative in sorted(modules.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if loaded_forbidden:
+        print(f"FAIL: --delete imported {', '.join(sorted(loaded_forbidden))}")
+        failed = True
+    if median_ms > args.budget_ms:
+        print("FAIL: cold start is over budget")
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import errno
+import itertools
+import os
+import stat
+import threading
+import time
+from pathlib import Path
+from key_slots import KeyCache
+
+try:
+    from fuse import FUSE, FuseOSError, Operations
+except (ImportError, OSError):
+    # fusepy (and libfuse) are optional: without them there is no --mount.
+    FUSE, FuseOSError, Operations = None, OSError, object
+
+# How long a directory listing is trusted before the vault is scanned again.
+REFRESH_INTERVAL = 2.0
+
+class VaultView(Operations):
+    # Read-only view of the vault: every .crypted file the password or the
+    # identities open appears under its original name, and reads decrypt
+    # only the segments they touch, in memory.
+    def __init__(self, crypto, vault_folder, password=None):
+        self.crypto = crypto
+        self.vault_folder = Path(vault_folder)
+        self.password = password
+        # Re-opening a file for every open() would otherwise rerun the KDF.
+        if self.crypto.key_cache is None:
+            self.crypto.key_cache = KeyCache()
+        self._files = {}
+        self._entries = {}
+        self._refreshed = None
+        self._readers = {}
+        self._handles = itertools.count(1)
+        self._lock = threading.Lock()
+        # One scan at a time; lookups keep using the last listing meanwhile.
+        self._refresh_lock = threading.Lock()
+        self._started = time.time()
+
+    def _describe(self, path, stat_result, key):
+        try:
+            reader = self.crypto.open_reader(path, self.password)
+        except (OSError, ValueError, KeyError):
+            # Not ours to open, legacy, or corrupted: left out of the view,
+            # and not tried again until the file changes.
+            return {'name': None, 'key': key}
+        try:
+            try:
+                mtime = float(reader.metadata.get('timestamp'))
+            except (TypeError, ValueError):
+                mtime = stat_result.st_mtime
+            return {'name': Path(reader.metadata.get('original_name') or path.stem).name,
+                    'size': reader.size, 'mtime': mtime, 'key': key}
+        finally:
+            reader.close()
+
+    def _refresh(self, wait=True):
+        # Opening a new file costs the KDF, so files are described outside
+        # self._lock: reads and lookups of known files never wait for a scan.
+        if self._refreshed is not None and time.monotonic() - self._refreshed < REFRESH_INTERVAL:
+            return
+        if not self._refresh_lock.acquire(blocking=wait or self._refreshed is None):
+            return
+        try:
+            if self._refreshed is not None and time.monotonic() - self._refreshed < REFRESH_INTERVAL:
+                return
+            known_files = self._files
+            files = {}
+            for path in sorted(self.vault_folder.glob("*.crypted")):
+                if path.name.startswith('.'):
+                    continue
+                try:
+                    stat_result = path.stat()
+                except OSError:
+                    continue
+                known = known_files.get(path)
+                key = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+                files[path] = known if known is not None and known['key'] == key else \
+                    self._describe(path, stat_result, key)
+            entries = {}
+            for path, info in files.items():
+                if info['name'] is None:
+                    continue
+                name = info['name']
+                if name in entries:
+                    # Two vault files with the same original name.
+                    name = f"{Path(name).stem} ({path.stem}){Path(name).suffix}"
+                entries[name] = (path, info)
+            with self._lock:
+                self._files = files
+                self._entries = entries
+                self._refreshed = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def _lookup(self, path):
+        # Known names are served from the last listing; only a name not in
+        # it rescans, at most once per REFRESH_INTERVAL, so a missing name is
+        # not looked for again on every getattr.
+        entry = self._entries.get(path.lstrip('/'))
+        if entry is None:
+            self._refresh()
+            entry = self._entries.get(path.lstrip('/'))
+        if entry is None:
+            raise FuseOSError(errno.ENOENT)
+        return entry
+
+    def getattr(self, path, fh=None):
+        if path == '/':
+            return {'st_mode': stat.S_IFDIR | 0o500, 'st_nlink': 2, 'st_uid': os.getuid(),
+                    'st_gid': os.getgid(), 'st_mtime': self._started, 'st_ctime': self._started,
+                    'st_atime': self._started}
+        _, info = self._lookup(path)
+        return {'st_mode': stat.S_IFREG | 0o400, 'st_nlink': 1, 'st_size': info['size'],
+                'st_uid': os.getuid(), 'st_gid': os.getgid(), 'st_mtime': info['mtime'],
+                'st_ctime': info['mtime'], 'st_atime': info['mtime']}
+
+    def readdir(self, path, fh):
+        if path != '/':
+            raise FuseOSError(errno.ENOTDIR)
+        # A rescan already running elsewhere is not waited for.
+        self._refresh(wait=False)
+        return ['.', '..'] + sorted(self._entries)
+
+    def open(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_TRUNC):
+            raise FuseOSError(errno.EROFS)
+        vault_path, _ = self._lookup(path)
+        try:
+            reader = self.crypto.open_reader(vault_path, self.password)
+        except FileNotFoundError:
+            # Removed from the vault since the last listing.
+            raise FuseOSError(errno.ENOENT)
+        except (OSError, ValueError, KeyError):
+            raise FuseOSError(errno.EIO)
+        with self._lock:
+            handle = next(self._handles)
+            self._readers[handle] = reader
+        return handle
+
+    def read(self, path, size, offset, fh):
+        reader = self._readers.get(fh)
+        if reader is None:
+            raise FuseOSError(errno.EBADF)
+        try:
+            return reader.read(offset, size)
+        except (OSError, ValueError) as e:
+            print(f"Read of {path} failed: {e}")
+            raise FuseOSError(errno.EIO)
+
+    def release(self, path, fh):
+        with self._lock:
+            reader = self._readers.pop(fh, None)
+        if reader is not None:
+            reader.close()
+        return 0
+
+    def statfs(self, path):
+        return {'f_bsize': 4096, 'f_frsize': 4096, 'f_namemax': 255}
+
+    def destroy(self, path):
+        with self._lock:
+            readers = list(self._readers.values())
+            self._readers.clear()
+        for reader in readers:
+            reader.close()
+        self.crypto.key_cache.clear()
+        if self.crypto.block_cache is not None:
+            self.crypto.block_cache.clear()
+
+def mount_vault(crypto, vault_folder, mountpoint, password=None, foreground=True):
+    if FUSE is None:
+        raise RuntimeError("Mounting the vault needs fusepy (pip install fusepy) and libfuse")
+    # Blocks until the view is unmounted.
+    print(f"Mounting {vault_folder} read-only on {mountpoint}; unmount with fusermount -u or Ctrl+C")
+    FUSE(VaultView(crypto, vault_folder, password), str(mountpoint), foreground=foreground, ro=True,
+         nothreads=False, fsname='cryptodisk', default_permissions=True)
\ No newline at end of file
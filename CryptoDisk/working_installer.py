@@ -150,7 +150,12 @@ WHAT WILL BE INSTALLED:
             print(f"Install directory: {self.install_dir}")
             
             self.update_status("Copying application files...")
-            required_files = ["main.py", "crypto_engine.py", "secure_delete.py", "context_menu.py"]
+            required_files = ["main.py", "crypto_engine.py", "secure_delete.py", "context_menu.py",
+                              "overwrite_policy.py", "settings.py", "audit_log.py",
+                              "metrics.py", "profiler.py", "daemon.py",
+                              "control.py", "cli.py", "shred_pool.py", "ciphers.py",
+                              "buffer_pool.py", "compression.py",
+                              "dedup_store.py", "free_space_wipe.py", "io_throttle.py", "shred_queue.py", "random_names.py", "key_slots.py", "rekey.py", "vault_mount.py", "block_cache.py", "secure_memory.py", "processes.py"]
             
             copied_files = []
             for filename in required_files:
@@ -348,7 +353,7 @@ StartupNotify=true
                 pythonw_exe = Path(sys.executable).parent / "pythonw.exe"
                 python_path = str(pythonw_exe) if pythonw_exe.exists() else sys.executable
                 
-                script_path = self.install_dir / "main.py"
+                script_path = self.install_dir / "cli.py"
                 icon_path = self.install_dir / "icon.ico"
                 
                 key_path = r"*\shell\CryptoDisk"
@@ -386,7 +391,7 @@ Icon={icon_path}
 Profiles=profile-zero;
 
 [X-Action-Profile profile-zero]
-Exec={sys.executable} {self.install_dir / "main.py"} --delete %f
+Exec={sys.executable} {self.install_dir / "cli.py"} --delete %F
 MimeTypes=application/octet-stream;text/plain;image/jpeg;image/png;video/mp4;audio/mpeg;application/pdf;text/html;
 """
 
@@ -403,10 +408,7 @@ MimeTypes=application/octet-stream;text/plain;image/jpeg;image/png;video/mp4;aud
                 desktop_file_path.chmod(0o755)
                 
                 nautilus_script_content = f"""#!/bin/bash
-for file in "$@"; do
-    "{sys.executable}" "{self.install_dir / "main.py"}" --delete "$file" &
-done
-wait
+exec "{sys.executable}" "{self.install_dir / "cli.py"}" --delete "$@"
 """
                 
                 nautilus_script_path = nautilus_scripts_dir / "Delete with CryptoDisk"
@@ -430,7 +432,7 @@ wait
             startup_key = r"SOFTWARE\Microsoft\Windows\CurrentVersion\Run"
             
             with reg.OpenKey(reg.HKEY_CURRENT_USER, startup_key, 0, reg.KEY_SET_VALUE) as key:
-                startup_command = f'"{sys.executable}" "{self.install_dir / "main.py"}" --background'
+                startup_command = f'"{sys.executable}" "{self.install_dir / "cli.py"}" --background'
                 reg.SetValueEx(key, "CryptoDisk", 0, reg.REG_SZ, startup_command)
             
             print("Startup registry entry created")
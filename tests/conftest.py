@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules import each other by their plain names, as when run from CryptoDisk/.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "CryptoDisk"))
\ No newline at end of file
@@ -0,0 +1,197 @@
+import json
+import os
+import secrets
+
+import pytest
+
+from crypto_engine import (CryptoEngine, IntegrityError, MAGIC, FINAL_SEGMENT, HEADER_MAC_SIZE,
+                           METADATA_INDEX, PASSWORD_HEADER_VERSION, TRAILER_INDEX)
+from key_slots import MAX_ITERATIONS
+
+PASSWORD = "correct horse"
+
+@pytest.fixture
+def engine():
+    crypto = CryptoEngine()
+    # The format does not depend on the cost; the tests do.
+    crypto.iterations = 1000
+    crypto.set_chunk_size(4096)
+    return crypto
+
+def encrypt(engine, tmp_path, data, name="plain.bin"):
+    source = tmp_path / name
+    source.write_bytes(data)
+    target = tmp_path / "file.crypted"
+    engine.encrypt_file(str(source), str(target), PASSWORD)
+    return target
+
+def segments(data):
+    # (offset, length field, sealed size) of every segment after the header MAC.
+    header_size = int.from_bytes(data[4:8], 'big')
+    offset = 8 + header_size
+    header = json.loads(data[8:offset])
+    if header['version'] != PASSWORD_HEADER_VERSION:
+        offset += 4 + int.from_bytes(data[offset:offset + 4], 'big')
+    offset += HEADER_MAC_SIZE
+    found = []
+    while offset < len(data):
+        field = int.from_bytes(data[offset:offset + 4], 'big')
+        size = field & ~FINAL_SEGMENT
+        found.append((offset, field, size))
+        offset += 4 + size
+    return found
+
+def assert_rejected(engine, tmp_path, encrypted):
+    output = tmp_path / "out.bin"
+    with pytest.raises(IntegrityError):
+        engine.decrypt_file(str(encrypted), str(output), PASSWORD)
+    # Nothing decrypted from a rejected file is left behind, not even hidden.
+    assert not output.exists()
+    assert not [path for path in tmp_path.iterdir() if path.name.startswith('.')]
+
+@pytest.mark.parametrize('size', [0, 1, 4095, 4096, 4097, 3 * 4096 + 17])
+def test_round_trip(engine, tmp_path, size):
+    data = os.urandom(size)
+    encrypted = encrypt(engine, tmp_path, data)
+    assert encrypted.read_bytes().startswith(MAGIC)
+    metadata = engine.decrypt_file(str(encrypted), str(tmp_path / "out.bin"), PASSWORD)
+    assert (tmp_path / "out.bin").read_bytes() == data
+    assert metadata['original_name'] == "plain.bin"
+
+def test_round_trip_compressed(engine, tmp_path):
+    engine.compression = 'zlib'
+    data = b"compressible " * 5000
+    encrypted = encrypt(engine, tmp_path, data)
+    assert json.loads(encrypted.read_bytes()[8:8 + int.from_bytes(encrypted.read_bytes()[4:8], 'big')]).get('compression')
+    engine.decrypt_file(str(encrypted), str(tmp_path / "out.bin"), PASSWORD)
+    assert (tmp_path / "out.bin").read_bytes() == data
+
+def test_wrong_password(engine, tmp_path):
+    encrypted = encrypt(engine, tmp_path, b"secret")
+    with pytest.raises(IntegrityError):
+        engine.decrypt_file(str(encrypted), str(tmp_path / "out.bin"), "wrong")
+    assert not (tmp_path / "out.bin").exists()
+
+def test_tampered_header_is_rejected(engine, tmp_path):
+    encrypted = encrypt(engine, tmp_path, os.urandom(10000))
+    data = encrypted.read_bytes()
+    tampered = data.replace(b'"chunk_size": 4096', b'"chunk_size": 8192', 1)
+    assert tampered != data
+    encrypted.write_bytes(tampered)
+    assert_rejected(engine, tmp_path, encrypted)
+
+def test_tampered_key_slot_is_rejected(engine, tmp_path):
+    encrypted = encrypt(engine, tmp_path, os.urandom(10000))
+    data = bytearray(encrypted.read_bytes())
+    slots_at = 8 + int.from_bytes(data[4:8], 'big') + 4
+    data[data.index(b'"salt"', slots_at) + 10] ^= 1
+    encrypted.write_bytes(bytes(data))
+    assert_rejected(engine, tmp_path, encrypted)
+
+def test_tampered_header_mac_is_rejected(engine, tmp_path):
+    encrypted = encrypt(engine, tmp_path, os.urandom(10000))
+    data = bytearray(encrypted.read_bytes())
+    metadata_at = segments(bytes(data))[0][0]
+    data[metadata_at - 1] ^= 1
+    encrypted.write_bytes(bytes(data))
+    assert_rejected(engine, tmp_path, encrypted)
+
+@pytest.mark.parametrize('which', ['metadata', 'first', 'last', 'trailer'])
+def test_tampered_segment_is_rejected(engine, tmp_path, which):
+    encrypted = encrypt(engine, tmp_path, os.urandom(3 * 4096 + 100))
+    data = bytearray(encrypted.read_bytes())
+    found = segments(bytes(data))
+    offset, _, size = {'metadata': found[0], 'first': found[1], 'last': found[-2], 'trailer': found[-1]}[which]
+    data[offset + 4 + size // 2] ^= 0x40
+    encrypted.write_bytes(bytes(data))
+    assert_rejected(engine, tmp_path, encrypted)
+
+def test_reordered_segments_are_rejected(engine, tmp_path):
+    encrypted = encrypt(engine, tmp_path, os.urandom(3 * 4096 + 100))
+    data = encrypted.read_bytes()
+    found = segments(data)
+    (first, _, size), (second, _, _) = found[1], found[2]
+    chunk = 4 + size
+    swapped = data[:first] + data[second:second + chunk] + data[first:first + chunk] + data[second + chunk:]
+    encrypted.write_bytes(swapped)
+    assert_rejected(engine, tmp_path, encrypted)
+
+def test_cleared_final_flag_is_rejected(engine, tmp_path):
+    encrypted = encrypt(engine, tmp_path, os.urandom(2 * 4096 + 100))
+    data = bytearray(encrypted.read_bytes())
+    offset, field, _ = segments(bytes(data))[-2]
+    assert field & FINAL_SEGMENT
+    data[offset:offset + 4] = (field & ~FINAL_SEGMENT).to_bytes(4, 'big')
+    encrypted.write_bytes(bytes(data))
+    assert_rejected(engine, tmp_path, encrypted)
+
+@pytest.mark.parametrize('cut', ['trailer', 'last_segment', 'one_byte'])
+def test_truncation_is_rejected(engine, tmp_path, cut):
+    encrypted = encrypt(engine, tmp_path, os.urandom(3 * 4096 + 100))
+    data = encrypted.read_bytes()
+    found = segments(data)
+    end = {'trailer': found[-1][0], 'last_segment': found[-2][0], 'one_byte': len(data) - 1}[cut]
+    encrypted.write_bytes(data[:end])
+    assert_rejected(engine, tmp_path, encrypted)
+
+def test_appended_data_is_rejected(engine, tmp_path):
+    encrypted = encrypt(engine, tmp_path, os.urandom(5000))
+    encrypted.write_bytes(encrypted.read_bytes() + b"\0")
+    assert_rejected(engine, tmp_path, encrypted)
+
+def write_v2(engine, path, data, iterations=1000):
+    # Password containers as written before key slots: the PBKDF2 salt and
+    # iteration count are in the header itself.
+    from ciphers import get_cipher
+    prefix = secrets.token_bytes(8)
+    header = {'version': PASSWORD_HEADER_VERSION, 'cipher': engine.get_cipher_name(), 'nonce': prefix.hex(),
+              'chunk_size': 4096, 'salt': secrets.token_hex(16), 'iterations': iterations}
+    header_json = json.dumps(header).encode()
+    header_bytes = MAGIC + len(header_json).to_bytes(4, 'big') + header_json
+    with engine._derive_keys(PASSWORD, header) as subkeys:
+        cipher = get_cipher(header['cipher'])(subkeys.view[:32])
+        mac = engine._header_mac(subkeys.view[32:], header_bytes)
+    with open(path, 'wb') as f:
+        f.write(header_bytes)
+        f.write(mac)
+        metadata = {'original_name': 'old.bin', 'original_size': len(data)}
+        engine._write_segment(f, cipher, prefix, METADATA_INDEX, json.dumps(metadata).encode(), header_bytes)
+        pieces = [data[start:start + 4096] for start in range(0, len(data), 4096)]
+        if not pieces or len(pieces[-1]) == 4096:
+            pieces.append(b'')
+        for index, piece in enumerate(pieces):
+            engine._write_segment(f, cipher, prefix, index, piece, final=index == len(pieces) - 1)
+        trailer = json.dumps({'original_size': len(data), 'segments': len(pieces)}).encode()
+        engine._write_segment(f, cipher, prefix, TRAILER_INDEX, trailer)
+
+def test_v2_round_trip(engine, tmp_path):
+    data = os.urandom(9000)
+    write_v2(engine, tmp_path / "old.crypted", data)
+    metadata = engine.decrypt_file(str(tmp_path / "old.crypted"), str(tmp_path / "out.bin"), PASSWORD)
+    assert (tmp_path / "out.bin").read_bytes() == data
+    assert metadata['original_name'] == "old.bin"
+
+def test_v2_tampered_segment_is_rejected(engine, tmp_path):
+    write_v2(engine, tmp_path / "old.crypted", os.urandom(9000))
+    encrypted = tmp_path / "old.crypted"
+    data = bytearray(encrypted.read_bytes())
+    offset, _, size = segments(bytes(data))[1]
+    data[offset + 4 + size // 2] ^= 1
+    encrypted.write_bytes(bytes(data))
+    assert_rejected(engine, tmp_path, encrypted)
+
+def test_v2_excessive_iterations_are_rejected(engine, tmp_path):
+    # Checked before the KDF runs, since the header is not authenticated yet.
+    write_v2(engine, tmp_path / "old.crypted", b"data")
+    encrypted = tmp_path / "old.crypted"
+    data = encrypted.read_bytes()
+    encrypted.write_bytes(data.replace(b'"iterations": 1000', b'"iterations": %d' % (MAX_ITERATIONS * 100), 1))
+    assert_rejected(engine, tmp_path, encrypted)
+
+def test_password_slot_with_excessive_iterations_is_rejected(engine, tmp_path):
+    encrypted = encrypt(engine, tmp_path, b"data")
+    data = encrypted.read_bytes()
+    tampered = data.replace(b'"iterations": 1000', b'"iterations": %d' % (MAX_ITERATIONS * 100), 1)
+    assert tampered != data
+    encrypted.write_bytes(tampered)
+    assert_rejected(engine, tmp_path, encrypted)
\ No newline at end of file
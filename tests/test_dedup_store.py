@@ -0,0 +1,165 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from crypto_engine import CryptoEngine, IntegrityError
+from dedup_store import DELETED_LOG, DedupStore, format_recipe, parse_recipe
+from secure_delete import SecureDelete
+
+PASSWORD = "correct horse"
+
+@pytest.fixture
+def vault(tmp_path):
+    folder = tmp_path / "vault"
+    folder.mkdir()
+    return folder
+
+@pytest.fixture
+def store(vault, tmp_path):
+    store = DedupStore(vault / ".chunks", key_file=tmp_path / "dedup.key")
+    yield store
+    store.close()
+
+@pytest.fixture
+def engine(store):
+    crypto = CryptoEngine()
+    crypto.iterations = 1000
+    crypto.dedup_store = store
+    return crypto
+
+@pytest.fixture
+def shredder():
+    secure_delete = SecureDelete()
+    secure_delete.set_policy(['nist'])
+    return secure_delete
+
+def ingest(engine, vault, tmp_path, name, data):
+    source = tmp_path / f"{name}.plain"
+    source.write_bytes(data)
+    target = vault / f"{name}.crypted"
+    engine.encrypt_file(str(source), str(target), PASSWORD)
+    return target
+
+def decrypt(engine, encrypted, tmp_path):
+    output = tmp_path / "out.bin"
+    engine.decrypt_file(str(encrypted), str(output), PASSWORD)
+    return output.read_bytes()
+
+def chunk_files(store):
+    return sorted(path for path in store.root.rglob('*') if path.is_file() and path.parent != store.root)
+
+def test_recipe_format_round_trip():
+    recipe = [('aa' * 32, 100, 'bb' * 32), ('cc' * 32, 5, None)]
+    assert parse_recipe(format_recipe(recipe)) == recipe
+    # Chunks stored before keys were per chunk: two fields, store-wide key.
+    assert parse_recipe(b"%s 7\n" % (b'dd' * 32)) == [('dd' * 32, 7, None)]
+
+def test_round_trip_shares_chunks(engine, store, vault, tmp_path):
+    shared = os.urandom(400000)
+    first = ingest(engine, vault, tmp_path, "first", shared + os.urandom(100000))
+    second = ingest(engine, vault, tmp_path, "second", os.urandom(100000) + shared)
+    assert decrypt(engine, first, tmp_path)[:len(shared)] == shared
+    assert decrypt(engine, second, tmp_path)[-len(shared):] == shared
+    stats = store.stats()
+    assert stats['files'] == 2
+    assert stats['stored_bytes'] < stats['referenced_bytes']
+
+def test_chunks_need_the_recipe_key(engine, store, vault, tmp_path):
+    data = os.urandom(100000)
+    ingest(engine, vault, tmp_path, "file", data)
+    fp = store._db.execute("SELECT fp FROM chunks").fetchone()[0]
+    # dedup.key alone does not open a chunk; the key is in the encrypted recipe.
+    with pytest.raises(InvalidTag):
+        store.read_chunk(fp)
+
+def test_tampered_chunk_is_rejected(engine, store, vault, tmp_path):
+    encrypted = ingest(engine, vault, tmp_path, "file", os.urandom(100000))
+    chunk = chunk_files(store)[0]
+    data = bytearray(chunk.read_bytes())
+    data[len(data) // 2] ^= 1
+    chunk.write_bytes(bytes(data))
+    with pytest.raises(IntegrityError):
+        decrypt(engine, encrypted, tmp_path)
+    assert not (tmp_path / "out.bin").exists()
+
+def test_missing_chunk_is_rejected(engine, store, vault, tmp_path):
+    encrypted = ingest(engine, vault, tmp_path, "file", os.urandom(100000))
+    chunk_files(store)[0].unlink()
+    with pytest.raises(IntegrityError):
+        decrypt(engine, encrypted, tmp_path)
+
+def test_gc_keeps_chunks_still_in_use(engine, store, vault, tmp_path, shredder):
+    shared = os.urandom(400000)
+    first = ingest(engine, vault, tmp_path, "first", shared + os.urandom(200000))
+    second_data = os.urandom(200000) + shared
+    second = ingest(engine, vault, tmp_path, "second", second_data)
+    before = set(chunk_files(store))
+
+    assert shredder.secure_delete_file(str(first))
+    assert (store.root / DELETED_LOG).exists()
+    removed = store.collect_garbage(shredder)
+
+    assert 0 < removed < len(before)
+    assert set(chunk_files(store)) < before
+    assert store.stats()['files'] == 1
+    assert decrypt(engine, second, tmp_path) == second_data
+    assert store.collect_garbage(shredder) == 0
+
+def test_gc_keeps_chunks_of_moved_files(engine, store, vault, tmp_path, shredder):
+    data = os.urandom(300000)
+    encrypted = ingest(engine, vault, tmp_path, "file", data)
+    before = chunk_files(store)
+    moved = tmp_path / "elsewhere.crypted"
+    shutil.move(str(encrypted), str(moved))
+
+    assert store.collect_garbage(shredder) == 0
+    assert chunk_files(store) == before
+    assert decrypt(engine, moved, tmp_path) == data
+
+def test_gc_keeps_chunks_of_files_removed_outside_cryptodisk(engine, store, vault, tmp_path, shredder):
+    encrypted = ingest(engine, vault, tmp_path, "file", os.urandom(300000))
+    before = chunk_files(store)
+    encrypted.unlink()
+    assert store.collect_garbage(shredder) == 0
+    assert chunk_files(store) == before
+
+def test_failed_ingest_leaves_no_chunks(engine, store, vault, tmp_path):
+    ingest(engine, vault, tmp_path, "kept", os.urandom(100000))
+    before = chunk_files(store)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+    engine._encrypt_stream = fail
+    with pytest.raises(RuntimeError):
+        ingest(engine, vault, tmp_path, "failed", os.urandom(300000))
+
+    assert chunk_files(store) == before
+    assert not (vault / "failed.crypted").exists()
+    assert store.stats()['files'] == 1
+
+def test_gc_releases_ingests_of_dead_processes(store):
+    process = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                             capture_output=True, text=True, check=True)
+    store.add_file('abandoned', io.BytesIO(os.urandom(200000)))
+    store._db.execute("UPDATE files SET pid = ? WHERE file_id = 'abandoned'", (int(process.stdout),))
+    store._db.commit()
+    store.add_file('running', io.BytesIO(os.urandom(200000)))
+
+    assert store.collect_garbage() > 0
+    assert [file_id for (file_id,) in store._db.execute("SELECT file_id FROM files")] == ['running']
+
+def test_store_reopens_with_its_key(engine, store, vault, tmp_path):
+    data = os.urandom(200000)
+    encrypted = ingest(engine, vault, tmp_path, "file", data)
+    store.close()
+    reopened = DedupStore(vault / ".chunks", key_file=tmp_path / "dedup.key", create=False)
+    try:
+        engine.dedup_store = reopened
+        assert decrypt(engine, encrypted, tmp_path) == data
+    finally:
+        reopened.close()
\ No newline at end of file